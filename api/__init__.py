@@ -1,6 +1,10 @@
 from .health_api import HealthApi
+from .metrics_api import MetricsApi
 from .organization_api import OrganizationApi
 from .user_api import UserApi
 from .project_api import ProjectApi
 from .data_center_api import DataCenterApi
 from .machine_key_api import MachineKeyApi
+from .machine_api import MachineApi
+from .infra_api import InfraApi
+from .json_provider import FastJSONProvider
@@ -0,0 +1,30 @@
+import inspect
+from functools import wraps
+
+from quart import Quart
+
+
+class AsyncApp(Quart):
+    # the Api classes are written as plain Flask views; with async services those views return
+    # coroutines, which are awaited here so the same registration code serves both apps
+    def add_url_rule(self, rule: str, endpoint: str = None, view_func=None, provide_automatic_options: bool = None,
+                     **options):
+        if view_func is not None and not inspect.iscoroutinefunction(view_func):
+            view_func = self.awaiting(view_func)
+
+        super().add_url_rule(rule, endpoint, view_func, provide_automatic_options, **options)
+
+    @staticmethod
+    def awaiting(view_func):
+        @wraps(view_func)
+        async def view(*args, **kwargs):
+            result = view_func(*args, **kwargs)
+            if inspect.isawaitable(result):
+                return await result
+
+            if isinstance(result, tuple) and result and inspect.isawaitable(result[0]):
+                return (await result[0],) + result[1:]
+
+            return result
+
+        return view
@@ -23,10 +23,30 @@ class DataCenterApi:
                 user["organization_id"],
             )
 
+        @self.app.post("/api/v1/projects/<project_id>/infra/data-centers/bulk")
+        @authenticate_user
+        def bulk_create_data_centers(user, project_id):
+            return self.data_center_service.bulk_create(
+                required_param("items", list),
+                project_id,
+                user["id"],
+                user["organization_id"],
+            )
+
+        @self.app.put("/api/v1/projects/<project_id>/infra/data-centers/bulk")
+        @authenticate_user
+        def bulk_update_data_centers(user, project_id):
+            return self.data_center_service.bulk_update(required_param("items", list), project_id, user["id"])
+
+        @self.app.delete("/api/v1/projects/<project_id>/infra/data-centers/bulk")
+        @authenticate_user
+        def bulk_delete_data_centers(user, project_id):
+            return self.data_center_service.bulk_delete(required_param("ids", list), project_id, user["id"])
+
         @self.app.get("/api/v1/projects/<project_id>/infra/regions/<region_id>//data-centers")
         @authenticate_user
         def fetch_data_centers(user, project_id, region_id):
-            return self.data_center_service.fetch(region_id, project_id, user["id"], page(), size())
+            return self.data_center_service.fetch(region_id, project_id, user["id"], page(), size(), cursor(), fields())
 
         @self.app.get("/api/v1/projects/<project_id>/infra/regions/<region_id>//data-centers/<data_center_id>")
         @authenticate_user
@@ -0,0 +1,35 @@
+import inspect
+from typing import AsyncIterator, Iterator
+
+from flask import Flask
+from lib.infra import InfraExportService
+from .utils import *
+
+
+class InfraApi:
+    def __init__(self, app: Flask, infra_export_service: InfraExportService):
+        self.app = app
+        self.infra_export_service = infra_export_service
+
+    def register(self):
+        @self.app.get("/api/v1/projects/<project_id>/infra/export")
+        @authenticate_user
+        def export_infra(user, project_id):
+            items = self.infra_export_service.export(project_id, user["id"])
+            if inspect.isawaitable(items):
+                return self.ndjson_response_async(items)
+            return self.ndjson_response(self.ndjson(items))
+
+    def ndjson_response(self, lines):
+        return self.app.response_class(lines, mimetype="application/x-ndjson")
+
+    async def ndjson_response_async(self, items):
+        return self.ndjson_response(self.ndjson_async(await items))
+
+    def ndjson(self, items: Iterator[dict]) -> Iterator[str]:
+        for item in items:
+            yield self.app.json.dumps(item) + "\n"
+
+    async def ndjson_async(self, items: AsyncIterator[dict]) -> AsyncIterator[str]:
+        async for item in items:
+            yield self.app.json.dumps(item) + "\n"
@@ -0,0 +1,78 @@
+from datetime import date, datetime, time, timezone
+from time import perf_counter
+
+from bson import ObjectId
+from flask import Flask, g, has_app_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def http_date(value: date) -> str:
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time())
+    elif value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+
+    return (f"{DAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} {value.year:04d} "
+            f"{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    def __init__(self, app: Flask, iso_datetimes: bool = False):
+        super().__init__(app)
+        self.iso_datetimes = iso_datetimes
+
+    def default(self, o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, date):
+            return o.isoformat() if self.iso_datetimes else http_date(o)
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or set(kwargs) - {"indent", "separators"}:
+            return super().dumps(obj, **kwargs)
+
+        return self.encode(obj, kwargs.get("indent") is not None).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        started = perf_counter()
+        data = self.encode(obj, indent)
+
+        metrics = g.get("metrics") if has_app_context() else None
+        if metrics is not None:
+            metrics.observe("controller_operation_duration_seconds", {"operation": "json_encode"},
+                            perf_counter() - started)
+
+        return self._app.response_class(data + b"\n", mimetype=self.mimetype)
+
+    def encode(self, obj, indent: bool = False) -> bytes:
+        option = 0
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if not self.iso_datetimes:
+            # keep the RFC 822 dates clients already parse; orjson would emit ISO 8601
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+
+        return orjson.dumps(obj, default=self.default, option=option)
@@ -0,0 +1,37 @@
+from flask import Flask
+from lib.infra import HeartbeatHistoryService, LivenessTracker, MachineService
+from .utils import *
+
+
+class MachineApi:
+    def __init__(self, app: Flask, machine_service: MachineService, heartbeat_history_service: HeartbeatHistoryService,
+                 liveness_tracker: LivenessTracker):
+        self.app = app
+        self.machine_service = machine_service
+        self.heartbeat_history_service = heartbeat_history_service
+        self.liveness_tracker = liveness_tracker
+
+    def register(self):
+        @self.app.post("/api/v1/machines/heartbeat")
+        def machine_heartbeat():
+            return self.machine_service.process_heartbeat(
+                machine_key(),
+                required_param("name"),
+                optional_param("data", dict),
+            ), 202
+
+        @self.app.get("/api/v1/projects/<project_id>/infra/machines/status")
+        @authenticate_user
+        def get_machine_status(user, project_id):
+            return self.liveness_tracker.status(project_id, user["id"])
+
+        @self.app.get("/api/v1/projects/<project_id>/infra/machines/<name>/history")
+        @authenticate_user
+        def get_machine_history(user, project_id, name):
+            return self.heartbeat_history_service.history(
+                project_id,
+                name,
+                user["id"],
+                time_param("from"),
+                time_param("to"),
+            )
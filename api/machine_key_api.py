@@ -19,10 +19,30 @@ class MachineKeyApi:
                 user["organization_id"]
             )
 
+        @self.app.post("/api/v1/projects/<project_id>/infra/machine-keys/bulk")
+        @authenticate_user
+        def bulk_create_machine_keys(user, project_id):
+            return self.machine_key_service.bulk_create(
+                required_param("items", list),
+                project_id,
+                user["id"],
+                user["organization_id"]
+            )
+
+        @self.app.put("/api/v1/projects/<project_id>/infra/machine-keys/bulk")
+        @authenticate_user
+        def bulk_update_machine_keys(user, project_id):
+            return self.machine_key_service.bulk_update(required_param("items", list), project_id, user["id"])
+
+        @self.app.delete("/api/v1/projects/<project_id>/infra/machine-keys/bulk")
+        @authenticate_user
+        def bulk_delete_machine_keys(user, project_id):
+            return self.machine_key_service.bulk_delete(required_param("ids", list), project_id, user["id"])
+
         @self.app.get("/api/v1/projects/<project_id>/infra/machine-keys")
         @authenticate_user
         def fetch_machine_keys(user, project_id):
-            return self.machine_key_service.fetch(project_id, user["id"], page(), size())
+            return self.machine_key_service.fetch(project_id, user["id"], page(), size(), cursor(), fields())
 
         @self.app.get("/api/v1/projects/<project_id>/infra/machine-keys/<machine_key_id>")
         @authenticate_user
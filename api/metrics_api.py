@@ -0,0 +1,15 @@
+from flask import Flask
+
+from lib.metrics import Metrics
+
+
+class MetricsApi:
+
+    def __init__(self, app: Flask, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    def register(self):
+        @self.app.get("/metrics")
+        def prometheus_metrics():
+            return self.app.response_class(self.metrics.render(), mimetype="text/plain; version=0.0.4")
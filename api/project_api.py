@@ -25,7 +25,9 @@ class ProjectApi:
             return self.project_service.fetch(
                 user["id"],
                 page(),
-                size()
+                size(),
+                cursor(),
+                fields()
             )
 
         @self.app.get("/api/v1/projects/<project_id>")
@@ -59,6 +61,25 @@ class ProjectApi:
                 user["organization_id"]
             )
 
+        @self.app.post("/api/v1/projects/<project_id>/access/bulk")
+        @authenticate_user
+        def bulk_project_access(user, project_id):
+            return self.project_service.bulk_access(
+                project_id,
+                required_param("items", list),
+                user["id"],
+                user["organization_id"]
+            )
+
+        @self.app.post("/api/v1/projects/<project_id>/access/copy")
+        @authenticate_user
+        def copy_project_access(user, project_id):
+            return self.project_service.copy_access(
+                project_id,
+                required_param("source_project_id"),
+                user["id"]
+            )
+
         @self.app.delete("/api/v1/projects/<project_id>/users/<user_id>/access")
         @authenticate_user
         def delete_project_access(user, project_id, user_id):
@@ -85,5 +106,7 @@ class ProjectApi:
                 project_id,
                 user["id"],
                 page(),
-                size()
+                size(),
+                cursor(),
+                fields()
             )
@@ -20,10 +20,30 @@ class RegionApi:
                 user["organization_id"],
             )
 
+        @self.app.post("/api/v1/projects/<project_id>/infra/regions/bulk")
+        @authenticate_user
+        def bulk_create_regions(user, project_id):
+            return self.region_service.bulk_create(
+                required_param("items", list),
+                project_id,
+                user["id"],
+                user["organization_id"],
+            )
+
+        @self.app.put("/api/v1/projects/<project_id>/infra/regions/bulk")
+        @authenticate_user
+        def bulk_update_regions(user, project_id):
+            return self.region_service.bulk_update(required_param("items", list), project_id, user["id"])
+
+        @self.app.delete("/api/v1/projects/<project_id>/infra/regions/bulk")
+        @authenticate_user
+        def bulk_delete_regions(user, project_id):
+            return self.region_service.bulk_delete(required_param("ids", list), project_id, user["id"])
+
         @self.app.get("/api/v1/projects/<project_id>/infra/regions")
         @authenticate_user
         def fetch_regions(user, project_id):
-            return self.region_service.fetch(project_id, user["id"], page(), size())
+            return self.region_service.fetch(project_id, user["id"], page(), size(), cursor(), fields())
 
         @self.app.get("/api/v1/projects/<project_id>/infra/regions/<region_id>")
         @authenticate_user
@@ -51,7 +51,7 @@ class UserApi:
         @self.app.get("/api/v1/users")
         @authenticate_user
         def fetch_users(user):
-            return self.user_service.fetch(user["organization_id"], page(), size())
+            return self.user_service.fetch(user["organization_id"], page(), size(), cursor(), fields())
 
         @self.app.get("/api/v1/users/<user_id>")
         @authenticate_user
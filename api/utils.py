@@ -1,7 +1,27 @@
+import hashlib
+import time
+from datetime import datetime
 from functools import wraps
 
+import flask
 import jwt
-from flask import g, request
+from werkzeug.local import LocalProxy
+
+try:
+    import quart
+except ImportError:
+    quart = None
+
+
+def current(name: str):
+    # the same routes are served by the Flask app and the ASGI app, so resolve whichever context is active
+    if quart is not None and quart.has_app_context():
+        return getattr(quart, name)
+    return getattr(flask, name)
+
+
+g = LocalProxy(lambda: current("g"))
+request = LocalProxy(lambda: current("request"))
 
 
 def required_param(key: str, data_type=str):
@@ -34,6 +54,40 @@ def size():
     return request.args.get("size", 50, int)
 
 
+def cursor():
+    return request.args.get("cursor")
+
+
+def fields():
+    value = request.args.get("fields")
+    if not value:
+        return None
+    return [field.strip() for field in value.split(",") if field.strip()]
+
+
+def time_param(key: str):
+    value = request.args.get(key)
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise Exception(f"Invalid value for {key}, expected an ISO 8601 time")
+
+    # stored times are naive local times, so offsets are converted rather than compared against them
+    if moment.tzinfo:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+
+def machine_key():
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Machine '):
+        raise Exception("Invalid machine key")
+
+    return auth_header.split(' ')[1]
+
+
 def authenticate_user(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -48,12 +102,7 @@ def authenticate_user(f):
             raise Exception("Invalid access token")
 
         try:
-            data = jwt.decode(token, g.jwt_signing_key, algorithms=['HS256'], issuer="silicate", audience="silicate")
-            current_user = {
-                "id": data["sub"],
-                "organization_id": data["organization_id"],
-                "admin": data["admin"]
-            }
+            current_user = decode_token(token)
         except Exception as _:
             raise Exception("Invalid access token")
 
@@ -61,6 +110,36 @@ def authenticate_user(f):
 
     return decorated
 
+
+def decode_token(token: str) -> dict:
+    token_cache = g.get("token_cache")
+    # the signing key is part of the cache key so rotating it never serves claims verified with the old key
+    cache_key = hashlib.sha256(f"{g.jwt_signing_key}\x00{token}".encode("utf-8")).digest()
+
+    if token_cache is not None:
+        current_user = token_cache.get(cache_key)
+        if current_user is not None:
+            return current_user
+
+    metrics = g.get("metrics")
+    started = time.perf_counter()
+    data = jwt.decode(token, g.jwt_signing_key, algorithms=['HS256'], issuer="silicate", audience="silicate")
+    if metrics is not None:
+        metrics.observe("controller_operation_duration_seconds", {"operation": "jwt_decode"},
+                        time.perf_counter() - started)
+    current_user = {
+        "id": data["sub"],
+        "organization_id": data["organization_id"],
+        "admin": data["admin"]
+    }
+
+    if token_cache is not None:
+        ttl = data["exp"] - time.time() if "exp" in data else None
+        token_cache.set(cache_key, current_user, ttl)
+
+    return current_user
+
+
 def check_admin(user):
     if not user["admin"]:
         raise Exception("Not allowed")
@@ -0,0 +1,97 @@
+import asyncio
+import os
+
+import pymongo
+from dotenv import *
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from quart import g, jsonify, request
+
+from api import *
+from api.async_app import AsyncApp
+from lib.metrics import CommandMetrics, Metrics
+from lib.slow_queries import SlowQueryLog
+from wiring import ASYNC_SERVICES, ERROR_RESPONSES, apply_migrations, build_controller, close_request, error_body, \
+    open_request, register, start_background, stop_background
+
+app = AsyncApp(__name__)
+load_dotenv()
+app.json = FastJSONProvider(app, os.getenv("JSON_ISO_DATETIMES", "false") == "true")
+
+metrics = Metrics()
+slow_query_log = SlowQueryLog(
+    float(os.getenv("SLOW_QUERY_MS", 100)),
+    os.getenv("SLOW_QUERY_LOG", "slow_queries.log"),
+    int(os.getenv("SLOW_QUERY_EXPLAIN_PER_MINUTE", 6)),
+)
+command_metrics = CommandMetrics(metrics)
+
+# requests run on the async driver, the heartbeat flusher, rollups and liveness writes keep their threads
+# and the blocking driver
+mongo_client = pymongo.AsyncMongoClient(
+    os.getenv("DB_HOST"),
+    int(os.getenv("DB_PORT")),
+    event_listeners=[command_metrics, slow_query_log],
+)
+background_client = pymongo.MongoClient(
+    os.getenv("DB_HOST"),
+    int(os.getenv("DB_PORT")),
+    event_listeners=[command_metrics, slow_query_log],
+)
+slow_query_log.attach(background_client)
+db = mongo_client[os.getenv("DB_NAME", "controller")]
+background_db = background_client[os.getenv("DB_NAME", "controller")]
+
+controller = build_controller(db, background_db, metrics, ASYNC_SERVICES)
+register(app, controller)
+
+
+def migrate():
+    # index and backfill work is blocking, it runs on a controller built over the background database
+    migration_controller = build_controller(background_db, background_db, Metrics())
+    try:
+        apply_migrations(migration_controller)
+    finally:
+        migration_controller.password_hasher.shutdown()
+
+
+@app.before_serving
+async def start_background_work():
+    await asyncio.to_thread(migrate)
+    start_background(controller)
+
+
+@app.after_serving
+async def stop_background_work():
+    stop_background(controller)
+    slow_query_log.shutdown()
+    await mongo_client.close()
+    background_client.close()
+
+
+@app.before_request
+async def before_request():
+    open_request(controller, g)
+    g.request_body = await request.get_json(force=True, silent=True)
+
+
+@app.after_request
+async def after_request(response):
+    return close_request(controller, g, request, response)
+
+
+def error_handler(status: int, headers: dict):
+    async def handle_error(e):
+        return jsonify(error_body(e)), status, headers
+
+    return handle_error
+
+
+for error, status, headers in ERROR_RESPONSES:
+    app.register_error_handler(error, error_handler(status, headers))
+
+
+if __name__ == '__main__':
+    config = Config()
+    config.bind = [f"{os.getenv('HOST')}:{os.getenv('PORT')}"]
+    asyncio.run(serve(app, config))
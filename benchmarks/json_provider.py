@@ -0,0 +1,70 @@
+import argparse
+import json
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from api.json_provider import FastJSONProvider, orjson
+
+
+def list_response(count: int) -> list[dict]:
+    items = []
+    for i in range(count):
+        items.append({
+            "id": ObjectId(),
+            "name": f"region-{i}",
+            "description": "Benchmark region with a realistic description length",
+            "project_id": str(ObjectId()),
+            "creator_id": str(ObjectId()),
+            "organization_id": str(ObjectId()),
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+        })
+    return items
+
+
+def measure(app: Flask, items: list[dict], repeat: int) -> float:
+    with app.app_context():
+        app.json.response(items)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            app.json.response(items)
+        return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare JSON providers on list responses")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 500, 5000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    providers = {
+        "flask-default": lambda app: DefaultJSONProvider(app),
+        "fast-json": lambda app: FastJSONProvider(app),
+        "fast-json-iso": lambda app: FastJSONProvider(app, iso_datetimes=True),
+    }
+
+    results = []
+    for size in args.sizes:
+        items = list_response(size)
+        for name, provider in providers.items():
+            app = Flask(__name__)
+            app.json = provider(app)
+            # the default provider cannot encode ObjectId, so give it the str ids services produce
+            payload = [{**item, "id": str(item["id"])} for item in items] if name == "flask-default" else items
+            seconds = measure(app, payload, args.repeat)
+            results.append({
+                "provider": name,
+                "items": size,
+                "ms_per_response": round(seconds * 1000, 3),
+                "items_per_second": round(size / seconds),
+            })
+
+    print(json.dumps({"orjson": orjson is not None, "results": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,480 @@
+import argparse
+import importlib
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable
+from unittest import mock
+
+from bson import ObjectId
+
+PASSWORD = "benchmark-password"
+MACHINE_KEY = "benchmark-machine-key-{}"
+BULK_SIZE = 50
+# mongomock has no correlated $lookup or $merge, so these are reported as skipped with --in-memory
+REQUIRES_MONGOD = {
+    "ProjectService.fetch",
+    "ProjectService.fetch_users",
+    "GET /api/v1/projects",
+    "GET /api/v1/projects/<project_id>/users",
+    "POST /api/v1/projects/<project_id>/access/copy",
+}
+SKIPPED = {"skipped": "requires mongod"}
+
+
+def load_server(args):
+    os.environ["DB_HOST"] = args.db_host
+    os.environ["DB_PORT"] = str(args.db_port)
+    os.environ["DB_NAME"] = args.db_name
+
+    if not args.in_memory:
+        return importlib.import_module("server").create_app().extensions["controller"]
+
+    import mongomock
+
+    with mock.patch("pymongo.MongoClient", mongomock.MongoClient):
+        return importlib.import_module("server").create_app().extensions["controller"]
+
+
+def seed(server, args) -> dict:
+    db = server.db
+    for name in db.list_collection_names():
+        db.drop_collection(name)
+
+    if not args.in_memory:
+        server.index_manager.apply()
+
+    now = datetime.now()
+    password_hash = server.password_hasher.hash(PASSWORD)
+    context = {
+        "organizations": [],
+    }
+
+    for o in range(args.organizations):
+        organization_id = ObjectId()
+        user_ids = [ObjectId() for _ in range(args.users)]
+        db.organizations.insert_one({
+            "_id": organization_id,
+            "name": f"organization-{o}",
+            "creator_id": str(user_ids[0]),
+            "created_at": now,
+            "updated_at": now,
+        })
+        db.users.insert_many([{
+            "_id": user_id,
+            "username": f"user-{u}",
+            "password": password_hash,
+            "organization_id": str(organization_id),
+            "creator_id": str(user_ids[0]),
+            "admin": u == 0,
+            "created_at": now,
+            "updated_at": now,
+        } for u, user_id in enumerate(user_ids)])
+
+        projects = []
+        for p in range(args.projects):
+            project_id = ObjectId()
+            project = {
+                "id": str(project_id),
+                "regions": [],
+                "data_centers": [],
+                "machine_keys": [],
+            }
+            base = {
+                "project_id": str(project_id),
+                "creator_id": str(user_ids[0]),
+                "organization_id": str(organization_id),
+                "created_at": now,
+                "updated_at": now,
+            }
+            db.projects.insert_one({
+                "_id": project_id,
+                "name": f"project-{p}",
+                **{key: value for key, value in base.items() if key != "project_id"},
+            })
+            db.project_accesses.insert_many([{
+                "project_id": str(project_id),
+                "user_id": str(user_id),
+                "permissions": ["all"] if u == 0 else ["infra.region.admin"],
+                "creator_id": "",
+                "created_at": now,
+                "updated_at": now,
+            } for u, user_id in enumerate(user_ids)])
+
+            for r in range(args.regions):
+                region_id = db.regions.insert_one({
+                    "name": f"region-{r}",
+                    "description": "Seeded benchmark region",
+                    **base,
+                }).inserted_id
+                project["regions"].append(str(region_id))
+                data_center_ids = db.data_centers.insert_many([{
+                    "name": f"data-center-{r}-{d}",
+                    "description": "Seeded benchmark data center",
+                    "region_id": str(region_id),
+                    **base,
+                } for d in range(args.data_centers)]).inserted_ids
+                project["data_centers"].extend((str(region_id), str(i)) for i in data_center_ids)
+
+            for m in range(args.machine_keys):
+                key = MACHINE_KEY.format(f"{o}-{p}-{m}")
+                machine_key_id = db.machine_keys.insert_one({
+                    "name": f"machine-key-{m}",
+                    "key": key,
+                    "key_hash": server.machine_key_service.hash_key(key),
+                    **base,
+                }).inserted_id
+                project["machine_keys"].append((str(machine_key_id), key))
+
+            projects.append(project)
+
+        token = server.user_service.get_token("user-0", PASSWORD, f"organization-{o}")["token"]
+        context["organizations"].append({
+            "id": str(organization_id),
+            "name": f"organization-{o}",
+            "admin_id": str(user_ids[0]),
+            "user_ids": [str(user_id) for user_id in user_ids],
+            "token": token,
+            "projects": projects,
+        })
+
+    return context
+
+
+def percentile(latencies: list[float], fraction: float) -> float:
+    index = max(0, min(len(latencies) - 1, int(round(fraction * len(latencies) + 0.5)) - 1))
+    return latencies[index]
+
+
+def measure(fn: Callable[[int], bool], iterations: int, threads: int) -> dict:
+    def timed(i: int):
+        started = time.perf_counter()
+        try:
+            ok = fn(i) is not False
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            samples = list(executor.map(timed, range(iterations)))
+    else:
+        samples = [timed(i) for i in range(iterations)]
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(sample[0] for sample in samples)
+    return {
+        "iterations": iterations,
+        "errors": sum(1 for sample in samples if not sample[1]),
+        "throughput": round(iterations / elapsed, 2) if elapsed else None,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run(name: str, fn: Callable[[int], bool], args) -> dict:
+    if args.in_memory and name in REQUIRES_MONGOD:
+        return SKIPPED
+
+    return measure(fn, args.iterations, args.threads)
+
+
+def service_scenarios(server, context: dict) -> dict:
+    organization = context["organizations"][0]
+    project = organization["projects"][0]
+    admin_id = organization["admin_id"]
+    member_id = organization["user_ids"][-1]
+    region_id = project["regions"][0]
+    data_center_region_id, data_center_id = project["data_centers"][0]
+    machine_key_id, machine_key = project["machine_keys"][0]
+    counter = itertools.count()
+
+    return {
+        "OrganizationService.get": lambda i: server.organization_service.get(organization["id"]),
+        "UserService.get_token": lambda i: server.user_service.get_token("user-0", PASSWORD, organization["name"]),
+        "UserService.get": lambda i: server.user_service.get(admin_id),
+        "UserService.fetch": lambda i: server.user_service.fetch(organization["id"]),
+        "UserService.get_by_organization": lambda i: server.user_service.get_by_organization(member_id,
+                                                                                             organization["id"]),
+        "ProjectAccessService.has_access": lambda i: server.project_access_service.has_access(
+            project["id"], member_id, "infra.region.admin"),
+        "ProjectAccessService.has_any_access": lambda i: server.project_access_service.has_any_access(project["id"],
+                                                                                                      admin_id),
+        "ProjectAccessService.fetch_users": lambda i: server.project_access_service.fetch_users(project["id"]),
+        "ProjectAccessService.fetch_projects": lambda i: server.project_access_service.fetch_projects(admin_id),
+        "ProjectService.get": lambda i: server.project_service.get(project["id"], admin_id),
+        "ProjectService.fetch": lambda i: server.project_service.fetch(admin_id),
+        "ProjectService.fetch_users": lambda i: server.project_service.fetch_users(project["id"], admin_id),
+        "RegionService.create": lambda i: server.region_service.create(f"bench-region-{next(counter)}", "", project["id"],
+                                                                       admin_id, organization["id"]),
+        "RegionService.get": lambda i: server.region_service.get(region_id, project["id"], admin_id),
+        "RegionService.fetch": lambda i: server.region_service.fetch(project["id"], admin_id),
+        "RegionService.fetch.cursor": lambda i: server.region_service.fetch(project["id"], admin_id, cursor=""),
+        "DataCenterService.get": lambda i: server.data_center_service.get(data_center_id, data_center_region_id,
+                                                                          project["id"], admin_id),
+        "DataCenterService.fetch": lambda i: server.data_center_service.fetch(data_center_region_id, project["id"],
+                                                                              admin_id),
+        "MachineKeyService.get": lambda i: server.machine_key_service.get(machine_key_id, project["id"], admin_id),
+        "MachineKeyService.fetch": lambda i: server.machine_key_service.fetch(project["id"], admin_id),
+        "MachineKeyService.authenticate": lambda i: server.machine_key_service.authenticate(machine_key),
+        "MachineService.process_heartbeat": lambda i: server.machine_service.process_heartbeat(
+            machine_key, f"machine-{i % 100}", {"cpu": i % 100}),
+        "InfraExportService.export": lambda i: sum(1 for _ in server.infra_export_service.export(project["id"],
+                                                                                                 admin_id)),
+    }
+
+
+def route_scenarios(server, context: dict) -> dict:
+    client = server.app.test_client()
+    organization = context["organizations"][0]
+    project = organization["projects"][0]
+    member_id = organization["user_ids"][-1]
+    region_id = project["regions"][0]
+    data_center_region_id, data_center_id = project["data_centers"][0]
+    machine_key_id, machine_key = project["machine_keys"][0]
+    counter = itertools.count()
+    headers = {"Authorization": f"Bearer {organization['token']}"}
+    projects = f"/api/v1/projects/{project['id']}"
+    regions = f"{projects}/infra/regions"
+    data_centers = f"{regions}/{data_center_region_id}/data-centers"
+    machine_keys = f"{projects}/infra/machine-keys"
+
+    def call(method: str, url: str, body: dict = None, auth: dict = None) -> bool:
+        response = client.open(url, method=method, json=body, headers=headers if auth is None else auth)
+        response.close()
+        return response.status_code < 400
+
+    def created(url: str, body: dict) -> str:
+        return client.post(url, json=body, headers=headers).get_json()["id"]
+
+    def unique(prefix: str) -> str:
+        return f"{prefix}-{next(counter)}"
+
+    def created_bulk(url: str, items: list[dict]) -> list[str]:
+        response = client.post(url, json={"items": items}, headers=headers).get_json()
+        return [item["id"] for item in response["items"] if item["success"]]
+
+    def batch(item: Callable[[], dict]) -> list[dict]:
+        return [item() for _ in range(BULK_SIZE)]
+
+    copy_target_id = created("/api/v1/projects", {"name": unique("bench-copy-target")})
+
+    return {
+        "GET /health": ("/health", lambda i: call("GET", "/health")),
+        "POST /api/v1/users/signup": ("/api/v1/users/signup", lambda i: call("POST", "/api/v1/users/signup", {
+            "username": "admin", "password": PASSWORD, "organization_name": unique("bench-organization")})),
+        "POST /api/v1/users/token": ("/api/v1/users/token", lambda i: call("POST", "/api/v1/users/token", {
+            "username": "user-0", "password": PASSWORD, "organization_name": organization["name"]})),
+        "GET /api/v1/users/me": ("/api/v1/users/me", lambda i: call("GET", "/api/v1/users/me")),
+        "PUT /api/v1/users/me/password": ("/api/v1/users/me/password", lambda i: call(
+            "PUT", "/api/v1/users/me/password", {"password": PASSWORD})),
+        "POST /api/v1/users": ("/api/v1/users", lambda i: call("POST", "/api/v1/users", {
+            "username": unique("bench-user"), "admin": False})),
+        "GET /api/v1/users": ("/api/v1/users", lambda i: call("GET", "/api/v1/users")),
+        "GET /api/v1/users/<user_id>": ("/api/v1/users/<user_id>", lambda i: call(
+            "GET", f"/api/v1/users/{member_id}")),
+        "PUT /api/v1/users/<user_id>/password": ("/api/v1/users/<user_id>/password", lambda i: call(
+            "PUT", f"/api/v1/users/{member_id}/password")),
+        "PUT /api/v1/users/<user_id>/admin": ("/api/v1/users/<user_id>/admin", lambda i: call(
+            "PUT", f"/api/v1/users/{member_id}/admin", {"admin": False})),
+        "DELETE /api/v1/users/<user_id>": ("/api/v1/users/<user_id>", lambda i: call(
+            "DELETE", f"/api/v1/users/{created('/api/v1/users', {'username': unique('doomed'), 'admin': False})}")),
+        "GET /api/v1/organization": ("/api/v1/organization", lambda i: call("GET", "/api/v1/organization")),
+        "POST /api/v1/projects": ("/api/v1/projects", lambda i: call("POST", "/api/v1/projects", {
+            "name": unique("bench-project")})),
+        "GET /api/v1/projects": ("/api/v1/projects", lambda i: call("GET", "/api/v1/projects")),
+        "GET /api/v1/projects/<project_id>": ("/api/v1/projects/<project_id>", lambda i: call("GET", projects)),
+        "PUT /api/v1/projects/<project_id>": ("/api/v1/projects/<project_id>", lambda i: call(
+            "PUT", projects, {"name": "project-0"})),
+        "DELETE /api/v1/projects/<project_id>": ("/api/v1/projects/<project_id>", lambda i: call(
+            "DELETE", f"/api/v1/projects/{created('/api/v1/projects', {'name': unique('doomed')})}")),
+        "POST /api/v1/projects/<project_id>/users/<user_id>/access": (
+            "/api/v1/projects/<project_id>/users/<user_id>/access", lambda i: call(
+                "POST", f"{projects}/users/{member_id}/access", {"permissions": ["infra.region.admin"]})),
+        "DELETE /api/v1/projects/<project_id>/users/<user_id>/access": (
+            "/api/v1/projects/<project_id>/users/<user_id>/access", lambda i: call(
+                "DELETE", f"{projects}/users/{member_id}/access", {"permissions": ["unused"]})),
+        "DELETE /api/v1/projects/<project_id>/users/<user_id>": (
+            "/api/v1/projects/<project_id>/users/<user_id>", lambda i: call(
+                "DELETE", f"{projects}/users/{member_id}") and call(
+                "POST", f"{projects}/users/{member_id}/access", {"permissions": ["infra.region.admin"]})),
+        "POST /api/v1/projects/<project_id>/access/bulk": ("/api/v1/projects/<project_id>/access/bulk", lambda i: call(
+            "POST", f"{projects}/access/bulk", {"items": [{"user_id": user_id, "grant": ["infra.region.admin"]}
+                                                          for user_id in organization["user_ids"][1:]]})),
+        "POST /api/v1/projects/<project_id>/access/copy": ("/api/v1/projects/<project_id>/access/copy", lambda i: call(
+            "POST", f"/api/v1/projects/{copy_target_id}/access/copy", {"source_project_id": project["id"]})),
+        "GET /api/v1/projects/<project_id>/users": ("/api/v1/projects/<project_id>/users", lambda i: call(
+            "GET", f"{projects}/users")),
+        "POST regions": ("/api/v1/projects/<project_id>/infra/regions", lambda i: call("POST", regions, {
+            "name": unique("bench-region")})),
+        "GET regions": ("/api/v1/projects/<project_id>/infra/regions", lambda i: call("GET", regions)),
+        "GET regions?cursor": ("/api/v1/projects/<project_id>/infra/regions", lambda i: call(
+            "GET", f"{regions}?cursor=")),
+        "GET region": ("/api/v1/projects/<project_id>/infra/regions/<region_id>", lambda i: call(
+            "GET", f"{regions}/{region_id}")),
+        "PUT region": ("/api/v1/projects/<project_id>/infra/regions/<region_id>", lambda i: call(
+            "PUT", f"{regions}/{region_id}", {"description": "updated"})),
+        "DELETE region": ("/api/v1/projects/<project_id>/infra/regions/<region_id>", lambda i: call(
+            "DELETE", f"{regions}/{created(regions, {'name': unique('doomed')})}")),
+        "POST data center": ("/api/v1/projects/<project_id>/infra/regions/<region_id>/data-centers", lambda i: call(
+            "POST", data_centers, {"name": unique("bench-data-center")})),
+        "GET data centers": ("/api/v1/projects/<project_id>/infra/regions/<region_id>//data-centers", lambda i: call(
+            "GET", data_centers)),
+        "GET data center": (
+            "/api/v1/projects/<project_id>/infra/regions/<region_id>//data-centers/<data_center_id>",
+            lambda i: call("GET", f"{data_centers}/{data_center_id}")),
+        "PUT data center": (
+            "/api/v1/projects/<project_id>/infra/regions/<region_id>//data-centers/<data_center_id>",
+            lambda i: call("PUT", f"{data_centers}/{data_center_id}", {"description": "updated"})),
+        "DELETE data center": (
+            "/api/v1/projects/<project_id>/infra/regions/<region_id>//data-centers/<data_center_id>",
+            lambda i: call("DELETE", f"{data_centers}/{created(data_centers, {'name': unique('doomed')})}")),
+        "POST machine key": ("/api/v1/projects/<project_id>/infra/machine-keys", lambda i: call(
+            "POST", machine_keys, {"name": unique("bench-machine-key")})),
+        "GET machine keys": ("/api/v1/projects/<project_id>/infra/machine-keys", lambda i: call("GET", machine_keys)),
+        "GET machine key": ("/api/v1/projects/<project_id>/infra/machine-keys/<machine_key_id>", lambda i: call(
+            "GET", f"{machine_keys}/{machine_key_id}")),
+        "PUT machine key": ("/api/v1/projects/<project_id>/infra/machine-keys/<machine_key_id>", lambda i: call(
+            "PUT", f"{machine_keys}/{machine_key_id}", {"name": "machine-key-0"})),
+        "DELETE machine key": ("/api/v1/projects/<project_id>/infra/machine-keys/<machine_key_id>", lambda i: call(
+            "DELETE", f"{machine_keys}/{created(machine_keys, {'name': unique('doomed')})}")),
+        "POST regions bulk": ("/api/v1/projects/<project_id>/infra/regions/bulk", lambda i: call(
+            "POST", f"{regions}/bulk", {"items": batch(lambda: {"name": unique("bench-region")})})),
+        "PUT regions bulk": ("/api/v1/projects/<project_id>/infra/regions/bulk", lambda i: call(
+            "PUT", f"{regions}/bulk", {"items": [{"id": region, "description": "updated"}
+                                                 for region in project["regions"][:BULK_SIZE]]})),
+        "DELETE regions bulk": ("/api/v1/projects/<project_id>/infra/regions/bulk", lambda i: call(
+            "DELETE", f"{regions}/bulk", {"ids": created_bulk(f"{regions}/bulk", batch(
+                lambda: {"name": unique("doomed")}))})),
+        "POST data centers bulk": ("/api/v1/projects/<project_id>/infra/data-centers/bulk", lambda i: call(
+            "POST", f"{projects}/infra/data-centers/bulk", {"items": batch(lambda: {
+                "name": unique("bench-data-center"), "region_id": data_center_region_id})})),
+        "PUT data centers bulk": ("/api/v1/projects/<project_id>/infra/data-centers/bulk", lambda i: call(
+            "PUT", f"{projects}/infra/data-centers/bulk", {"items": [{"id": data_center, "description": "updated"}
+                                                                     for _, data_center in
+                                                                     project["data_centers"][:BULK_SIZE]]})),
+        "DELETE data centers bulk": ("/api/v1/projects/<project_id>/infra/data-centers/bulk", lambda i: call(
+            "DELETE", f"{projects}/infra/data-centers/bulk", {"ids": created_bulk(
+                f"{projects}/infra/data-centers/bulk",
+                batch(lambda: {"name": unique("doomed"), "region_id": data_center_region_id}))})),
+        "POST machine keys bulk": ("/api/v1/projects/<project_id>/infra/machine-keys/bulk", lambda i: call(
+            "POST", f"{machine_keys}/bulk", {"items": batch(lambda: {"name": unique("bench-machine-key")})})),
+        "PUT machine keys bulk": ("/api/v1/projects/<project_id>/infra/machine-keys/bulk", lambda i: call(
+            "PUT", f"{machine_keys}/bulk", {"items": [{"id": machine_key_id}
+                                                      for machine_key_id, _ in project["machine_keys"][:BULK_SIZE]]})),
+        "DELETE machine keys bulk": ("/api/v1/projects/<project_id>/infra/machine-keys/bulk", lambda i: call(
+            "DELETE", f"{machine_keys}/bulk", {"ids": created_bulk(f"{machine_keys}/bulk", batch(
+                lambda: {"name": unique("doomed")}))})),
+        "GET machine key secret": ("/api/v1/projects/<project_id>/infra/machine-keys/<machine_key_id>/key",
+                                   lambda i: call("GET", f"{machine_keys}/{machine_key_id}/key")),
+        "POST /api/v1/machines/heartbeat": ("/api/v1/machines/heartbeat", lambda i: call(
+            "POST", "/api/v1/machines/heartbeat", {"name": f"machine-{i % 100}", "data": {"cpu": i % 100}},
+            {"Authorization": f"Machine {machine_key}"})),
+        "GET infra export": ("/api/v1/projects/<project_id>/infra/export", lambda i: call(
+            "GET", f"{projects}/infra/export")),
+        "GET machine status": ("/api/v1/projects/<project_id>/infra/machines/status", lambda i: call(
+            "GET", f"{projects}/infra/machines/status")),
+        "GET machine history": ("/api/v1/projects/<project_id>/infra/machines/<name>/history", lambda i: call(
+            "GET", f"{projects}/infra/machines/machine-{i % 100}/history")),
+    }
+
+
+def compare(baseline: dict, current: dict):
+    print(f"{'benchmark':70} {'p50 ms':>18} {'p99 ms':>18} {'throughput':>22}")
+    for section in ["services", "routes"]:
+        for name, result in current.get(section, {}).items():
+            before = baseline.get(section, {}).get(name)
+            if not before or "skipped" in before or "skipped" in result:
+                continue
+            print(f"{name[:70]:70} "
+                  f"{before['p50_ms']:>8} -> {result['p50_ms']:<7} "
+                  f"{before['p99_ms']:>8} -> {result['p99_ms']:<7} "
+                  f"{before['throughput']:>10} -> {result['throughput']:<9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark services and HTTP routes against seeded data")
+    parser.add_argument("--db-host", default="127.0.0.1")
+    parser.add_argument("--db-port", type=int, default=27017)
+    parser.add_argument("--db-name", default="controller_benchmark")
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock instead of a local mongod")
+    parser.add_argument("--organizations", type=int, default=5)
+    parser.add_argument("--users", type=int, default=50, help="users per organization")
+    parser.add_argument("--projects", type=int, default=10, help="projects per organization")
+    parser.add_argument("--regions", type=int, default=20, help="regions per project")
+    parser.add_argument("--data-centers", type=int, default=5, help="data centers per region")
+    parser.add_argument("--machine-keys", type=int, default=20, help="machine keys per project")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--only", help="run only benchmarks whose name contains this text")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="print a comparison with a previous JSON report")
+    args = parser.parse_args()
+
+    if args.db_name == "controller":
+        parser.error("refusing to seed the production database name")
+
+    server = load_server(args)
+    context = seed(server, args)
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "in_memory": args.in_memory,
+        "iterations": args.iterations,
+        "threads": args.threads,
+        "volumes": {
+            "organizations": args.organizations,
+            "users": args.users,
+            "projects": args.projects,
+            "regions": args.regions,
+            "data_centers": args.data_centers,
+            "machine_keys": args.machine_keys,
+        },
+        "services": {},
+        "routes": {},
+    }
+
+    for name, fn in service_scenarios(server, context).items():
+        if args.only and args.only not in name:
+            continue
+        report["services"][name] = run(name, fn, args)
+        print(f"{name}: {report['services'][name]}", file=sys.stderr)
+
+    covered = set()
+    for name, (rule, fn) in route_scenarios(server, context).items():
+        covered.add(rule)
+        if args.only and args.only not in name:
+            continue
+        report["routes"][name] = run(name, fn, args)
+        print(f"{name}: {report['routes'][name]}", file=sys.stderr)
+
+    report["uncovered_routes"] = sorted(
+        rule.rule for rule in server.app.url_map.iter_rules()
+        if rule.rule.startswith("/api/") and rule.rule not in covered
+    )
+
+    server.shutdown()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
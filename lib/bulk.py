@@ -0,0 +1,151 @@
+from typing import Callable, Iterable, Optional
+
+from bson import ObjectId
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+
+MAX_ITEMS = 1000
+
+
+def parse_items(items: list, parse_item: Callable) -> tuple[list[Optional[dict]], dict[int, dict]]:
+    if len(items) > MAX_ITEMS:
+        raise Exception(f"At most {MAX_ITEMS} items can be sent at once")
+
+    results = [None] * len(items)
+    parsed = {}
+    for position, item in enumerate(items):
+        try:
+            parsed[position] = parse_item(item)
+        except Exception as e:
+            results[position] = failure(str(e))
+
+    return results, parsed
+
+
+def item_param(item, key: str, data_type=str, required: bool = True):
+    if not isinstance(item, dict):
+        raise Exception("Item must be an object")
+    if key not in item or item[key] is None:
+        if required:
+            raise Exception(f"{key} is required")
+        return None
+    if not isinstance(item[key], data_type):
+        raise Exception(f"Invalid data type for value of {key}")
+    return item[key]
+
+
+def item_id(value, message: str) -> ObjectId:
+    if not isinstance(value, str) or not ObjectId.is_valid(value):
+        raise Exception(message)
+    return ObjectId(value)
+
+
+def names_query(project_id: str, parsed: dict[int, dict]) -> dict:
+    return {
+        "project_id": project_id,
+        "name": {"$in": list({fields["name"] for fields in parsed.values()})},
+    }
+
+
+def ids_query(project_id: str, parsed: dict[int, dict]) -> dict:
+    return {
+        "_id": {"$in": [fields["_id"] for fields in parsed.values()]},
+        "project_id": project_id,
+    }
+
+
+def targets_query(project_id: str, parsed: dict[int, dict]) -> dict:
+    # one round trip finds the documents being changed and the current owners of the names they take
+    return {
+        "project_id": project_id,
+        "$or": [
+            {"_id": {"$in": [fields["_id"] for fields in parsed.values()]}},
+            {"name": {"$in": [fields["name"] for fields in parsed.values() if fields.get("name")]}},
+        ],
+    }
+
+
+def claim_names(results: list, parsed: dict[int, dict], existing: Iterable[dict],
+                name_taken: str) -> dict[int, dict]:
+    taken = {document["name"] for document in existing}
+    claimed = {}
+    for position, fields in parsed.items():
+        if fields["name"] in taken:
+            results[position] = failure(name_taken.format(fields["name"]))
+            continue
+
+        taken.add(fields["name"])
+        claimed[position] = fields
+
+    return claimed
+
+
+def match_targets(results: list, parsed: dict[int, dict], existing: Iterable[dict], not_found: str,
+                  name_taken: str = None) -> dict[int, dict]:
+    found = {}
+    owners = {}
+    for document in existing:
+        found[document["_id"]] = document
+        if "name" in document:
+            owners[document["name"]] = document["_id"]
+
+    matched = {}
+    for position, fields in parsed.items():
+        if fields["_id"] not in found:
+            results[position] = failure(not_found)
+            continue
+
+        name = fields.get("name")
+        if name:
+            if owners.get(name, fields["_id"]) != fields["_id"]:
+                results[position] = failure(name_taken.format(name))
+                continue
+            owners[name] = fields["_id"]
+
+        matched[position] = {**found[fields["_id"]], **fields}
+        results[position] = success(fields["_id"])
+
+    return matched
+
+
+def write_bulk(mongo: Collection, operations: dict[int, object], results: list, duplicate: Callable[[int], str]):
+    if not operations:
+        return
+
+    try:
+        mongo.bulk_write(list(operations.values()), ordered=False)
+    except BulkWriteError as e:
+        record_write_errors(e, list(operations), results, duplicate)
+
+
+async def write_bulk_async(mongo, operations: dict[int, object], results: list, duplicate: Callable[[int], str]):
+    if not operations:
+        return
+
+    try:
+        await mongo.bulk_write(list(operations.values()), ordered=False)
+    except BulkWriteError as e:
+        record_write_errors(e, list(operations), results, duplicate)
+
+
+def record_write_errors(error: BulkWriteError, positions: list[int], results: list, duplicate: Callable[[int], str]):
+    for write_error in error.details["writeErrors"]:
+        position = positions[write_error["index"]]
+        if write_error["code"] == 11000:
+            results[position] = failure(duplicate(position))
+        else:
+            results[position] = failure(write_error["errmsg"])
+
+
+def success(document_id: ObjectId) -> dict:
+    return {
+        "success": True,
+        "id": str(document_id),
+    }
+
+
+def failure(message: str) -> dict:
+    return {
+        "success": False,
+        "message": message,
+    }
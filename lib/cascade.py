@@ -0,0 +1,263 @@
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.database import Database
+
+logger = logging.getLogger(__name__)
+
+PLANS = {
+    # access rows and machine keys go first so a deleted project stops granting anything
+    "project": [
+        ("project_accesses", "project_id"),
+        ("machine_keys", "project_id"),
+        ("data_centers", "project_id"),
+        ("regions", "project_id"),
+        ("machines", "project_id"),
+        ("projects", "_id"),
+    ],
+    "region": [
+        ("data_centers", "region_id"),
+        ("regions", "_id"),
+    ],
+    "user": [
+        ("project_accesses", "user_id"),
+        ("users", "_id"),
+    ],
+}
+
+
+# a deleted parent keeps this marker until its job has removed the children and then the parent itself
+NOT_DELETING = {"deleting": {"$ne": True}}
+
+
+def deleting_update() -> dict:
+    return {
+        "$set": {
+            "deleting": True,
+            "deleting_at": datetime.now(),
+            "updated_at": datetime.now(),
+        },
+    }
+
+
+class CascadeService:
+    def __init__(self, db: Database, batch_size: int = 1000, poll_interval: float = 5, lease: float = 60,
+                 pause: float = 0, retention: int = 604800,
+                 hooks: dict[str, tuple[dict, Callable[[list[dict]], None]]] = None):
+        self.db = db
+        self.mongo = db.cascade_jobs
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.pause = pause
+        self.hooks = hooks or {}
+        self.indexes = [
+            IndexModel([("state", ASCENDING), ("lease_until", ASCENDING)], name="state_lease_until"),
+            IndexModel([("finished_at", ASCENDING)], name="finished_at", expireAfterSeconds=retention),
+            IndexModel([("target_id", ASCENDING)], name="target_id"),
+        ]
+        self.owner = None
+        self.deleted = Counter()
+        self.finished = 0
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def enqueue(self, kind: str, target_ids: list[str], scope: dict = None) -> list[str]:
+        if not target_ids:
+            return []
+
+        result = self.mongo.insert_many([self.job_document(kind, target_id, scope) for target_id in target_ids])
+        self.wake.set()
+        return [str(job_id) for job_id in result.inserted_ids]
+
+    def start(self):
+        if self.thread:
+            return
+
+        # created after fork so every worker holds its own leases
+        self.owner = str(ObjectId())
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="cascade-deleter", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.stopped.set()
+        self.wake.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                job = self.claim()
+            except Exception:
+                logger.exception("Failed to claim a cascade job")
+                job = None
+
+            if job is None:
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
+                continue
+
+            try:
+                self.process(job)
+            except Exception:
+                logger.exception("Cascade job %s failed, it resumes once its lease expires", job["_id"])
+                self.stopped.wait(self.poll_interval)
+
+    def claim(self) -> Optional[dict]:
+        now = datetime.now()
+        return self.mongo.find_one_and_update({
+            "state": {"$ne": "done"},
+            "$or": [
+                {"lease_until": None},
+                {"lease_until": {"$lte": now}},
+            ],
+        }, {
+            "$set": {
+                "state": "running",
+                "lease_owner": self.owner,
+                "lease_until": now + timedelta(seconds=self.lease),
+                "updated_at": now,
+            },
+            "$inc": {
+                "attempts": 1,
+            },
+        }, sort=[("created_at", ASCENDING)], return_document=ReturnDocument.AFTER)
+
+    def process(self, job: dict):
+        for index in range(job["step"], len(job["steps"])):
+            step = job["steps"][index]
+            while True:
+                if self.stopped.is_set():
+                    self.release(job)
+                    return
+
+                found, deleted = self.delete_batch(step["collection"], self.step_query(job, step))
+                finished = found < self.batch_size
+                if not self.checkpoint(job, index, deleted, finished):
+                    logger.warning("Lost the lease on cascade job %s", job["_id"])
+                    return
+
+                if finished:
+                    break
+
+                if self.pause:
+                    self.stopped.wait(self.pause)
+
+        self.finish(job)
+
+    def delete_batch(self, collection_name: str, query: dict) -> tuple[int, int]:
+        collection = self.db[collection_name]
+        projection, hook = self.hooks.get(collection_name, ({}, None))
+        documents = list(collection.find(query, {"_id": 1, **projection}).limit(self.batch_size))
+        if not documents:
+            return 0, 0
+
+        deleted = collection.delete_many({
+            "_id": {"$in": [document["_id"] for document in documents]},
+        }).deleted_count
+        if hook:
+            hook(documents)
+
+        self.deleted[collection_name] += deleted
+        return len(documents), deleted
+
+    def checkpoint(self, job: dict, index: int, deleted: int, finished: bool) -> bool:
+        now = datetime.now()
+        fields = {
+            "lease_until": now + timedelta(seconds=self.lease),
+            "updated_at": now,
+        }
+
+        if finished:
+            fields["step"] = index + 1
+
+        return self.mongo.update_one({
+            "_id": job["_id"],
+            "lease_owner": self.owner,
+        }, {
+            "$set": fields,
+            "$inc": {
+                f"steps.{index}.deleted": deleted,
+            },
+        }).matched_count > 0
+
+    def finish(self, job: dict):
+        now = datetime.now()
+        self.mongo.update_one({
+            "_id": job["_id"],
+            "lease_owner": self.owner,
+        }, {
+            "$set": {
+                "state": "done",
+                "lease_until": None,
+                "updated_at": now,
+                "finished_at": now,
+            },
+        })
+        self.finished += 1
+
+    def release(self, job: dict):
+        self.mongo.update_one({
+            "_id": job["_id"],
+            "lease_owner": self.owner,
+        }, {
+            "$set": {
+                "lease_until": None,
+                "updated_at": datetime.now(),
+            },
+        })
+
+    def stats(self) -> dict:
+        return {
+            "deleted": dict(self.deleted),
+            "finished": self.finished,
+        }
+
+    @staticmethod
+    def step_query(job: dict, step: dict) -> dict:
+        if step["field"] == "_id":
+            # the parent goes last and only while it is still marked
+            return {"_id": ObjectId(job["target_id"]), "deleting": True, **job.get("scope", {})}
+
+        return {step["field"]: job["target_id"], **job.get("scope", {})}
+
+    @staticmethod
+    def job_document(kind: str, target_id: str, scope: dict = None) -> dict:
+        return {
+            "kind": kind,
+            "target_id": target_id,
+            # extra equality filters so each step can use the child collection's compound indexes
+            "scope": scope or {},
+            "state": "pending",
+            "step": 0,
+            "steps": [{
+                "collection": collection_name,
+                "field": field,
+                "deleted": 0,
+            } for collection_name, field in PLANS[kind]],
+            "attempts": 0,
+            "lease_owner": None,
+            "lease_until": None,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+        }
+
+
+class AsyncCascadeService(CascadeService):
+    async def enqueue(self, kind: str, target_ids: list[str], scope: dict = None) -> list[str]:
+        if not target_ids:
+            return []
+
+        result = await self.mongo.insert_many([self.job_document(kind, target_id, scope) for target_id in target_ids])
+        return [str(job_id) for job_id in result.inserted_ids]
@@ -0,0 +1,2 @@
+class ServiceBusyError(Exception):
+    pass
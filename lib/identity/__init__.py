@@ -1,2 +1,4 @@
 from .organization_service import OrganizationService
 from .user_service import UserService
+from .password_hasher import PasswordHasher
+from .async_services import AsyncOrganizationService, AsyncUserService
@@ -0,0 +1,209 @@
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from lib.cascade import AsyncCascadeService, deleting_update
+from lib.pagination import paginate_async
+from lib.projection import narrow_projection
+
+from .organization_service import OrganizationService
+from .user_service import UserService
+
+
+class AsyncOrganizationService(OrganizationService):
+    async def create(self, name: str, creator_id: str, organization_id: ObjectId) -> bool:
+        try:
+            await self.mongo.insert_one(self.organization_document(name, creator_id, organization_id))
+        except DuplicateKeyError as e:
+            return self.created(e)
+
+        return True
+
+    async def delete(self, organization_id: str):
+        await self.mongo.delete_one({
+            "_id": ObjectId(organization_id)
+        })
+
+    async def get(self, organization_id: str) -> dict:
+        organization = await self.mongo.find_one({
+            "_id": ObjectId(organization_id)
+        }, self.projection)
+
+        if not organization:
+            raise Exception("Organization not found")
+
+        return self.to_dict(organization)
+
+    async def get_by_name(self, name: str) -> dict:
+        organization = await self.mongo.find_one({
+            "name": name
+        }, self.projection)
+
+        if not organization:
+            raise Exception(f"Organization {name} not found")
+
+        return self.to_dict(organization)
+
+
+class AsyncUserService(UserService):
+    cascade_service: AsyncCascadeService
+
+    async def sign_up(self, username: str, password: str, organization_name: str) -> dict:
+        user_id = ObjectId()
+        organization_id = ObjectId()
+        hashed_password = await self.password_hasher.hash_async(password)
+
+        try:
+            await self.mongo.insert_one(self.sign_up_user(user_id, username, hashed_password, organization_id,
+                                                          organization_name))
+        except DuplicateKeyError:
+            raise Exception(f"Organization {organization_name} already exists")
+
+        if not await self.organization_service.create(organization_name, str(user_id), organization_id):
+            await self.mongo.delete_one({"_id": user_id})
+            raise Exception(f"Organization {organization_name} already exists")
+
+        return {
+            "id": str(user_id),
+            "organization_id": str(organization_id)
+        }
+
+    async def get_token(self, username: str, password: str, organization_name: str) -> dict:
+        organization = await self.get_organization(organization_name)
+        user = await self.mongo.find_one(self.credentials_query(username, organization["id"]), {"password": 1, "organization_id": 1, "admin": 1})
+
+        if not user:
+            raise Exception("Invalid username and password combination")
+
+        valid, upgraded_password = await self.password_hasher.verify_async(password, user["password"])
+        if not valid:
+            raise Exception("Invalid username and password combination")
+
+        if upgraded_password:
+            await self.mongo.update_one({
+                "_id": user["_id"],
+                "password": user["password"]
+            }, {
+                "$set": {
+                    "password": upgraded_password
+                }
+            })
+
+        return self.issue_token(user)
+
+    async def get_organization(self, name: str) -> dict:
+        try:
+            return await self.organization_service.get_by_name(name)
+        except Exception:
+            founder = await self.mongo.find_one(self.founder_query(name), {"organization_id": 1})
+            if not founder or not await self.organization_service.create(name, str(founder["_id"]),
+                                                                         ObjectId(founder["organization_id"])):
+                raise
+
+            return {"id": founder["organization_id"]}
+
+    async def get(self, user_id: str) -> dict:
+        user = await self.mongo.find_one(self.user_query(user_id), self.projection)
+
+        if not user:
+            raise Exception("User not found")
+
+        return self.to_dict(user)
+
+    async def change_password(self, user_id: str, password: str):
+        result = await self.mongo.update_one(self.user_query(user_id), {
+            "$set": self.password_fields(await self.password_hasher.hash_async(password))
+        })
+
+        if result.matched_count == 0:
+            raise Exception("User not found")
+
+        return {
+            "id": user_id
+        }
+
+    async def add(self, username: str, admin: bool, creator_id: str, organization_id: str) -> dict:
+        password = self.password_generator.generate()
+
+        try:
+            result = await self.mongo.insert_one(self.user_document(
+                username, await self.password_hasher.hash_async(password), admin, creator_id, organization_id))
+        except DuplicateKeyError:
+            raise Exception(f"Username {username} already exists")
+
+        return {
+            "id": str(result.inserted_id),
+            "password": password,
+        }
+
+    async def delete(self, user_id: str, organization_id: str) -> dict:
+        query = self.member_query(user_id, organization_id)
+        if not self.cascade_service:
+            result = await self.mongo.delete_one(query)
+            if result.deleted_count == 0:
+                raise Exception("User not found")
+
+            return {
+                "id": user_id
+            }
+
+        result = await self.mongo.update_one(query, deleting_update())
+        if result.matched_count == 0:
+            raise Exception("User not found")
+
+        await self.cascade_service.enqueue("user", [user_id])
+
+        return {
+            "id": user_id
+        }
+
+    async def fetch(self, organization_id: str, page=0, size=50, cursor: str = None,
+                    fields: list[str] = None) -> list[dict] | dict:
+        return await paginate_async(self.mongo, self.organization_query(organization_id), self.to_dict, page, size, cursor, narrow_projection(self.projection, fields))
+
+    async def fetch_by_ids(self, user_ids: list[str]) -> list[dict]:
+        users = await self.mongo.find(self.ids_query(user_ids), self.projection).to_list(None)
+
+        return [self.to_dict(user) for user in users]
+
+    async def existing(self, user_ids: list[str], organization_id: str) -> set[str]:
+        users = await self.mongo.find(self.existing_query(user_ids, organization_id), {"_id": 1}).to_list(None)
+        return {str(user["_id"]) for user in users}
+
+    async def get_by_organization(self, user_id: str, organization_id: str) -> dict:
+        user = await self.mongo.find_one(self.member_query(user_id, organization_id), self.projection)
+
+        if not user:
+            raise Exception("User not found")
+
+        return self.to_dict(user)
+
+    async def reset_password(self, user_id: str, organization_id: str) -> dict:
+        password = self.password_generator.generate()
+        result = await self.mongo.update_one(self.member_query(user_id, organization_id), {
+            "$set": self.password_fields(await self.password_hasher.hash_async(password))
+        })
+
+        if result.matched_count == 0:
+            raise Exception("User not found")
+
+        return {
+            "id": user_id,
+            "password": password
+        }
+
+    async def change_admin(self, user_id: str, admin: bool, organization_id: str) -> dict:
+        result = await self.mongo.update_one(self.member_query(user_id, organization_id), {
+            "$set": {
+                "updated_at": datetime.now(),
+                "admin": admin
+            }
+        })
+
+        if result.matched_count == 0:
+            raise Exception("User not found")
+
+        return {
+            "id": user_id
+        }
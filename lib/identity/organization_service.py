@@ -1,28 +1,45 @@
 from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
 from pymongo.collection import Collection
 from datetime import datetime
 
+from lib.projection import document_to_dict
+
 
 class OrganizationService:
+    public_fields = [
+        "name",
+        "creator_id",
+        "created_at",
+        "updated_at",
+    ]
+    projection = dict.fromkeys(public_fields, 1)
+
+    indexes = [
+        IndexModel([("name", ASCENDING)], name="name", unique=True),
+    ]
+
     def __init__(self, mongo: Collection):
         self.mongo = mongo
 
-    def create(self, name: str, creator_id: str) -> dict:
-        organization_id = self.mongo.insert_one({
-            "name": name,
-            "creator_id": creator_id,
-            "created_at": datetime.now(),
-            "updated_at": datetime.now(),
-        }).inserted_id
+    def create(self, name: str, creator_id: str, organization_id: ObjectId) -> bool:
+        try:
+            self.mongo.insert_one(self.organization_document(name, creator_id, organization_id))
+        except DuplicateKeyError as e:
+            return self.created(e)
 
-        return {
-            "id": str(organization_id),
-        }
+        return True
+
+    def delete(self, organization_id: str):
+        self.mongo.delete_one({
+            "_id": ObjectId(organization_id)
+        })
 
     def get(self, organization_id: str) -> dict:
         organization = self.mongo.find_one({
             "_id": ObjectId(organization_id)
-        })
+        }, self.projection)
 
         if not organization:
             raise Exception("Organization not found")
@@ -32,24 +49,28 @@ class OrganizationService:
     def get_by_name(self, name: str) -> dict:
         organization = self.mongo.find_one({
             "name": name
-        })
+        }, self.projection)
 
         if not organization:
             raise Exception(f"Organization {name} not found")
 
         return self.to_dict(organization)
 
-    def name_exists(self, name: str) -> bool:
-        return self.mongo.count_documents({
-            "name": name
-        }) > 0
-
     @staticmethod
-    def to_dict(self):
+    def organization_document(name: str, creator_id: str, organization_id: ObjectId) -> dict:
         return {
-            "id": str(self["_id"]),
-            "name": self["name"],
-            "creator_id": self["creator_id"],
-            "created_at": self["created_at"],
-            "updated_at": self["updated_at"],
+            "_id": organization_id,
+            "name": name,
+            "creator_id": creator_id,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
         }
+
+    @staticmethod
+    def created(e: DuplicateKeyError) -> bool:
+        # a retried insert finds its own organization, an organization from before sign-up claims keeps its name
+        return "_id" in (e.details or {}).get("keyPattern", {})
+
+    @staticmethod
+    def to_dict(self):
+        return document_to_dict(self, OrganizationService.public_fields)
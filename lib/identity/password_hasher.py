@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+import bcrypt
+
+from lib.errors import ServiceBusyError
+from lib.metrics import Metrics
+
+
+class PasswordHasher:
+    def __init__(self, rounds: int = 12, workers: int = 4, max_queue: int = 32, metrics: Metrics = None,
+                 threads: int = None):
+        self.rounds = rounds
+        self.metrics = metrics
+        self.workers = workers
+        self.max_queue = max_queue
+        # blocking callers hold a request thread while they wait, so admit fewer than the threads there are and
+        # keep at least one free for requests that never touch bcrypt
+        self.limit = workers + max_queue
+        if threads:
+            self.limit = max(1, min(self.limit, threads - 1))
+        # bcrypt releases the GIL while hashing, so threads spread the work across cores
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+        self.slots = threading.BoundedSemaphore(self.limit)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+
+    def hash(self, password: str) -> str:
+        return self.submit(self.timed, "bcrypt_hash", self.compute_hash, password).result()
+
+    def verify(self, password: str, hashed: str) -> tuple[bool, Optional[str]]:
+        return self.submit(self.timed, "bcrypt_verify", self.check, password, hashed).result()
+
+    async def hash_async(self, password: str) -> str:
+        return await asyncio.wrap_future(self.submit(self.timed, "bcrypt_hash", self.compute_hash, password))
+
+    async def verify_async(self, password: str, hashed: str) -> tuple[bool, Optional[str]]:
+        return await asyncio.wrap_future(self.submit(self.timed, "bcrypt_verify", self.check, password, hashed))
+
+    def timed(self, operation: str, fn: Callable, *args):
+        if not self.metrics:
+            return fn(*args)
+
+        with self.metrics.time("controller_operation_duration_seconds", {"operation": operation}):
+            return fn(*args)
+
+    def compute_hash(self, password: str) -> str:
+        return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(self.rounds)).decode("utf-8")
+
+    def check(self, password: str, hashed: str) -> tuple[bool, Optional[str]]:
+        if not bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8")):
+            return False, None
+
+        if self.cost(hashed) < self.rounds:
+            return True, self.compute_hash(password)
+
+        return True, None
+
+    def submit(self, fn: Callable, *args) -> Future:
+        submitted = time.perf_counter()
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise ServiceBusyError("Too many password operations in progress, try again later")
+
+        with self.lock:
+            self.pending += 1
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.release(None)
+            raise
+
+        future.add_done_callback(self.release)
+        if self.metrics:
+            future.add_done_callback(lambda _: self.metrics.observe(
+                "controller_operation_duration_seconds", {"operation": "bcrypt_queue_and_run"},
+                time.perf_counter() - submitted))
+        return future
+
+    def release(self, _):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "rounds": self.rounds,
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "limit": self.limit,
+                "pending": self.pending,
+                "rejected": self.rejected,
+            }
+
+    @staticmethod
+    def cost(hashed: str) -> int:
+        try:
+            return int(hashed.split("$")[2])
+        except (IndexError, ValueError):
+            return 0
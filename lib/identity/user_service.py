@@ -1,63 +1,105 @@
 import time
 from datetime import datetime
 
-import bcrypt
 import jwt
 from bson import ObjectId
 from password_generator import PasswordGenerator
+from pymongo import ASCENDING, IndexModel
 from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+
+from lib.cascade import NOT_DELETING, CascadeService, deleting_update
+from lib.pagination import paginate
+from lib.projection import document_to_dict, narrow_projection
 
 from .organization_service import OrganizationService
+from .password_hasher import PasswordHasher
 
 
 class UserService:
-
-    def __init__(self, mongo: Collection, organization_service: OrganizationService, jwt_signing_key: str):
+    public_fields = [
+        "username",
+        "organization_id",
+        "admin",
+        "created_at",
+        "updated_at",
+    ]
+    projection = dict.fromkeys(public_fields, 1)
+
+    indexes = [
+        IndexModel([("organization_id", ASCENDING), ("username", ASCENDING)], name="organization_id_username",
+                   unique=True, partialFilterExpression={"organization_id": {"$type": "string"}}),
+        IndexModel([("organization_id", ASCENDING), ("_id", ASCENDING)], name="organization_id__id"),
+        IndexModel([("founded_organization", ASCENDING)], name="founded_organization", unique=True,
+                   partialFilterExpression={"founded_organization": {"$type": "string"}}),
+    ]
+
+    def __init__(self, mongo: Collection, organization_service: OrganizationService, jwt_signing_key: str,
+                 password_hasher: PasswordHasher, cascade_service: CascadeService = None):
         self.mongo = mongo
         self.organization_service = organization_service
         self.jwt_signing_key = jwt_signing_key
+        self.password_hasher = password_hasher
+        self.cascade_service = cascade_service
         self.password_generator = PasswordGenerator()
 
     def sign_up(self, username: str, password: str, organization_name: str) -> dict:
-        if self.organization_service.name_exists(organization_name):
+        user_id = ObjectId()
+        organization_id = ObjectId()
+        hashed_password = self.password_hasher.hash(password)
+
+        # the founding user claims the organization name, so this one insert decides the sign-up; the organization
+        # document written next is restored from the claim if it never lands
+        try:
+            self.mongo.insert_one(self.sign_up_user(user_id, username, hashed_password, organization_id,
+                                                    organization_name))
+        except DuplicateKeyError:
             raise Exception(f"Organization {organization_name} already exists")
 
-        user_id = self.mongo.insert_one({
-            "username": username,
-            "password": bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
-            "organization_id": None,
-            "creator_id": None,
-            "admin": True,
-            "created_at": datetime.now(),
-            "updated_at": datetime.now(),
-        }).inserted_id
-
-        user_id_str = str(user_id)
-        organization_id = self.organization_service.create(organization_name, user_id_str)["id"]
-
-        self.mongo.update_one({
-            "_id": user_id
-        }, {
-            "$set": {
-                "organization_id": organization_id
-            }
-        })
+        if not self.organization_service.create(organization_name, str(user_id), organization_id):
+            self.mongo.delete_one({"_id": user_id})
+            raise Exception(f"Organization {organization_name} already exists")
 
         return {
-            "id": user_id_str,
-            "organization_id": organization_id
+            "id": str(user_id),
+            "organization_id": str(organization_id)
         }
 
     def get_token(self, username: str, password: str, organization_name: str) -> dict:
-        organization = self.organization_service.get_by_name(organization_name)
-        user = self.mongo.find_one({
-            "username": username,
-            "organization_id": organization["id"]
-        })
+        organization = self.get_organization(organization_name)
+        user = self.mongo.find_one(self.credentials_query(username, organization["id"]), {"password": 1, "organization_id": 1, "admin": 1})
+
+        if not user:
+            raise Exception("Invalid username and password combination")
 
-        if not user or not bcrypt.checkpw(password.encode('utf-8'), user["password"].encode('utf-8')):
+        valid, upgraded_password = self.password_hasher.verify(password, user["password"])
+        if not valid:
             raise Exception("Invalid username and password combination")
 
+        if upgraded_password:
+            self.mongo.update_one({
+                "_id": user["_id"],
+                "password": user["password"]
+            }, {
+                "$set": {
+                    "password": upgraded_password
+                }
+            })
+
+        return self.issue_token(user)
+
+    def get_organization(self, name: str) -> dict:
+        try:
+            return self.organization_service.get_by_name(name)
+        except Exception:
+            founder = self.mongo.find_one(self.founder_query(name), {"organization_id": 1})
+            if not founder or not self.organization_service.create(name, str(founder["_id"]),
+                                                                   ObjectId(founder["organization_id"])):
+                raise
+
+            return {"id": founder["organization_id"]}
+
+    def issue_token(self, user: dict) -> dict:
         token = jwt.encode({
             "sub": str(user["_id"]),
             "organization_id": user["organization_id"],
@@ -72,25 +114,43 @@ class UserService:
         }
 
     def get(self, user_id: str) -> dict:
-        user = self.mongo.find_one({
-            "_id": ObjectId(user_id),
-        })
+        user = self.mongo.find_one(self.user_query(user_id), self.projection)
 
         if not user:
             raise Exception("User not found")
 
         return self.to_dict(user)
 
-    def change_password(self, user_id: str, password: str):
-        fields = {
-            "password": bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
+    def existing(self, user_ids: list[str], organization_id: str) -> set[str]:
+        users = self.mongo.find(self.existing_query(user_ids, organization_id), {"_id": 1})
+        return {str(user["_id"]) for user in users}
+
+    @staticmethod
+    def existing_query(user_ids: list[str], organization_id: str) -> dict:
+        return {
+            "_id": {"$in": [ObjectId(user_id) for user_id in set(user_ids) if ObjectId.is_valid(user_id)]},
+            "organization_id": organization_id,
+            **NOT_DELETING,
+        }
+
+    @staticmethod
+    def sign_up_user(user_id: ObjectId, username: str, hashed_password: str, organization_id: ObjectId,
+                     organization_name: str) -> dict:
+        return {
+            "_id": user_id,
+            "username": username,
+            "password": hashed_password,
+            "organization_id": str(organization_id),
+            "founded_organization": organization_name,
+            "creator_id": None,
+            "admin": True,
+            "created_at": datetime.now(),
             "updated_at": datetime.now(),
         }
 
-        result = self.mongo.update_one({
-            "_id": ObjectId(user_id),
-        }, {
-            "$set": fields
+    def change_password(self, user_id: str, password: str):
+        result = self.mongo.update_one(self.user_query(user_id), {
+            "$set": self.password_fields(self.password_hasher.hash(password))
         })
 
         if result.matched_count == 0:
@@ -101,20 +161,13 @@ class UserService:
         }
 
     def add(self, username: str, admin: bool, creator_id: str, organization_id: str) -> dict:
-        if self.username_exists(username, organization_id):
-            raise Exception(f"Username {username} already exists")
-
         password = self.password_generator.generate()
 
-        user_id = self.mongo.insert_one({
-            "username": username,
-            "password": bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
-            "admin": admin,
-            "creator_id": creator_id,
-            "organization_id": organization_id,
-            "created_at": datetime.now(),
-            "updated_at": datetime.now(),
-        }).inserted_id
+        try:
+            user_id = self.mongo.insert_one(self.user_document(username, self.password_hasher.hash(password), admin,
+                                                               creator_id, organization_id)).inserted_id
+        except DuplicateKeyError:
+            raise Exception(f"Username {username} already exists")
 
         return {
             "id": str(user_id),
@@ -122,36 +175,97 @@ class UserService:
         }
 
     def delete(self, user_id: str, organization_id: str) -> dict:
-        result = self.mongo.delete_one({
-            "_id": ObjectId(user_id),
-            "organization_id": organization_id
-        })
+        query = self.member_query(user_id, organization_id)
+        if not self.cascade_service:
+            result = self.mongo.delete_one(query)
+            if result.deleted_count == 0:
+                raise Exception("User not found")
+
+            return {
+                "id": user_id
+            }
 
-        if result.deleted_count == 0:
+        # the marker locks the user out at once, the cascade job removes their access rows and then the user
+        result = self.mongo.update_one(query, deleting_update())
+        if result.matched_count == 0:
             raise Exception("User not found")
 
+        self.cascade_service.enqueue("user", [user_id])
+
         return {
             "id": user_id
         }
 
-    def fetch(self, organization_id: str, page=0, size=50) -> list[dict]:
-        users = self.mongo.find({
-            "organization_id": organization_id
-        }).skip(page * size).limit(size)
+    @staticmethod
+    def user_query(user_id: str) -> dict:
+        return {
+            "_id": ObjectId(user_id),
+            **NOT_DELETING,
+        }
 
-        result = []
-        for user in users:
-            result.append(self.to_dict(user))
+    @staticmethod
+    def member_query(user_id: str, organization_id: str) -> dict:
+        return {
+            "_id": ObjectId(user_id),
+            "organization_id": organization_id,
+            **NOT_DELETING,
+        }
 
-        return result
+    @staticmethod
+    def organization_query(organization_id: str) -> dict:
+        return {
+            "organization_id": organization_id,
+            **NOT_DELETING,
+        }
+
+    @staticmethod
+    def credentials_query(username: str, organization_id: str) -> dict:
+        return {
+            "username": username,
+            "organization_id": organization_id,
+            **NOT_DELETING,
+        }
+
+    @staticmethod
+    def founder_query(organization_name: str) -> dict:
+        return {
+            "founded_organization": organization_name,
+            **NOT_DELETING,
+        }
+
+    @staticmethod
+    def ids_query(user_ids: list[str]) -> dict:
+        return {
+            "_id": {"$in": [ObjectId(user_id) for user_id in user_ids]},
+            **NOT_DELETING,
+        }
+
+    @staticmethod
+    def user_document(username: str, hashed_password: str, admin: bool, creator_id: str,
+                      organization_id: str) -> dict:
+        return {
+            "username": username,
+            "password": hashed_password,
+            "admin": admin,
+            "creator_id": creator_id,
+            "organization_id": organization_id,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+        }
+
+    @staticmethod
+    def password_fields(hashed_password: str) -> dict:
+        return {
+            "password": hashed_password,
+            "updated_at": datetime.now(),
+        }
+
+    def fetch(self, organization_id: str, page=0, size=50, cursor: str = None,
+              fields: list[str] = None) -> list[dict] | dict:
+        return paginate(self.mongo, self.organization_query(organization_id), self.to_dict, page, size, cursor, narrow_projection(self.projection, fields))
 
     def fetch_by_ids(self, user_ids: list[str]) -> list[dict]:
-        ids = []
-        for user_id in user_ids:
-            ids.append(ObjectId(user_id))
-        users = self.mongo.find({
-            "_id": {"$in": ids}
-        })
+        users = self.mongo.find(self.ids_query(user_ids), self.projection)
 
         result = []
         for user in users:
@@ -159,10 +273,7 @@ class UserService:
         return result
 
     def get_by_organization(self, user_id: str, organization_id: str) -> dict:
-        user = self.mongo.find_one({
-            "_id": ObjectId(user_id),
-            "organization_id": organization_id
-        })
+        user = self.mongo.find_one(self.member_query(user_id, organization_id), self.projection)
 
         if not user:
             raise Exception("User not found")
@@ -171,16 +282,8 @@ class UserService:
 
     def reset_password(self, user_id: str, organization_id: str) -> dict:
         password = self.password_generator.generate()
-        fields = {
-            "password": bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8"),
-            "updated_at": datetime.now()
-        }
-
-        result = self.mongo.update_one({
-            "_id": ObjectId(user_id),
-            "organization_id": organization_id
-        }, {
-            "$set": fields
+        result = self.mongo.update_one(self.member_query(user_id, organization_id), {
+            "$set": self.password_fields(self.password_hasher.hash(password))
         })
 
         if result.matched_count == 0:
@@ -197,10 +300,7 @@ class UserService:
             "admin": admin
         }
 
-        result = self.mongo.update_one({
-            "_id": ObjectId(user_id),
-            "organization_id": organization_id
-        }, {
+        result = self.mongo.update_one(self.member_query(user_id, organization_id), {
             "$set": fields
         })
 
@@ -211,19 +311,6 @@ class UserService:
             "id": user_id
         }
 
-    def username_exists(self, username: str, organization_id: str) -> bool:
-        return self.mongo.count_documents({
-            "username": username,
-            "organization_id": organization_id
-        }) > 0
-
     @staticmethod
     def to_dict(self):
-        return {
-            "id": str(self["_id"]),
-            "username": self["username"],
-            "organization_id": self["organization_id"],
-            "admin": self["admin"],
-            "created_at": self["created_at"],
-            "updated_at": self["updated_at"]
-        }
+        return document_to_dict(self, UserService.public_fields)
@@ -0,0 +1,150 @@
+import logging
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+INDEX_OPTIONS = ["unique", "sparse", "partialFilterExpression", "expireAfterSeconds"]
+# an index that differs only in collation is a separate index, so the stand-in never conflicts with the old or new
+# spec; the identical strength compares strings by code point after the collation levels, like the binary default
+TEMPORARY_COLLATION = {"locale": "en", "strength": 5}
+
+
+class IndexManager:
+    def __init__(self, services: list):
+        self.services = services
+
+    def plan(self) -> dict:
+        report = {}
+        for collection, indexes in self.targets():
+            existing = collection.index_information()
+            existing.pop("_id_", None)
+
+            declared = {}
+            for model in indexes:
+                declared[model.document["name"]] = model
+
+            missing = []
+            changed = []
+            for name, model in declared.items():
+                if name not in existing:
+                    missing.append(name)
+                elif not self.same_spec(model, existing[name]):
+                    changed.append(name)
+
+            extra = []
+            for name in existing:
+                if name not in declared:
+                    extra.append(name)
+
+            report[collection.name] = {
+                "missing": missing,
+                "changed": changed,
+                "extra": extra,
+            }
+
+        return report
+
+    def apply(self, dry_run: bool = False, prune: bool = False, rebuild: bool = False) -> dict:
+        report = self.plan()
+        if dry_run:
+            return report
+
+        for collection, indexes in self.targets():
+            collection_report = report[collection.name]
+            collection_report["failed"] = {}
+            declared = {model.document["name"]: model for model in indexes}
+
+            # missing indexes are only ever added, a failed build leaves the collection as it was
+            for name in collection_report["missing"]:
+                try:
+                    collection.create_indexes([declared[name]])
+                except OperationFailure as e:
+                    collection_report["failed"][name] = str(e)
+
+            if rebuild:
+                existing = collection.index_information()
+                for name in collection_report["changed"]:
+                    try:
+                        self.rebuild(collection, declared[name], existing[name])
+                    except OperationFailure as e:
+                        collection_report["failed"][name] = str(e)
+
+            if prune:
+                for name in collection_report["extra"]:
+                    collection.drop_index(name)
+
+        return report
+
+    def migrate(self) -> dict:
+        report = self.apply()
+        for collection_name, collection_report in report.items():
+            if collection_report["changed"]:
+                logger.warning("Indexes on %s differ from their declaration, run `indexes --rebuild` to rebuild: %s",
+                               collection_name, ", ".join(collection_report["changed"]))
+            if collection_report["extra"]:
+                logger.warning("Indexes on %s are not declared by any service, run `indexes --prune` to drop: %s",
+                               collection_name, ", ".join(collection_report["extra"]))
+            for name, message in collection_report["failed"].items():
+                logger.error("Failed to build index %s on %s: %s", name, collection_name, message)
+
+        return report
+
+    @classmethod
+    def rebuild(cls, collection, model: IndexModel, info: dict):
+        name = model.document["name"]
+        document = model.document
+
+        # a changed TTL is the one option Mongo can modify in place
+        if "expireAfterSeconds" in document and "expireAfterSeconds" in info and \
+                cls.same_spec(model, {**info, "expireAfterSeconds": document["expireAfterSeconds"]}):
+            collection.database.command("collMod", collection.name,
+                                        index={"name": name, "expireAfterSeconds": document["expireAfterSeconds"]})
+            return
+
+        # build the new spec under a temporary name and collation first, so a unique index over duplicates fails
+        # before the old index is gone, and keep it until the final index is built so queries always have one
+        temporary_name = f"{name}_rebuild"
+        if temporary_name in collection.index_information():
+            collection.drop_index(temporary_name)
+
+        temporary = IndexModel(list(document["key"].items()), name=temporary_name, collation=TEMPORARY_COLLATION,
+                               **{option: document[option] for option in INDEX_OPTIONS if option in document})
+        collection.create_indexes([temporary])
+        try:
+            collection.drop_index(name)
+            try:
+                collection.create_indexes([model])
+            except OperationFailure:
+                collection.create_indexes([cls.restore_model(name, info)])
+                raise
+        finally:
+            collection.drop_index(temporary_name)
+
+    def targets(self) -> list:
+        targets = []
+        for service in self.services:
+            # services that own several collections list each one with its indexes
+            if hasattr(service, "index_targets"):
+                targets.extend(service.index_targets())
+            else:
+                targets.append((service.mongo, service.indexes))
+        return targets
+
+    @staticmethod
+    def restore_model(name: str, info: dict) -> IndexModel:
+        return IndexModel(info["key"], name=name, **{option: info[option] for option in INDEX_OPTIONS
+                                                     if option in info})
+
+    @staticmethod
+    def same_spec(model: IndexModel, info: dict) -> bool:
+        document = model.document
+        if list(document["key"].items()) != [(field, direction) for field, direction in info["key"]]:
+            return False
+
+        for option in INDEX_OPTIONS:
+            if document.get(option) != info.get(option):
+                return False
+
+        return True
@@ -1,3 +1,16 @@
 from .data_center_service import DataCenterService
 from .region_service import RegionService
 from .machine_key_service import MachineKeyService
+from .heartbeat_history_service import HeartbeatHistoryService
+from .liveness_tracker import LivenessTracker, TimingWheel
+from .machine_service import MachineService
+from .infra_export_service import InfraExportService
+from .async_services import (
+    AsyncDataCenterService,
+    AsyncHeartbeatHistoryService,
+    AsyncInfraExportService,
+    AsyncLivenessTracker,
+    AsyncMachineKeyService,
+    AsyncMachineService,
+    AsyncRegionService,
+)
@@ -0,0 +1,502 @@
+import asyncio
+from datetime import datetime
+from typing import AsyncIterator
+
+from pymongo.errors import DuplicateKeyError
+
+from lib.bulk import claim_names, ids_query, match_targets, names_query, parse_items, targets_query, \
+    write_bulk_async
+from lib.cascade import NOT_DELETING, AsyncCascadeService, deleting_update
+from lib.pagination import paginate_async
+from lib.project.async_services import AsyncProjectAccessService
+from lib.projection import narrow_projection
+
+from .data_center_service import DataCenterService
+from .heartbeat_history_service import HeartbeatHistoryService
+from .infra_export_service import InfraExportService
+from .liveness_tracker import LivenessTracker
+from .machine_key_service import MachineKeyService
+from .machine_service import MachineService
+from .region_service import RegionService
+
+
+class AsyncRegionService(RegionService):
+    project_access_service: AsyncProjectAccessService
+    cascade_service: AsyncCascadeService
+
+    async def create(self, name: str, description: str, project_id: str, creator_id: str, organization_id: str):
+        if not await self.project_access_service.has_access(project_id, creator_id, "infra.region.admin"):
+            raise Exception("Not allowed")
+
+        try:
+            result = await self.mongo.insert_one(self.region_document(
+                name, description, project_id, creator_id, organization_id))
+        except DuplicateKeyError:
+            raise Exception(f"Region {name} already exists")
+
+        return {
+            "id": str(result.inserted_id)
+        }
+
+    async def fetch(self, project_id: str, requester_id: str, page: int = 0, size: int = 50,
+                    cursor: str = None, fields: list[str] = None) -> list[dict] | dict:
+        return await self.project_access_service.authorized(
+            self.project_access_service.has_any_access(project_id, requester_id),
+            paginate_async(self.mongo, self.project_query(project_id), self.to_dict, page, size, cursor,
+                           narrow_projection(self.projection, fields)),
+        )
+
+    async def get(self, region_id: str, project_id: str, requester_id: str) -> dict:
+        allowed, region = await self.project_access_service.load_with_access(
+            project_id, requester_id, None, self.mongo, self.region_query(region_id, project_id), self.projection)
+
+        if not allowed:
+            raise Exception("Project not found")
+
+        if not region:
+            raise Exception("Region not found")
+
+        return self.to_dict(region)
+
+    async def update(self, region_id: str, name: str, description: str, project_id: str, requester_id: str) -> dict:
+        if not await self.project_access_service.has_access(project_id, requester_id, "infra.region.admin"):
+            raise Exception("Not allowed")
+
+        try:
+            result = await self.mongo.update_one(self.region_query(region_id, project_id), {
+                "$set": self.update_fields(name, description)
+            })
+        except DuplicateKeyError:
+            raise Exception(f"Region {name} already exists")
+
+        if result.matched_count == 0:
+            raise Exception("Region not found")
+
+        return {
+            "id": region_id
+        }
+
+    async def delete(self, region_id: str, project_id: str, requester_id: str) -> dict:
+        if not await self.project_access_service.has_access(project_id, requester_id, "infra.region.admin"):
+            raise Exception("Not allowed")
+
+        if not self.cascade_service:
+            result = await self.mongo.delete_one(self.region_query(region_id, project_id))
+            if result.deleted_count == 0:
+                raise Exception("Region not found")
+
+            return {
+                "id": region_id
+            }
+
+        result = await self.mongo.update_one(self.region_query(region_id, project_id), deleting_update())
+
+        if result.matched_count == 0:
+            raise Exception("Region not found")
+
+        await self.cascade_service.enqueue("region", [region_id], {"project_id": project_id})
+
+        return {
+            "id": region_id
+        }
+
+    async def exists(self, region_id: str, project_id: str) -> bool:
+        return await self.mongo.count_documents(self.region_query(region_id, project_id), limit=1) > 0
+
+    async def existing(self, region_ids: list[str], project_id: str) -> set[str]:
+        regions = await self.mongo.find(self.existing_query(region_ids, project_id), {"_id": 1}).to_list(None)
+        return {str(region["_id"]) for region in regions}
+
+    async def bulk_create(self, items: list, project_id: str, creator_id: str, organization_id: str) -> dict:
+        results, parsed = parse_items(items, self.parse_create)
+        existing = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, creator_id, "infra.region.admin"),
+            self.mongo.find(names_query(project_id, parsed), {"name": 1}).to_list(None),
+            "Not allowed",
+        )
+        parsed = claim_names(results, parsed, existing, "Region {} already exists")
+        await write_bulk_async(self.mongo,
+                               self.insert_operations(results, parsed, project_id, creator_id, organization_id),
+                               results, lambda position: f"Region {parsed[position]['name']} already exists")
+
+        return {
+            "items": results
+        }
+
+    async def bulk_update(self, items: list, project_id: str, requester_id: str) -> dict:
+        results, parsed = parse_items(items, self.parse_update)
+        existing = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, requester_id, "infra.region.admin"),
+            self.mongo.find({**targets_query(project_id, parsed), **NOT_DELETING}, {"name": 1}).to_list(None),
+            "Not allowed",
+        )
+        parsed = match_targets(results, parsed, existing, "Region not found", "Region {} already exists")
+        await write_bulk_async(self.mongo, self.update_operations(parsed, project_id), results,
+                               lambda position: f"Region {parsed[position]['name']} already exists")
+
+        return {
+            "items": results
+        }
+
+    async def bulk_delete(self, region_ids: list, project_id: str, requester_id: str) -> dict:
+        results, parsed = parse_items(region_ids, self.parse_delete)
+        existing = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, requester_id, "infra.region.admin"),
+            self.mongo.find({**ids_query(project_id, parsed), **NOT_DELETING}, {"_id": 1}).to_list(None),
+            "Not allowed",
+        )
+        parsed = match_targets(results, parsed, existing, "Region not found")
+        if parsed and self.cascade_service:
+            await self.mongo.update_many({**ids_query(project_id, parsed), **NOT_DELETING}, deleting_update())
+            await self.cascade_service.enqueue("region", [str(fields["_id"]) for fields in parsed.values()],
+                                               {"project_id": project_id})
+        elif parsed:
+            await self.mongo.delete_many(ids_query(project_id, parsed))
+
+        return {
+            "items": results
+        }
+
+
+class AsyncDataCenterService(DataCenterService):
+    project_access_service: AsyncProjectAccessService
+    region_service: AsyncRegionService
+
+    async def create(self, name: str, description: str, region_id: str, project_id: str, creator_id: str,
+                     organization_id: str):
+        region_exists = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, creator_id, "infra.datacenter.admin"),
+            self.region_service.exists(region_id, project_id),
+            "Not allowed",
+        )
+
+        if not region_exists:
+            raise Exception("Region not found")
+
+        try:
+            result = await self.mongo.insert_one(self.data_center_document(
+                name, description, region_id, project_id, creator_id, organization_id))
+        except DuplicateKeyError:
+            raise Exception(f"Data center {name} already exists in this project")
+
+        return {
+            "id": str(result.inserted_id),
+        }
+
+    async def fetch(self, region_id: str, project_id: str, requester_id: str, page: int = 0, size: int = 50,
+                    cursor: str = None, fields: list[str] = None) -> list[dict] | dict:
+        return await self.project_access_service.authorized(
+            self.project_access_service.has_any_access(project_id, requester_id),
+            paginate_async(self.mongo, self.in_region_query(region_id, project_id), self.to_dict, page, size, cursor,
+                           narrow_projection(self.projection, fields)),
+        )
+
+    async def get(self, data_center_id: str, region_id: str, project_id: str, requester_id: str) -> dict:
+        allowed, data_center = await self.project_access_service.load_with_access(
+            project_id, requester_id, None, self.mongo, self.data_center_query(data_center_id, region_id, project_id),
+            self.projection)
+
+        if not allowed:
+            raise Exception("Project not found")
+
+        if not data_center:
+            raise Exception("Data center not found")
+
+        return self.to_dict(data_center)
+
+    async def update(self, data_center_id: str, name: str, description: str, region_id: str, project_id: str,
+                     requester_id: str):
+        if not await self.project_access_service.has_access(project_id, requester_id, "infra.datacenter.admin"):
+            raise Exception("Project not found")
+
+        try:
+            result = await self.mongo.update_one(self.data_center_query(data_center_id, region_id, project_id), {
+                "$set": RegionService.update_fields(name, description)
+            })
+        except DuplicateKeyError:
+            raise Exception(f"Data center {name} already exists in this project")
+
+        if result.matched_count == 0:
+            raise Exception("Data center not found")
+
+        return {
+            "id": data_center_id,
+        }
+
+    async def delete(self, data_center_id: str, region_id: str, project_id: str, requester_id: str) -> dict:
+        if not await self.project_access_service.has_access(project_id, requester_id, "infra.datacenter.admin"):
+            raise Exception("Project not found")
+
+        result = await self.mongo.delete_one(self.data_center_query(data_center_id, region_id, project_id))
+
+        if result.deleted_count == 0:
+            raise Exception("Data center not found")
+
+        return {
+            "id": data_center_id,
+        }
+
+
+    async def bulk_create(self, items: list, project_id: str, creator_id: str, organization_id: str) -> dict:
+        results, parsed = parse_items(items, self.parse_create)
+        regions = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, creator_id, "infra.datacenter.admin"),
+            self.region_service.existing([fields["region_id"] for fields in parsed.values()], project_id),
+            "Not allowed",
+        )
+        parsed = self.in_regions(results, parsed, regions)
+        existing = await self.mongo.find(names_query(project_id, parsed), {"name": 1}).to_list(None)
+        parsed = claim_names(results, parsed, existing, "Data center {} already exists in this project")
+        await write_bulk_async(
+            self.mongo, self.insert_operations(results, parsed, project_id, creator_id, organization_id), results,
+            lambda position: f"Data center {parsed[position]['name']} already exists in this project")
+
+        return {
+            "items": results
+        }
+
+    async def bulk_update(self, items: list, project_id: str, requester_id: str) -> dict:
+        results, parsed = parse_items(items, self.parse_update)
+        existing = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, requester_id, "infra.datacenter.admin"),
+            self.mongo.find(targets_query(project_id, parsed), {"name": 1}).to_list(None),
+        )
+        parsed = match_targets(results, parsed, existing, "Data center not found",
+                               "Data center {} already exists in this project")
+        await write_bulk_async(
+            self.mongo, self.update_operations(parsed, project_id), results,
+            lambda position: f"Data center {parsed[position]['name']} already exists in this project")
+
+        return {
+            "items": results
+        }
+
+    async def bulk_delete(self, data_center_ids: list, project_id: str, requester_id: str) -> dict:
+        results, parsed = parse_items(data_center_ids, self.parse_delete)
+        existing = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, requester_id, "infra.datacenter.admin"),
+            self.mongo.find(ids_query(project_id, parsed), {"_id": 1}).to_list(None),
+        )
+        parsed = match_targets(results, parsed, existing, "Data center not found")
+        if parsed:
+            await self.mongo.delete_many(ids_query(project_id, parsed))
+
+        return {
+            "items": results
+        }
+
+
+class AsyncMachineKeyService(MachineKeyService):
+    project_access_service: AsyncProjectAccessService
+
+    async def create(self, project_id: str, name: str, creator_id: str, organization_id: str):
+        if not await self.project_access_service.has_access(project_id, creator_id, "infra.machine-key.admin"):
+            raise Exception("Not allowed")
+
+        key = self.key_generator.generate()
+
+        try:
+            result = await self.mongo.insert_one(self.machine_key_document(
+                name, key, project_id, creator_id, organization_id))
+        except DuplicateKeyError:
+            raise Exception(f"Machine key {name} already exists")
+
+        return {
+            "id": str(result.inserted_id)
+        }
+
+    async def fetch(self, project_id: str, requester_id: str, page: int = 0, size: int = 50,
+                    cursor: str = None, fields: list[str] = None) -> list[dict] | dict:
+        return await self.project_access_service.authorized(
+            self.project_access_service.has_any_access(project_id, requester_id),
+            paginate_async(self.mongo, {"project_id": project_id}, self.to_dict, page, size, cursor,
+                           narrow_projection(self.projection, fields)),
+        )
+
+    async def get(self, machine_key_id: str, project_id: str, requester_id: str) -> dict:
+        allowed, machine_key = await self.project_access_service.load_with_access(
+            project_id, requester_id, None, self.mongo, self.machine_key_query(machine_key_id, project_id),
+            self.projection)
+
+        if not allowed:
+            raise Exception("Project not found")
+
+        if not machine_key:
+            raise Exception("Machine key not found")
+
+        return self.to_dict(machine_key)
+
+    async def update(self, machine_key_id: str, name: str, project_id: str, requester_id: str) -> dict:
+        if not await self.project_access_service.has_access(project_id, requester_id, "infra.machine-key.admin"):
+            raise Exception("Not allowed")
+
+        try:
+            machine_key = await self.mongo.find_one_and_update(self.machine_key_query(machine_key_id, project_id), {
+                "$set": self.update_fields(name),
+            }, {"key_hash": 1})
+        except DuplicateKeyError:
+            raise Exception(f"Machine key {name} already exists")
+
+        if not machine_key:
+            raise Exception("Machine key not found")
+
+        self.invalidate(machine_key)
+
+        return {
+            "id": machine_key_id
+        }
+
+    async def delete(self, machine_key_id: str, project_id: str, requester_id: str) -> dict:
+        if not await self.project_access_service.has_access(project_id, requester_id, "infra.machine-key.admin"):
+            raise Exception("Project not found")
+
+        machine_key = await self.mongo.find_one_and_delete(self.machine_key_query(machine_key_id, project_id),
+                                                         {"key_hash": 1})
+
+        if not machine_key:
+            raise Exception("Machine key not found")
+
+        self.invalidate(machine_key)
+
+        return {
+            "id": machine_key_id
+        }
+
+    async def bulk_create(self, items: list, project_id: str, creator_id: str, organization_id: str) -> dict:
+        results, parsed = parse_items(items, self.parse_create)
+        existing = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, creator_id, "infra.machine-key.admin"),
+            self.mongo.find(names_query(project_id, parsed), {"name": 1}).to_list(None),
+            "Not allowed",
+        )
+        parsed = claim_names(results, parsed, existing, "Machine key {} already exists")
+        await write_bulk_async(self.mongo,
+                               self.insert_operations(results, parsed, project_id, creator_id, organization_id),
+                               results, lambda position: f"Machine key {parsed[position]['name']} already exists")
+
+        return {
+            "items": results
+        }
+
+    async def bulk_update(self, items: list, project_id: str, requester_id: str) -> dict:
+        results, parsed = parse_items(items, self.parse_update)
+        existing = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, requester_id, "infra.machine-key.admin"),
+            self.mongo.find(targets_query(project_id, parsed), {"name": 1, "key_hash": 1}).to_list(None),
+            "Not allowed",
+        )
+        parsed = match_targets(results, parsed, existing, "Machine key not found", "Machine key {} already exists")
+        await write_bulk_async(self.mongo, self.update_operations(parsed, project_id), results,
+                               lambda position: f"Machine key {parsed[position]['name']} already exists")
+        for machine_key in parsed.values():
+            self.invalidate(machine_key)
+
+        return {
+            "items": results
+        }
+
+    async def bulk_delete(self, machine_key_ids: list, project_id: str, requester_id: str) -> dict:
+        results, parsed = parse_items(machine_key_ids, self.parse_delete)
+        existing = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, requester_id, "infra.machine-key.admin"),
+            self.mongo.find(ids_query(project_id, parsed), {"key_hash": 1}).to_list(None),
+        )
+        parsed = match_targets(results, parsed, existing, "Machine key not found")
+        if parsed:
+            await self.mongo.delete_many(ids_query(project_id, parsed))
+        for machine_key in parsed.values():
+            self.invalidate(machine_key)
+
+        return {
+            "items": results
+        }
+
+    async def get_key(self, machine_key_id: str, project_id: str, requester_id: str) -> dict:
+        allowed, machine_key = await self.project_access_service.load_with_access(
+            project_id, requester_id, "infra.machine-key.admin", self.mongo,
+            self.machine_key_query(machine_key_id, project_id), {"key": 1})
+
+        if not allowed:
+            raise Exception("Project not found")
+
+        if not machine_key:
+            raise Exception("Machine key not found")
+
+        return {
+            "id": str(machine_key["_id"]),
+            "key": machine_key["key"]
+        }
+
+    async def authenticate(self, key: str) -> dict:
+        key_hash = self.hash_key(key)
+        identity = self.key_cache.get(key_hash)
+
+        if identity is None:
+            generation = self.key_cache.generation
+            machine_key = await self.mongo.find_one(self.authenticate_query(key_hash),
+                                                   {"project_id": 1, "organization_id": 1})
+            identity = self.cache_identity(key_hash, machine_key, generation)
+
+        if not identity:
+            raise Exception("Invalid machine key")
+
+        return identity
+
+    async def revoke_project(self, project_id: str):
+        await self.mongo.update_many({"project_id": project_id}, deleting_update())
+        self.invalidate_many(await self.mongo.find({"project_id": project_id}, {"key_hash": 1}).to_list(None))
+
+
+class AsyncMachineService(MachineService):
+    machine_key_service: AsyncMachineKeyService
+
+    async def process_heartbeat(self, key: str, name: str, data: dict) -> dict:
+        return self.enqueue(await self.machine_key_service.authenticate(key), name, data)
+
+
+class AsyncHeartbeatHistoryService(HeartbeatHistoryService):
+    project_access_service: AsyncProjectAccessService
+
+    async def history(self, project_id: str, name: str, requester_id: str, start: datetime = None,
+                      end: datetime = None) -> dict:
+        start, end = self.history_range(start, end)
+        resolution = self.resolution(start, end)
+        documents = await self.project_access_service.authorized(
+            self.project_access_service.has_any_access(project_id, requester_id),
+            self.history_cursor(project_id, name, start, end, resolution).to_list(None),
+        )
+
+        return self.history_result(name, start, end, resolution, documents)
+
+
+class AsyncInfraExportService(InfraExportService):
+    project_access_service: AsyncProjectAccessService
+
+    async def export(self, project_id: str, requester_id: str) -> AsyncIterator[dict]:
+        if not await self.project_access_service.has_any_access(project_id, requester_id):
+            raise Exception("Project not found")
+
+        return self.stream(project_id)
+
+    async def stream(self, project_id: str) -> AsyncIterator[dict]:
+        for kind, service, extra_fields in self.sources():
+            documents = service.mongo.find({
+                "project_id": project_id,
+                **NOT_DELETING,
+            }, self.export_projection(service, extra_fields), batch_size=self.batch_size).sort("_id", 1)
+
+            async for document in documents:
+                yield self.to_line(kind, service, extra_fields, document)
+
+
+class AsyncLivenessTracker(LivenessTracker):
+    project_access_service: AsyncProjectAccessService
+
+    async def status(self, project_id: str, requester_id: str) -> dict:
+        if not await self.project_access_service.has_any_access(project_id, requester_id):
+            raise Exception("Project not found")
+
+        if not self.tracking:
+            return await asyncio.to_thread(self.published_counts, project_id)
+
+        return self.counts_for(project_id)
@@ -1,12 +1,36 @@
 from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, InsertOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from pymongo.collection import Collection
 from datetime import datetime
 
 from .region_service import RegionService
+from lib.bulk import claim_names, failure, ids_query, item_id, item_param, match_targets, names_query, parse_items, \
+    success, targets_query, write_bulk
 from lib.project import ProjectAccessService
+from lib.pagination import paginate
+from lib.projection import document_to_dict, narrow_projection
 
 
 class DataCenterService:
+    public_fields = [
+        "name",
+        "description",
+        "project_id",
+        "creator_id",
+        "organization_id",
+        "created_at",
+        "updated_at",
+    ]
+    projection = dict.fromkeys(public_fields, 1)
+
+    indexes = [
+        IndexModel([("project_id", ASCENDING), ("name", ASCENDING)], name="project_id_name", unique=True),
+        IndexModel([("project_id", ASCENDING), ("region_id", ASCENDING), ("_id", ASCENDING)],
+                   name="project_id_region_id__id"),
+        IndexModel([("project_id", ASCENDING), ("_id", ASCENDING)], name="project_id__id"),
+    ]
+
     def __init__(self, mongo: Collection, region_service: RegionService, project_access_service: ProjectAccessService):
         self.mongo = mongo
         self.region_service = region_service
@@ -17,52 +41,34 @@ class DataCenterService:
         if not self.project_access_service.has_access(project_id, creator_id, "infra.datacenter.admin"):
             raise Exception("Not allowed")
 
-        if self.name_exists(name, project_id):
-            raise Exception(f"Data center {name} already exists in this project")
-
         if not self.region_service.exists(region_id, project_id):
             raise Exception("Region not found")
 
-        data_center_id = self.mongo.insert_one({
-            "name": name,
-            "description": description,
-            "region_id": region_id,
-            "project_id": project_id,
-            "creator_id": creator_id,
-            "organization_id": organization_id,
-            "created_at": datetime.now(),
-            "updated_at": datetime.now()
-        }).inserted_id
+        try:
+            data_center_id = self.mongo.insert_one(self.data_center_document(
+                name, description, region_id, project_id, creator_id, organization_id)).inserted_id
+        except DuplicateKeyError:
+            raise Exception(f"Data center {name} already exists in this project")
 
         return {
             "id": str(data_center_id),
         }
 
-    def fetch(self, region_id: str, project_id: str, requester_id: str, page: int = 0, size: int = 50) -> list[dict]:
-        if self.project_access_service.has_any_access(project_id, requester_id):
+    def fetch(self, region_id: str, project_id: str, requester_id: str, page: int = 0, size: int = 50,
+              cursor: str = None, fields: list[str] = None) -> list[dict] | dict:
+        if not self.project_access_service.has_any_access(project_id, requester_id):
             raise Exception("Project not found")
 
-        data_centers = self.mongo.find({
-            "region_id": region_id,
-            "project_id": project_id
-        }).skip(page * size).limit(size)
-
-        result = []
-
-        for data_center in data_centers:
-            result.append(self.to_dict(data_center))
-
-        return result
+        return paginate(self.mongo, self.in_region_query(region_id, project_id), self.to_dict, page, size, cursor,
+                        narrow_projection(self.projection, fields))
 
     def get(self, data_center_id: str, region_id: str, project_id: str, requester_id: str) -> dict:
-        if not self.project_access_service.has_any_access(project_id, requester_id):
-            raise Exception("Project not found")
+        allowed, data_center = self.project_access_service.load_with_access(
+            project_id, requester_id, None, self.mongo, self.data_center_query(data_center_id, region_id, project_id),
+            self.projection)
 
-        data_center = self.mongo.find_one({
-            "_id": ObjectId(data_center_id),
-            "region_id": region_id,
-            "project_id": project_id
-        })
+        if not allowed:
+            raise Exception("Project not found")
 
         if not data_center:
             raise Exception("Data center not found")
@@ -74,28 +80,12 @@ class DataCenterService:
         if not self.project_access_service.has_access(project_id, requester_id, "infra.datacenter.admin"):
             raise Exception("Project not found")
 
-        fields = {
-            "updated_at": datetime.now(),
-            "description": description,
-        }
-
-        if name:
-            if self.mongo.count_documents({
-                "_id": {"$ne": ObjectId(data_center_id)},
-                "name": name,
-                "project_id": project_id
-            }):
-                raise Exception(f"Data center {name} already exists in this project")
-
-            fields["name"] = name
-
-        result = self.mongo.update_one({
-            "_id": ObjectId(data_center_id),
-            "region_id": region_id,
-            "project_id": project_id,
-        }, {
-            "$set": fields
-        })
+        try:
+            result = self.mongo.update_one(self.data_center_query(data_center_id, region_id, project_id), {
+                "$set": RegionService.update_fields(name, description)
+            })
+        except DuplicateKeyError:
+            raise Exception(f"Data center {name} already exists in this project")
 
         if result.matched_count == 0:
             raise Exception("Data center not found")
@@ -108,11 +98,7 @@ class DataCenterService:
         if not self.project_access_service.has_access(project_id, requester_id, "infra.datacenter.admin"):
             raise Exception("Project not found")
 
-        result = self.mongo.delete_one({
-            "_id": ObjectId(data_center_id),
-            "region_id": region_id,
-            "project_id": project_id
-        })
+        result = self.mongo.delete_one(self.data_center_query(data_center_id, region_id, project_id))
 
         if result.deleted_count == 0:
             raise Exception("Data center not found")
@@ -121,21 +107,142 @@ class DataCenterService:
             "id": data_center_id,
         }
 
-    def name_exists(self, name: str, project_id: str) -> bool:
-        return self.mongo.count_documents({
+    def bulk_create(self, items: list, project_id: str, creator_id: str, organization_id: str) -> dict:
+        if not self.project_access_service.has_access(project_id, creator_id, "infra.datacenter.admin"):
+            raise Exception("Not allowed")
+
+        results, parsed = parse_items(items, self.parse_create)
+        regions = self.region_service.existing([fields["region_id"] for fields in parsed.values()], project_id)
+        parsed = self.in_regions(results, parsed, regions)
+        parsed = claim_names(results, parsed, self.mongo.find(names_query(project_id, parsed), {"name": 1}),
+                             "Data center {} already exists in this project")
+        write_bulk(self.mongo, self.insert_operations(results, parsed, project_id, creator_id, organization_id),
+                   results, lambda position: f"Data center {parsed[position]['name']} already exists in this project")
+
+        return {
+            "items": results
+        }
+
+    def bulk_update(self, items: list, project_id: str, requester_id: str) -> dict:
+        if not self.project_access_service.has_access(project_id, requester_id, "infra.datacenter.admin"):
+            raise Exception("Project not found")
+
+        results, parsed = parse_items(items, self.parse_update)
+        parsed = match_targets(results, parsed, self.mongo.find(targets_query(project_id, parsed), {"name": 1}),
+                               "Data center not found", "Data center {} already exists in this project")
+        write_bulk(self.mongo, self.update_operations(parsed, project_id), results,
+                   lambda position: f"Data center {parsed[position]['name']} already exists in this project")
+
+        return {
+            "items": results
+        }
+
+    def bulk_delete(self, data_center_ids: list, project_id: str, requester_id: str) -> dict:
+        if not self.project_access_service.has_access(project_id, requester_id, "infra.datacenter.admin"):
+            raise Exception("Project not found")
+
+        results, parsed = parse_items(data_center_ids, self.parse_delete)
+        parsed = match_targets(results, parsed, self.mongo.find(ids_query(project_id, parsed), {"_id": 1}),
+                               "Data center not found")
+        if parsed:
+            self.mongo.delete_many(ids_query(project_id, parsed))
+
+        return {
+            "items": results
+        }
+
+    @staticmethod
+    def parse_create(item) -> dict:
+        return {
+            "name": item_param(item, "name"),
+            "description": item_param(item, "description", required=False),
+            "region_id": item_param(item, "region_id"),
+        }
+
+    @staticmethod
+    def parse_update(item) -> dict:
+        return {
+            "_id": item_id(item_param(item, "id"), "Data center not found"),
+            "name": item_param(item, "name", required=False),
+            "description": item_param(item, "description", required=False),
+        }
+
+    @staticmethod
+    def parse_delete(data_center_id) -> dict:
+        return {
+            "_id": item_id(data_center_id, "Data center not found"),
+        }
+
+    @staticmethod
+    def in_regions(results: list, parsed: dict[int, dict], regions: set[str]) -> dict[int, dict]:
+        found = {}
+        for position, fields in parsed.items():
+            if fields["region_id"] in regions:
+                found[position] = fields
+            else:
+                results[position] = failure("Region not found")
+
+        return found
+
+    @classmethod
+    def insert_operations(cls, results: list, parsed: dict[int, dict], project_id: str, creator_id: str,
+                          organization_id: str) -> dict:
+        operations = {}
+        for position, fields in parsed.items():
+            data_center_id = ObjectId()
+            operations[position] = InsertOne(cls.data_center_document(
+                fields["name"], fields["description"], fields["region_id"], project_id, creator_id, organization_id,
+                data_center_id))
+            results[position] = success(data_center_id)
+
+        return operations
+
+    @staticmethod
+    def update_operations(parsed: dict[int, dict], project_id: str) -> dict:
+        operations = {}
+        for position, data_center in parsed.items():
+            operations[position] = UpdateOne({
+                "_id": data_center["_id"],
+                "project_id": project_id,
+            }, {
+                "$set": RegionService.update_fields(data_center["name"], data_center["description"])
+            })
+
+        return operations
+
+    @staticmethod
+    def data_center_document(name: str, description: str, region_id: str, project_id: str, creator_id: str,
+                             organization_id: str, data_center_id: ObjectId = None) -> dict:
+        document = {
             "name": name,
+            "description": description,
+            "region_id": region_id,
+            "project_id": project_id,
+            "creator_id": creator_id,
+            "organization_id": organization_id,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now()
+        }
+        if data_center_id:
+            document["_id"] = data_center_id
+
+        return document
+
+    @staticmethod
+    def data_center_query(data_center_id: str, region_id: str, project_id: str) -> dict:
+        return {
+            "_id": ObjectId(data_center_id),
+            "region_id": region_id,
             "project_id": project_id
-        }) > 0
+        }
 
     @staticmethod
-    def to_dict(self):
+    def in_region_query(region_id: str, project_id: str) -> dict:
         return {
-            "id": str(self["_id"]),
-            "name": self["name"],
-            "description": self["description"],
-            "project_id": self["project_id"],
-            "creator_id": self["creator_id"],
-            "organization_id": self["organization_id"],
-            "created_at": self["created_at"],
-            "updated_at": self["updated_at"]
+            "region_id": region_id,
+            "project_id": project_id
         }
+
+    @staticmethod
+    def to_dict(self):
+        return document_to_dict(self, DataCenterService.public_fields)
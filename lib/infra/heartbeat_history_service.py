@@ -0,0 +1,331 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.database import Database
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+from lib.project import ProjectAccessService
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+MINUTE = 60
+HOUR = 60 * 60
+
+
+class HeartbeatHistoryService:
+    def __init__(self, db: Database, project_access_service: ProjectAccessService, raw_ttl: int = 2 * 24 * HOUR,
+                 minute_ttl: int = 30 * 24 * HOUR, rollup_interval: float = 60, max_points: int = 500,
+                 raw_max_range: int = HOUR):
+        self.db = db
+        self.mongo = db.heartbeats
+        self.minutes = db.heartbeats_1m
+        self.hours = db.heartbeats_1h
+        self.rollups = db.heartbeat_rollups
+        self.project_access_service = project_access_service
+        self.raw_ttl = raw_ttl
+        self.minute_ttl = minute_ttl
+        self.rollup_interval = rollup_interval
+        self.max_points = max_points
+        self.raw_max_range = raw_max_range
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def ensure_collection(self):
+        try:
+            self.db.create_collection(self.mongo.name, timeseries={
+                "timeField": "timestamp",
+                "metaField": "meta",
+                "granularity": "seconds",
+            }, expireAfterSeconds=self.raw_ttl)
+        except CollectionInvalid:
+            pass
+        except OperationFailure:
+            # servers before 5.0 have no time-series collections, the TTL index expires raw samples instead
+            logger.warning("Time-series collections are not supported, storing heartbeats in a plain collection")
+            self.db.create_collection(self.mongo.name)
+
+    def is_time_series(self) -> bool:
+        for collection in self.db.list_collections(filter={"name": self.mongo.name}):
+            return collection.get("type") == "timeseries"
+        return False
+
+    def index_targets(self) -> list:
+        raw_indexes = [
+            IndexModel([("meta.project_id", ASCENDING), ("meta.name", ASCENDING), ("timestamp", ASCENDING)],
+                       name="meta.project_id_meta.name_timestamp"),
+        ]
+        if not self.is_time_series():
+            raw_indexes.append(IndexModel([("timestamp", ASCENDING)], name="timestamp",
+                                          expireAfterSeconds=self.raw_ttl))
+
+        rollup_index = IndexModel([("project_id", ASCENDING), ("name", ASCENDING), ("bucket", ASCENDING)],
+                                  name="project_id_name_bucket")
+        return [
+            (self.mongo, raw_indexes),
+            (self.minutes, [
+                rollup_index,
+                IndexModel([("bucket", ASCENDING)], name="bucket", expireAfterSeconds=self.minute_ttl),
+            ]),
+            (self.hours, [rollup_index]),
+        ]
+
+    def record(self, heartbeats: list[dict]):
+        samples = []
+        for heartbeat in heartbeats:
+            samples.append({
+                "timestamp": heartbeat["received_at"],
+                "meta": {
+                    "project_id": heartbeat["project_id"],
+                    "name": heartbeat["name"],
+                },
+                "metrics": self.numeric_metrics(heartbeat["data"]),
+            })
+
+        if samples:
+            self.mongo.insert_many(samples, ordered=False)
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="heartbeat-rollup", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.rollup_interval):
+            try:
+                self.rollup(datetime.now())
+            except Exception:
+                logger.exception("Failed to roll up heartbeats")
+
+    def rollup(self, now: datetime):
+        self.rollup_tier("1m", self.mongo, self.raw_stage(), "timestamp", MINUTE, self.minutes, now,
+                         5 * MINUTE, self.raw_ttl, HOUR)
+        self.rollup_tier("1h", self.minutes, self.rollup_stage(), "bucket", HOUR, self.hours, now,
+                         HOUR, self.minute_ttl, 24 * HOUR)
+
+    def rollup_tier(self, tier: str, source, source_stage: dict, time_field: str, width: int, target, now: datetime,
+                    lateness: int, retention: int, window: int):
+        # each tier resumes from its persisted watermark, so buckets missed while no leader ran are still built;
+        # buckets are recomputed whole and replaced, so late heartbeats and repeated runs are harmless
+        state = self.rollups.find_one({"_id": tier})
+        since = min(state["watermark"], now) if state else now
+        start = self.truncate(max(since - timedelta(seconds=lateness), now - timedelta(seconds=retention)), width)
+
+        while not self.stopped.is_set():
+            # a long catch-up runs in bounded windows, the last one is left open for samples still arriving
+            end = start + timedelta(seconds=window)
+            if end >= now:
+                end = None
+
+            source.aggregate(self.rollup_pipeline(source_stage, time_field, start, end, width, target.name))
+            self.rollups.update_one({"_id": tier}, {"$set": {"watermark": end or now}}, upsert=True)
+            if end is None:
+                return
+            start = end
+
+    def history(self, project_id: str, name: str, requester_id: str, start: datetime = None,
+                end: datetime = None) -> dict:
+        if not self.project_access_service.has_any_access(project_id, requester_id):
+            raise Exception("Project not found")
+
+        start, end = self.history_range(start, end)
+        resolution = self.resolution(start, end)
+        documents = self.history_cursor(project_id, name, start, end, resolution)
+        return self.history_result(name, start, end, resolution, list(documents))
+
+    @staticmethod
+    def history_range(start: datetime = None, end: datetime = None) -> tuple[datetime, datetime]:
+        end = end or datetime.now()
+        start = start or end - timedelta(hours=1)
+        if start >= end:
+            raise Exception("from must be before to")
+
+        return start, end
+
+    def history_cursor(self, project_id: str, name: str, start: datetime, end: datetime, resolution: str):
+        if resolution == "raw":
+            return self.mongo.find({
+                "meta.project_id": project_id,
+                "meta.name": name,
+                "timestamp": {"$gte": start, "$lt": end},
+            }, {"_id": 0, "timestamp": 1, "metrics": 1}).sort([
+                # samples flushed in one batch can share a timestamp, _id keeps them in arrival order
+                ("timestamp", DESCENDING),
+                ("_id", DESCENDING),
+            ]).limit(self.max_points)
+
+        collection = self.minutes if resolution == "1m" else self.hours
+        return collection.find({
+            "project_id": project_id,
+            "name": name,
+            "bucket": {"$gte": self.truncate(start, MINUTE if resolution == "1m" else HOUR), "$lt": end},
+        }, {"_id": 0, "bucket": 1, "count": 1, "metrics": 1}).sort("bucket", ASCENDING)
+
+    def history_result(self, name: str, start: datetime, end: datetime, resolution: str,
+                       documents: list[dict]) -> dict:
+        to_point = self.raw_point if resolution == "raw" else self.rollup_point
+        # raw samples are read newest first so the limit drops the oldest ones, points go out in time order
+        if resolution == "raw":
+            documents = documents[::-1]
+        return {
+            "name": name,
+            "resolution": resolution,
+            "from": start,
+            "to": end,
+            "points": [to_point(document) for document in documents],
+        }
+
+    def resolution(self, start: datetime, end: datetime) -> str:
+        age = (datetime.now() - start).total_seconds()
+        span = (end - start).total_seconds()
+
+        if span <= self.raw_max_range and age <= self.raw_ttl:
+            return "raw"
+        if span / MINUTE <= self.max_points and age <= self.minute_ttl:
+            return "1m"
+        return "1h"
+
+    @staticmethod
+    def raw_stage() -> dict:
+        return {"$project": {
+            "project_id": "$meta.project_id",
+            "name": "$meta.name",
+            "time": "$timestamp",
+            "count": {"$literal": 1},
+            "first_seen": "$timestamp",
+            "last_seen": "$timestamp",
+            "metrics": {"$map": {
+                "input": {"$objectToArray": {"$ifNull": ["$metrics", {}]}},
+                "in": {"k": "$$this.k", "v": {
+                    "sum": "$$this.v",
+                    "min": "$$this.v",
+                    "max": "$$this.v",
+                    "count": {"$literal": 1},
+                }},
+            }},
+        }}
+
+    @staticmethod
+    def rollup_stage() -> dict:
+        return {"$project": {
+            "project_id": 1,
+            "name": 1,
+            "time": "$bucket",
+            "count": 1,
+            "first_seen": 1,
+            "last_seen": 1,
+            "metrics": {"$objectToArray": {"$ifNull": ["$metrics", {}]}},
+        }}
+
+    @staticmethod
+    def rollup_pipeline(source_stage: dict, time_field: str, start: datetime, end: Optional[datetime], width: int,
+                        target: str) -> list:
+        machine = {"project_id": "$project_id", "name": "$name", "bucket": "$bucket"}
+        time_range = {"$gte": start, "$lt": end} if end else {"$gte": start}
+        return [
+            {"$match": {time_field: time_range}},
+            source_stage,
+            {"$addFields": {"bucket": {"$toDate": {"$subtract": [
+                {"$toLong": "$time"},
+                {"$mod": [{"$toLong": "$time"}, width * 1000]},
+            ]}}}},
+            {"$group": {
+                "_id": machine,
+                "count": {"$sum": "$count"},
+                "first_seen": {"$min": "$first_seen"},
+                "last_seen": {"$max": "$last_seen"},
+                "metrics": {"$push": "$metrics"},
+            }},
+            {"$unwind": {"path": "$metrics", "preserveNullAndEmptyArrays": True}},
+            {"$unwind": {"path": "$metrics", "preserveNullAndEmptyArrays": True}},
+            {"$group": {
+                "_id": {**{key: f"$_id.{key}" for key in machine}, "metric": "$metrics.k"},
+                "count": {"$first": "$count"},
+                "first_seen": {"$first": "$first_seen"},
+                "last_seen": {"$first": "$last_seen"},
+                "sum": {"$sum": "$metrics.v.sum"},
+                "min": {"$min": "$metrics.v.min"},
+                "max": {"$max": "$metrics.v.max"},
+                "samples": {"$sum": "$metrics.v.count"},
+            }},
+            {"$group": {
+                "_id": {key: f"$_id.{key}" for key in machine},
+                "count": {"$first": "$count"},
+                "first_seen": {"$first": "$first_seen"},
+                "last_seen": {"$first": "$last_seen"},
+                "metrics": {"$push": {"k": "$_id.metric", "v": {
+                    "sum": "$sum",
+                    "min": "$min",
+                    "max": "$max",
+                    "count": "$samples",
+                }}},
+            }},
+            {"$project": {
+                "_id": 1,
+                "project_id": "$_id.project_id",
+                "name": "$_id.name",
+                "bucket": "$_id.bucket",
+                "count": 1,
+                "first_seen": 1,
+                "last_seen": 1,
+                "metrics": {"$arrayToObject": {"$filter": {
+                    "input": "$metrics",
+                    "cond": {"$ne": [{"$ifNull": ["$$this.k", None]}, None]},
+                }}},
+            }},
+            {"$merge": {"into": target, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+        ]
+
+    @staticmethod
+    def raw_point(sample: dict) -> dict:
+        metrics = {}
+        for key, value in sample.get("metrics", {}).items():
+            metrics[key] = {"avg": value, "min": value, "max": value}
+
+        return {
+            "time": sample["timestamp"],
+            "count": 1,
+            "metrics": metrics,
+        }
+
+    @staticmethod
+    def rollup_point(bucket: dict) -> dict:
+        metrics = {}
+        for key, value in bucket.get("metrics", {}).items():
+            metrics[key] = {
+                "avg": value["sum"] / value["count"] if value["count"] else None,
+                "min": value["min"],
+                "max": value["max"],
+            }
+
+        return {
+            "time": bucket["bucket"],
+            "count": bucket["count"],
+            "metrics": metrics,
+        }
+
+    @staticmethod
+    def numeric_metrics(data: dict) -> dict:
+        metrics = {}
+        for key, value in data.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metrics[key] = value
+        return metrics
+
+    @staticmethod
+    def truncate(moment: datetime, width: int) -> datetime:
+        return moment - timedelta(seconds=(moment - EPOCH).total_seconds() % width)
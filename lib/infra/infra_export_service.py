@@ -0,0 +1,55 @@
+from typing import Iterator
+
+from lib.cascade import NOT_DELETING
+from lib.project import ProjectAccessService
+from .data_center_service import DataCenterService
+from .machine_key_service import MachineKeyService
+from .region_service import RegionService
+
+
+class InfraExportService:
+    def __init__(self, region_service: RegionService, data_center_service: DataCenterService,
+                 machine_key_service: MachineKeyService, project_access_service: ProjectAccessService,
+                 batch_size: int = 1000):
+        self.region_service = region_service
+        self.data_center_service = data_center_service
+        self.machine_key_service = machine_key_service
+        self.project_access_service = project_access_service
+        self.batch_size = batch_size
+
+    def export(self, project_id: str, requester_id: str) -> Iterator[dict]:
+        # checked before streaming starts so a denied request still gets a normal error response
+        if not self.project_access_service.has_any_access(project_id, requester_id):
+            raise Exception("Project not found")
+
+        return self.stream(project_id)
+
+    def stream(self, project_id: str) -> Iterator[dict]:
+        for kind, service, extra_fields in self.sources():
+            documents = service.mongo.find({
+                "project_id": project_id,
+                **NOT_DELETING,
+            }, self.export_projection(service, extra_fields), batch_size=self.batch_size).sort("_id", 1)
+
+            for document in documents:
+                yield self.to_line(kind, service, extra_fields, document)
+
+    def sources(self) -> list[tuple[str, object, list[str]]]:
+        # data centers keep their region relation in the export only, API responses do not carry it
+        return [
+            ("region", self.region_service, []),
+            ("data_center", self.data_center_service, ["region_id"]),
+            ("machine_key", self.machine_key_service, []),
+        ]
+
+    @staticmethod
+    def export_projection(service, extra_fields: list[str]) -> dict:
+        return {**service.projection, **dict.fromkeys(extra_fields, 1)}
+
+    @staticmethod
+    def to_line(kind: str, service, extra_fields: list[str], document: dict) -> dict:
+        return {
+            "type": kind,
+            **service.to_dict(document),
+            **{field: document[field] for field in extra_fields if field in document},
+        }
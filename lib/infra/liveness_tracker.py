@@ -0,0 +1,371 @@
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Hashable
+
+from pymongo import CursorType, DeleteOne, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+from lib.project import ProjectAccessService
+
+logger = logging.getLogger(__name__)
+
+CAPPED_POSITION_LOST = 136
+
+
+class TimingWheel:
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 4, now: float = None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.current = self.to_tick(time.time() if now is None else now)
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.entries = {}
+
+    def to_tick(self, moment: float) -> int:
+        return int(moment // self.tick)
+
+    def schedule(self, key: Hashable, deadline: float):
+        self.cancel(key)
+        self.place(key, max(self.to_tick(deadline), self.current + 1))
+
+    def cancel(self, key: Hashable):
+        entry = self.entries.pop(key, None)
+        if entry:
+            _, level, slot = entry
+            self.wheels[level][slot].discard(key)
+
+    def place(self, key: Hashable, deadline: int):
+        delta = deadline - self.current
+        level = 0
+        span = self.slots
+        while delta >= span and level < self.levels - 1:
+            level += 1
+            span *= self.slots
+
+        # deadlines beyond the top level wait in its furthest slot and cascade down later
+        placed = min(deadline, self.current + span - 1)
+        slot = (placed // self.slots ** level) % self.slots
+        self.wheels[level][slot].add(key)
+        self.entries[key] = (deadline, level, slot)
+
+    def advance(self, now: float) -> list:
+        expired = []
+        target = self.to_tick(now)
+        while self.current < target:
+            self.current += 1
+            self.cascade()
+
+            bucket = self.wheels[0][self.current % self.slots]
+            self.wheels[0][self.current % self.slots] = set()
+            for key in bucket:
+                deadline, _, _ = self.entries[key]
+                if deadline <= self.current:
+                    del self.entries[key]
+                    expired.append(key)
+                else:
+                    self.place(key, deadline)
+
+        return expired
+
+    def cascade(self):
+        span = 1
+        for level in range(1, self.levels):
+            span *= self.slots
+            if self.current % span:
+                return
+
+            slot = (self.current // span) % self.slots
+            bucket = self.wheels[level][slot]
+            self.wheels[level][slot] = set()
+            for key in bucket:
+                deadline, _, _ = self.entries.pop(key)
+                self.place(key, deadline)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class LivenessTracker:
+    def __init__(self, mongo: Collection, project_access_service: ProjectAccessService, offline_after: float = 90,
+                 tick: float = 1.0, batch_size: int = 1000, rebuild_interval: float = 0,
+                 events_size: int = 16 * 1024 * 1024):
+        self.mongo = mongo
+        # the other workers forward the heartbeats they flush through a capped collection the leader tails, and
+        # read the per-project counts the leader publishes back
+        self.events = mongo.database.liveness_events
+        self.published = mongo.database.machine_counts
+        self.project_access_service = project_access_service
+        self.offline_after = offline_after
+        self.tick = tick
+        self.batch_size = batch_size
+        self.rebuild_interval = rebuild_interval
+        self.events_size = events_size
+        self.lock = threading.Lock()
+        self.wheel = TimingWheel(tick)
+        self.online = {}
+        self.counts = {}
+        self.dirty = set()
+        self.cursor = None
+        # only the started tracker keeps state, the other workers forward to it and answer from what it publishes
+        self.tracking = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def ensure_collection(self):
+        try:
+            self.mongo.database.create_collection(self.events.name, capped=True, size=self.events_size)
+        except CollectionInvalid:
+            pass
+
+    def rebuild(self):
+        now = time.time()
+        wheel = TimingWheel(self.tick, now=now)
+        online = {}
+        counts = {}
+        stale = []
+
+        machines = self.mongo.find({}, {"_id": 0, "project_id": 1, "name": 1, "last_seen": 1, "online": 1})
+        for machine in machines.batch_size(self.batch_size):
+            key = (machine["project_id"], machine["name"])
+            last_seen = machine.get("last_seen")
+            deadline = last_seen.timestamp() + self.offline_after if last_seen else now
+            alive = deadline > now
+
+            online[key] = alive
+            counts.setdefault(key[0], Counter())["online" if alive else "offline"] += 1
+            if alive:
+                wheel.schedule(key, deadline)
+            elif machine.get("online"):
+                stale.append(key)
+
+        with self.lock:
+            # heartbeats that arrived while the scan ran are newer than what it read
+            for key, (deadline, _, _) in self.wheel.entries.items():
+                if online.get(key) is not True:
+                    project_counts = counts.setdefault(key[0], Counter())
+                    project_counts["online"] += 1
+                    if online.get(key) is False:
+                        project_counts["offline"] -= 1
+                    online[key] = True
+                    wheel.schedule(key, deadline * self.tick)
+                elif deadline > wheel.entries[key][0]:
+                    wheel.schedule(key, deadline * self.tick)
+
+            self.dirty |= set(self.counts) | set(counts)
+            self.wheel = wheel
+            self.online = online
+            self.counts = counts
+
+        self.write_offline([key for key in stale if not online[key]], now)
+
+    def heartbeat(self, project_id: str, name: str, seen: float = None):
+        if not self.tracking:
+            return
+
+        deadline = (time.time() if seen is None else seen) + self.offline_after
+        key = (project_id, name)
+        with self.lock:
+            entry = self.wheel.entries.get(key)
+            if entry and entry[0] * self.tick >= deadline:
+                return
+
+            previous = self.online.get(key)
+            if previous is not True:
+                self.online[key] = True
+                project_counts = self.counts.setdefault(project_id, Counter())
+                project_counts["online"] += 1
+                if previous is False:
+                    project_counts["offline"] -= 1
+                self.dirty.add(project_id)
+
+            self.wheel.schedule(key, deadline)
+
+    def expire(self, now: float) -> list:
+        with self.lock:
+            expired = self.wheel.advance(now)
+            for key in expired:
+                self.online[key] = False
+                project_counts = self.counts[key[0]]
+                project_counts["online"] -= 1
+                project_counts["offline"] += 1
+                self.dirty.add(key[0])
+
+        return expired
+
+    def write_offline(self, keys: list, now: float):
+        # heartbeats flushed by other workers since the deadline keep their machine online
+        cutoff = datetime.fromtimestamp(now - self.offline_after)
+        offline_at = datetime.fromtimestamp(now)
+        for start in range(0, len(keys), self.batch_size):
+            operations = []
+            for project_id, name in keys[start:start + self.batch_size]:
+                operations.append(UpdateOne({
+                    "project_id": project_id,
+                    "name": name,
+                    "last_seen": {"$lte": cutoff},
+                }, {
+                    "$set": {
+                        "online": False,
+                        "offline_at": offline_at,
+                    },
+                }))
+
+            try:
+                self.mongo.bulk_write(operations, ordered=False)
+            except Exception:
+                logger.exception("Failed to mark %d machines offline", len(operations))
+
+    def forward(self, machines: list[dict]):
+        # the leader saw these heartbeats as they were enqueued
+        if self.tracking or not machines:
+            return
+
+        now = datetime.now()
+        for start in range(0, len(machines), self.batch_size):
+            self.events.insert_one({
+                "machines": [[machine["project_id"], machine["name"], machine["received_at"]]
+                             for machine in machines[start:start + self.batch_size]],
+                "created_at": now,
+            })
+
+    def consume(self):
+        now = time.time()
+        if self.cursor is None or not self.cursor.alive:
+            # a tailable cursor on an empty collection dies at once, so it is reopened until there is something to
+            # tail; replaying an event only reschedules a deadline that is already scheduled
+            self.cursor = self.events.find({
+                "created_at": {"$gte": datetime.fromtimestamp(now - self.offline_after)},
+            }, cursor_type=CursorType.TAILABLE)
+
+        try:
+            for event in self.cursor:
+                for project_id, name, last_seen in event["machines"]:
+                    seen = last_seen.timestamp()
+                    if seen + self.offline_after > now:
+                        self.heartbeat(project_id, name, seen)
+        except OperationFailure as e:
+            if e.code != CAPPED_POSITION_LOST:
+                raise
+
+            # the capped collection wrapped past the cursor, the events it skipped are read back from the machines
+            logger.warning("Lost the position in forwarded heartbeats, rebuilding machine liveness state")
+            self.cursor = None
+            self.refresh()
+
+    def publish(self):
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+            counts = {project_id: dict(self.counts.get(project_id, Counter())) for project_id in dirty}
+
+        now = datetime.now()
+        project_ids = sorted(counts)
+        for start in range(0, len(project_ids), self.batch_size):
+            operations = []
+            for project_id in project_ids[start:start + self.batch_size]:
+                project_counts = counts[project_id]
+                if not project_counts.get("online") and not project_counts.get("offline"):
+                    operations.append(DeleteOne({"_id": project_id}))
+                    continue
+
+                operations.append(UpdateOne({"_id": project_id}, {
+                    "$set": {
+                        "online": project_counts.get("online", 0),
+                        "offline": project_counts.get("offline", 0),
+                        "updated_at": now,
+                    },
+                }, upsert=True))
+
+            try:
+                self.published.bulk_write(operations, ordered=False)
+            except Exception:
+                logger.exception("Failed to publish machine counts of %d projects", len(operations))
+                with self.lock:
+                    self.dirty.update(project_ids[start:start + self.batch_size])
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.tracking = True
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="liveness-tracker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+    def run(self):
+        self.refresh()
+        refreshed = time.monotonic()
+
+        while not self.stopped.wait(self.tick):
+            # the periodic rescan only corrects drift, such as machines removed by a cascade delete
+            if self.rebuild_interval and time.monotonic() - refreshed >= self.rebuild_interval:
+                self.refresh()
+                refreshed = time.monotonic()
+            else:
+                try:
+                    self.consume()
+                except Exception:
+                    logger.exception("Failed to read forwarded machine heartbeats")
+                    self.cursor = None
+
+            now = time.time()
+            expired = self.expire(now)
+            if expired:
+                self.write_offline(expired, now)
+            self.publish()
+
+    def refresh(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception("Failed to rebuild machine liveness state")
+
+    def status(self, project_id: str, requester_id: str) -> dict:
+        if not self.project_access_service.has_any_access(project_id, requester_id):
+            raise Exception("Project not found")
+
+        return self.counts_for(project_id)
+
+    def counts_for(self, project_id: str) -> dict:
+        if not self.tracking:
+            return self.published_counts(project_id)
+
+        with self.lock:
+            project_counts = self.counts.get(project_id, Counter())
+            return {
+                "project_id": project_id,
+                "online": project_counts["online"],
+                "offline": project_counts["offline"],
+            }
+
+    def published_counts(self, project_id: str) -> dict:
+        project_counts = self.published.find_one({"_id": project_id}, {"online": 1, "offline": 1}) or {}
+        return {
+            "project_id": project_id,
+            "online": project_counts.get("online", 0),
+            "offline": project_counts.get("offline", 0),
+        }
+
+    def stats(self) -> dict:
+        with self.lock:
+            online = sum(counts["online"] for counts in self.counts.values())
+            return {
+                "online": online,
+                "offline": sum(counts["offline"] for counts in self.counts.values()),
+                "scheduled": len(self.wheel),
+            }
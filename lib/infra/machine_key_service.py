@@ -1,65 +1,82 @@
+import hashlib
+
+from typing import Optional, Union
 from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, InsertOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from pymongo.collection import Collection
 from datetime import datetime
 from password_generator import PasswordGenerator
+from lib.bulk import claim_names, ids_query, item_id, item_param, match_targets, names_query, parse_items, \
+    success, targets_query, write_bulk
+from lib.cache import LruCache
+from lib.cascade import NOT_DELETING, deleting_update
 from lib.project import ProjectAccessService
+from lib.pagination import paginate
+from lib.projection import document_to_dict, narrow_projection
 
 
 class MachineKeyService:
-    def __init__(self, mongo: Collection, project_access_service: ProjectAccessService):
+    public_fields = [
+        "name",
+        "project_id",
+        "creator_id",
+        "organization_id",
+        "created_at",
+        "updated_at",
+    ]
+    projection = dict.fromkeys(public_fields, 1)
+
+    indexes = [
+        IndexModel([("project_id", ASCENDING), ("name", ASCENDING)], name="project_id_name", unique=True),
+        IndexModel([("project_id", ASCENDING), ("_id", ASCENDING)], name="project_id__id"),
+        IndexModel([("key_hash", ASCENDING)], name="key_hash", unique=True,
+                   partialFilterExpression={"key_hash": {"$type": "string"}}),
+    ]
+
+    def __init__(self, mongo: Collection, project_access_service: ProjectAccessService, key_cache: LruCache = None,
+                 invalid_key_ttl: float = 5):
         self.mongo = mongo
         self.project_access_service = project_access_service
+        self.key_cache = key_cache if key_cache is not None else LruCache()
+        self.invalid_key_ttl = invalid_key_ttl
         self.key_generator = PasswordGenerator()
         self.key_generator.minlen = 128
         self.key_generator.maxlen = 128
-        self.key_generator.excludeschars = True
+        self.key_generator.minschars = 0
+        self.key_generator.excludeschars = "!#$%^&*(),.-_+=<>?"
 
     def create(self, project_id: str, name: str, creator_id: str, organization_id: str):
-        if self.project_access_service.has_access(project_id, creator_id, "infra.machine-key.admin"):
+        if not self.project_access_service.has_access(project_id, creator_id, "infra.machine-key.admin"):
             raise Exception("Not allowed")
 
         key = self.key_generator.generate()
 
-        if self.name_exists(name, project_id):
+        try:
+            machine_key_id = self.mongo.insert_one(self.machine_key_document(
+                name, key, project_id, creator_id, organization_id)).inserted_id
+        except DuplicateKeyError:
             raise Exception(f"Machine key {name} already exists")
 
-        machine_key_id = self.mongo.insert_one({
-            "name": name,
-            "key": key,
-            "project_id": project_id,
-            "creator_id": creator_id,
-            "organization_id": organization_id,
-            "created_at": datetime.now(),
-            "updated_at": datetime.now(),
-        }).inserted_id
-
         return {
             "id": str(machine_key_id)
         }
 
-    def fetch(self, project_id: str, requester_id: str, page: int = 0, size: int = 50) -> list[dict]:
+    def fetch(self, project_id: str, requester_id: str, page: int = 0, size: int = 50,
+              cursor: str = None, fields: list[str] = None) -> list[dict] | dict:
         if not self.project_access_service.has_any_access(project_id, requester_id):
             raise Exception("Project not found")
 
-        machine_keys = self.mongo.find({
-            "project_id": project_id,
-        }).skip(page * size).limit(size)
-
-        result = []
-
-        for machine_key in machine_keys:
-            result.append(self.to_dict(machine_key))
-
-        return result
+        return paginate(self.mongo, {"project_id": project_id}, self.to_dict, page, size, cursor,
+                        narrow_projection(self.projection, fields))
 
     def get(self, machine_key_id: str, project_id: str, requester_id: str) -> dict:
-        if not self.project_access_service.has_any_access(project_id, requester_id):
-            raise Exception("Project not found")
+        allowed, machine_key = self.project_access_service.load_with_access(
+            project_id, requester_id, None, self.mongo, self.machine_key_query(machine_key_id, project_id),
+            self.projection)
 
-        machine_key = self.mongo.find_one({
-            "_id": ObjectId(machine_key_id),
-            "project_id": project_id,
-        })
+        if not allowed:
+            raise Exception("Project not found")
 
         if not machine_key:
             raise Exception("Machine key not found")
@@ -67,33 +84,21 @@ class MachineKeyService:
         return self.to_dict(machine_key)
 
     def update(self, machine_key_id: str, name: str, project_id: str, requester_id: str) -> dict:
-        if self.project_access_service.has_access(project_id, requester_id, "infra.machine-key.admin"):
+        if not self.project_access_service.has_access(project_id, requester_id, "infra.machine-key.admin"):
             raise Exception("Not allowed")
 
-        fields = {
-            "updated_at": datetime.now(),
-        }
-
-        if name:
-            if self.mongo.count_documents({
-                "_id": {"$ne": ObjectId(machine_key_id)},
-                "name": name,
-                "project_id": project_id,
-            }) > 0:
-                raise Exception("Machine key {name} already exists")
-
-            fields["name"] = name
-
-        result = self.mongo.update_one({
-            "_id": ObjectId(machine_key_id),
-            "project_id": project_id,
-        }, {
-            "$set": fields,
-        })
+        try:
+            machine_key = self.mongo.find_one_and_update(self.machine_key_query(machine_key_id, project_id), {
+                "$set": self.update_fields(name),
+            }, {"key_hash": 1})
+        except DuplicateKeyError:
+            raise Exception(f"Machine key {name} already exists")
 
-        if result.matched_count == 0:
+        if not machine_key:
             raise Exception("Machine key not found")
 
+        self.invalidate(machine_key)
+
         return {
             "id": machine_key_id
         }
@@ -102,26 +107,72 @@ class MachineKeyService:
         if not self.project_access_service.has_access(project_id, requester_id, "infra.machine-key.admin"):
             raise Exception("Project not found")
 
-        result = self.mongo.delete_one({
-            "_id": ObjectId(machine_key_id),
-            "project_id": project_id,
-        })
+        machine_key = self.mongo.find_one_and_delete(self.machine_key_query(machine_key_id, project_id),
+                                                   {"key_hash": 1})
 
-        if result.deleted_count == 0:
+        if not machine_key:
             raise Exception("Machine key not found")
 
+        self.invalidate(machine_key)
+
         return {
             "id": machine_key_id
         }
 
-    def get_key(self, machine_key_id: str, project_id: str, requester_id: str) -> dict:
+    def bulk_create(self, items: list, project_id: str, creator_id: str, organization_id: str) -> dict:
+        if not self.project_access_service.has_access(project_id, creator_id, "infra.machine-key.admin"):
+            raise Exception("Not allowed")
+
+        results, parsed = parse_items(items, self.parse_create)
+        parsed = claim_names(results, parsed, self.mongo.find(names_query(project_id, parsed), {"name": 1}),
+                             "Machine key {} already exists")
+        write_bulk(self.mongo, self.insert_operations(results, parsed, project_id, creator_id, organization_id),
+                   results, lambda position: f"Machine key {parsed[position]['name']} already exists")
+
+        return {
+            "items": results
+        }
+
+    def bulk_update(self, items: list, project_id: str, requester_id: str) -> dict:
+        if not self.project_access_service.has_access(project_id, requester_id, "infra.machine-key.admin"):
+            raise Exception("Not allowed")
+
+        results, parsed = parse_items(items, self.parse_update)
+        parsed = match_targets(results, parsed,
+                               self.mongo.find(targets_query(project_id, parsed), {"name": 1, "key_hash": 1}),
+                               "Machine key not found", "Machine key {} already exists")
+        write_bulk(self.mongo, self.update_operations(parsed, project_id), results,
+                   lambda position: f"Machine key {parsed[position]['name']} already exists")
+        for machine_key in parsed.values():
+            self.invalidate(machine_key)
+
+        return {
+            "items": results
+        }
+
+    def bulk_delete(self, machine_key_ids: list, project_id: str, requester_id: str) -> dict:
         if not self.project_access_service.has_access(project_id, requester_id, "infra.machine-key.admin"):
             raise Exception("Project not found")
 
-        machine_key = self.mongo.find_one({
-            "_id": ObjectId(machine_key_id),
-            "project_id": project_id,
-        })
+        results, parsed = parse_items(machine_key_ids, self.parse_delete)
+        parsed = match_targets(results, parsed, self.mongo.find(ids_query(project_id, parsed), {"key_hash": 1}),
+                               "Machine key not found")
+        if parsed:
+            self.mongo.delete_many(ids_query(project_id, parsed))
+        for machine_key in parsed.values():
+            self.invalidate(machine_key)
+
+        return {
+            "items": results
+        }
+
+    def get_key(self, machine_key_id: str, project_id: str, requester_id: str) -> dict:
+        allowed, machine_key = self.project_access_service.load_with_access(
+            project_id, requester_id, "infra.machine-key.admin", self.mongo,
+            self.machine_key_query(machine_key_id, project_id), {"key": 1})
+
+        if not allowed:
+            raise Exception("Project not found")
 
         if not machine_key:
             raise Exception("Machine key not found")
@@ -131,20 +182,152 @@ class MachineKeyService:
             "key": machine_key["key"]
         }
 
-    def name_exists(self, name: str, project_id: str):
-        return self.mongo.count_documents({
-            'name': name,
-            'project_id': project_id
-        }) > 0
+    def authenticate(self, key: str) -> dict:
+        key_hash = self.hash_key(key)
+        identity = self.key_cache.get(key_hash)
+
+        if identity is None:
+            generation = self.key_cache.generation
+            machine_key = self.mongo.find_one(self.authenticate_query(key_hash),
+                                             {"project_id": 1, "organization_id": 1})
+            identity = self.cache_identity(key_hash, machine_key, generation)
+
+        if not identity:
+            raise Exception("Invalid machine key")
+
+        return identity
+
+    def insert_operations(self, results: list, parsed: dict[int, dict], project_id: str, creator_id: str,
+                          organization_id: str) -> dict:
+        operations = {}
+        for position, fields in parsed.items():
+            machine_key_id = ObjectId()
+            operations[position] = InsertOne(self.machine_key_document(
+                fields["name"], self.key_generator.generate(), project_id, creator_id, organization_id,
+                machine_key_id))
+            results[position] = success(machine_key_id)
+
+        return operations
 
     @staticmethod
-    def to_dict(self) -> dict:
+    def parse_create(item) -> dict:
+        return {
+            "name": item_param(item, "name"),
+        }
+
+    @staticmethod
+    def parse_update(item) -> dict:
+        return {
+            "_id": item_id(item_param(item, "id"), "Machine key not found"),
+            "name": item_param(item, "name", required=False),
+        }
+
+    @staticmethod
+    def parse_delete(machine_key_id) -> dict:
+        return {
+            "_id": item_id(machine_key_id, "Machine key not found"),
+        }
+
+    @classmethod
+    def update_operations(cls, parsed: dict[int, dict], project_id: str) -> dict:
+        operations = {}
+        for position, machine_key in parsed.items():
+            operations[position] = UpdateOne({
+                "_id": machine_key["_id"],
+                "project_id": project_id,
+            }, {
+                "$set": cls.update_fields(machine_key["name"]),
+            })
+
+        return operations
+
+    @classmethod
+    def machine_key_document(cls, name: str, key: str, project_id: str, creator_id: str, organization_id: str,
+                             machine_key_id: ObjectId = None) -> dict:
+        document = {
+            "name": name,
+            "key": key,
+            "key_hash": cls.hash_key(key),
+            "project_id": project_id,
+            "creator_id": creator_id,
+            "organization_id": organization_id,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+        }
+        if machine_key_id:
+            document["_id"] = machine_key_id
+
+        return document
+
+    @staticmethod
+    def machine_key_query(machine_key_id: str, project_id: str) -> dict:
+        return {
+            "_id": ObjectId(machine_key_id),
+            "project_id": project_id,
+        }
+
+    @staticmethod
+    def authenticate_query(key_hash: str) -> dict:
         return {
-            'id': str(self['_id']),
-            'name': self['name'],
-            'project_id': self['project_id'],
-            'creator_id': self['creator_id'],
-            'organization_id': self['organization_id'],
-            'created_at': self['created_at'],
-            'updated_at': self['updated_at'],
+            "key_hash": key_hash,
+            **NOT_DELETING,
+        }
+
+    @staticmethod
+    def update_fields(name: str) -> dict:
+        fields = {
+            "updated_at": datetime.now(),
+        }
+
+        if name:
+            fields["name"] = name
+
+        return fields
+
+    def cache_identity(self, key_hash: str, machine_key: Optional[dict], generation: int) -> Union[dict, bool]:
+        if not machine_key:
+            self.key_cache.set(key_hash, False, self.invalid_key_ttl, generation)
+            return False
+
+        identity = {
+            "id": str(machine_key["_id"]),
+            "project_id": machine_key["project_id"],
+            "organization_id": machine_key["organization_id"],
         }
+        self.key_cache.set(key_hash, identity, generation=generation)
+        return identity
+
+    def invalidate(self, machine_key: dict):
+        if machine_key.get("key_hash"):
+            self.key_cache.invalidate(machine_key["key_hash"])
+
+    def invalidate_many(self, machine_keys: list[dict]):
+        for machine_key in machine_keys:
+            self.invalidate(machine_key)
+
+    def revoke_project(self, project_id: str):
+        # the project's cascade job removes these keys, until then they authenticate nothing in any worker
+        self.mongo.update_many({"project_id": project_id}, deleting_update())
+        self.invalidate_many(self.mongo.find({"project_id": project_id}, {"key_hash": 1}))
+
+    def backfill_key_hashes(self) -> int:
+        count = 0
+        for machine_key in self.mongo.find({"key_hash": {"$exists": False}}, {"key": 1}):
+            self.mongo.update_one({
+                "_id": machine_key["_id"],
+            }, {
+                "$set": {
+                    "key_hash": self.hash_key(machine_key["key"]),
+                }
+            })
+            count += 1
+
+        return count
+
+    @staticmethod
+    def hash_key(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def to_dict(self) -> dict:
+        return document_to_dict(self, MachineKeyService.public_fields)
@@ -1,12 +1,195 @@
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, UpdateOne
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+
+from lib.errors import ServiceBusyError
+from .heartbeat_history_service import HeartbeatHistoryService
+from .liveness_tracker import LivenessTracker
 from .machine_key_service import MachineKeyService
-from datetime import datetime
+
+logger = logging.getLogger(__name__)
 
 
 class MachineService:
-    def __init__(self, mongo: Collection, machine_key_service: MachineKeyService):
+    indexes = [
+        IndexModel([("project_id", ASCENDING), ("name", ASCENDING)], name="project_id_name", unique=True),
+        IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+    ]
+
+    def __init__(self, mongo: Collection, machine_key_service: MachineKeyService, flush_size: int = 1000,
+                 flush_interval: float = 1.0, max_queue: int = 100000,
+                 history_service: HeartbeatHistoryService = None, liveness_tracker: LivenessTracker = None):
         self.mongo = mongo
+        self.projects = mongo.database.projects
         self.machine_key_service = machine_key_service
+        self.history_service = history_service
+        self.liveness_tracker = liveness_tracker
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queue)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="heartbeat-flusher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def process_heartbeat(self, key: str, name: str, data: dict) -> dict:
+        return self.enqueue(self.machine_key_service.authenticate(key), name, data)
+
+    def enqueue(self, machine_key: dict, name: str, data: dict) -> dict:
+        try:
+            self.queue.put_nowait({
+                "name": name,
+                "data": data or {},
+                "project_id": machine_key["project_id"],
+                "organization_id": machine_key["organization_id"],
+                "machine_key_id": machine_key["id"],
+                "received_at": datetime.now(),
+            })
+        except queue.Full:
+            raise ServiceBusyError("Too many heartbeats in flight, try again later")
+
+        if self.liveness_tracker:
+            self.liveness_tracker.heartbeat(machine_key["project_id"], name)
+
+        return {
+            "accepted": True
+        }
+
+    def run(self):
+        batch = {}
+        samples = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while not (self.stopped.is_set() and self.queue.empty()):
+            try:
+                heartbeat = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                self.coalesce(batch, heartbeat)
+                samples.append(heartbeat)
+            except queue.Empty:
+                pass
+
+            if len(samples) >= self.flush_size or time.monotonic() >= deadline:
+                self.flush(batch, samples)
+                batch = {}
+                samples = []
+                deadline = time.monotonic() + self.flush_interval
+
+        self.flush(batch, samples)
+
+    @staticmethod
+    def coalesce(batch: dict, heartbeat: dict):
+        key = (heartbeat["project_id"], heartbeat["name"])
+        machine = batch.get(key)
+        if not machine:
+            batch[key] = {**heartbeat, "count": 1}
+            return
+
+        machine["count"] += 1
+        if heartbeat["received_at"] >= machine["received_at"]:
+            machine.update(heartbeat)
+
+    def flush(self, batch: dict, samples: list[dict] = None):
+        deleting = self.deleting_projects({machine["project_id"] for machine in batch.values()})
+        if deleting:
+            # keys can stay cached for a moment after their project is deleted, its machines must not come back
+            batch = {key: machine for key, machine in batch.items() if machine["project_id"] not in deleting}
+            samples = [sample for sample in samples or [] if sample["project_id"] not in deleting]
+
+        if not batch:
+            return
+
+        now = datetime.now()
+        machines = list(batch.values())
+        operations = []
+        for machine in machines:
+            operations.append(UpdateOne({
+                "project_id": machine["project_id"],
+                "name": machine["name"],
+            }, {
+                "$setOnInsert": {
+                    "created_at": now,
+                },
+                "$set": {
+                    "organization_id": machine["organization_id"],
+                    "machine_key_id": machine["machine_key_id"],
+                    "data": machine["data"],
+                    "last_seen": machine["received_at"],
+                    "online": True,
+                    "updated_at": now,
+                },
+                "$inc": {
+                    "heartbeat_count": machine["count"],
+                },
+            }, upsert=True))
+
+        try:
+            self.mongo.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            self.retry_failed(machines, operations, e)
+        except Exception:
+            logger.exception("Failed to flush %d machine heartbeats", len(operations))
+
+        if self.liveness_tracker:
+            try:
+                self.liveness_tracker.forward(machines)
+            except Exception:
+                logger.exception("Failed to forward %d machine heartbeats", len(machines))
+
+        if self.history_service and samples:
+            try:
+                self.history_service.record(samples)
+            except Exception:
+                logger.exception("Failed to record %d heartbeat samples", len(samples))
+
+    def deleting_projects(self, project_ids: set[str]) -> set[str]:
+        if not project_ids:
+            return set()
+
+        try:
+            projects = self.projects.find({
+                "_id": {"$in": [ObjectId(project_id) for project_id in project_ids if ObjectId.is_valid(project_id)]},
+                "deleting": True,
+            }, {"_id": 1})
+            return {str(project["_id"]) for project in projects}
+        except Exception:
+            logger.exception("Failed to check %d projects for deletion", len(project_ids))
+            return set()
+
+    def retry_failed(self, machines: list[dict], operations: list[UpdateOne], error: BulkWriteError):
+        # unordered writes apply every other operation, only the failed ones are looked at again
+        retry = []
+        for write_error in error.details["writeErrors"]:
+            machine = machines[write_error["index"]]
+            # two workers upserting a new machine at once, the loser's write becomes an update on retry
+            if write_error["code"] == 11000:
+                retry.append(operations[write_error["index"]])
+            else:
+                logger.error("Failed to flush heartbeat of machine %s in project %s: %s", machine["name"],
+                             machine["project_id"], write_error["errmsg"])
 
-    def process_heartbeat(self):
-        pass
+        if retry:
+            try:
+                self.mongo.bulk_write(retry, ordered=False)
+            except Exception:
+                logger.exception("Failed to retry %d machine heartbeats", len(retry))
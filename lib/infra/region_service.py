@@ -1,58 +1,67 @@
 from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, InsertOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from pymongo.collection import Collection
 from datetime import datetime
+from lib.bulk import claim_names, ids_query, item_id, item_param, match_targets, names_query, parse_items, \
+    success, targets_query, write_bulk
+from lib.cascade import NOT_DELETING, CascadeService, deleting_update
 from lib.project import ProjectAccessService
+from lib.pagination import paginate
+from lib.projection import document_to_dict, narrow_projection
 
 
 class RegionService:
-    def __init__(self, mongo: Collection, project_access_service: ProjectAccessService):
+    public_fields = [
+        "name",
+        "description",
+        "project_id",
+        "creator_id",
+        "organization_id",
+        "created_at",
+        "updated_at",
+    ]
+    projection = dict.fromkeys(public_fields, 1)
+
+    indexes = [
+        IndexModel([("project_id", ASCENDING), ("name", ASCENDING)], name="project_id_name", unique=True),
+        IndexModel([("project_id", ASCENDING), ("_id", ASCENDING)], name="project_id__id"),
+    ]
+
+    def __init__(self, mongo: Collection, project_access_service: ProjectAccessService,
+                 cascade_service: CascadeService = None):
         self.mongo = mongo
         self.project_access_service = project_access_service
+        self.cascade_service = cascade_service
 
     def create(self, name: str, description: str, project_id: str, creator_id: str, organization_id: str):
         if not self.project_access_service.has_access(project_id, creator_id, "infra.region.admin"):
             raise Exception("Not allowed")
 
-        if self.name_exists(name, project_id):
+        try:
+            region_id = self.mongo.insert_one(self.region_document(
+                name, description, project_id, creator_id, organization_id)).inserted_id
+        except DuplicateKeyError:
             raise Exception(f"Region {name} already exists")
 
-        region_id = self.mongo.insert_one({
-            "name": name,
-            "description": description,
-            "project_id": project_id,
-            "creator_id": creator_id,
-            "organization_id": organization_id,
-            "created_at": datetime.now(),
-            "updated_at": datetime.now(),
-        }).inserted_id
-
         return {
             "id": str(region_id)
         }
 
-    def fetch(self, project_id: str, requester_id: str, page: int = 0, size: int = 50) -> list[dict]:
+    def fetch(self, project_id: str, requester_id: str, page: int = 0, size: int = 50,
+              cursor: str = None, fields: list[str] = None) -> list[dict] | dict:
         if not self.project_access_service.has_any_access(project_id, requester_id):
             raise Exception("Project not found")
 
-        regions = self.mongo.find({
-            "project_id": project_id,
-        }).skip(page * size).limit(size)
-
-        result = []
-
-        for region in regions:
-            result.append(self.to_dict(region))
-
-        return result
+        return paginate(self.mongo, self.project_query(project_id), self.to_dict, page, size, cursor,
+                        narrow_projection(self.projection, fields))
 
     def get(self, region_id: str, project_id: str, requester_id: str) -> dict:
-        if not self.project_access_service.has_any_access(project_id, requester_id):
-            raise Exception("Project not found")
+        allowed, region = self.project_access_service.load_with_access(
+            project_id, requester_id, None, self.mongo, self.region_query(region_id, project_id), self.projection)
 
-        region = self.mongo.find_one({
-            "_id": ObjectId(region_id),
-            "project_id": project_id,
-        })
+        if not allowed:
+            raise Exception("Project not found")
 
         if not region:
             raise Exception("Region not found")
@@ -63,72 +72,198 @@ class RegionService:
         if not self.project_access_service.has_access(project_id, requester_id, "infra.region.admin"):
             raise Exception("Not allowed")
 
-        fields = {
-            "updated_at": datetime.now(),
-            "description": description,
+        try:
+            result = self.mongo.update_one(self.region_query(region_id, project_id), {
+                "$set": self.update_fields(name, description)
+            })
+        except DuplicateKeyError:
+            raise Exception(f"Region {name} already exists")
+
+        if result.matched_count == 0:
+            raise Exception("Region not found")
+
+        return {
+            "id": region_id
         }
 
-        if name:
-            if self.mongo.count_documents({
-                "_id": {"$ne": ObjectId(region_id)},
-                "name": name,
-                "project_id": project_id
-            }) > 0:
-                raise Exception(f"Project {name} already exists")
+    def delete(self, region_id: str, project_id: str, requester_id: str) -> dict:
+        if not self.project_access_service.has_access(project_id, requester_id, "infra.region.admin"):
+            raise Exception("Not allowed")
 
-            fields["name"] = name
+        if not self.cascade_service:
+            result = self.mongo.delete_one(self.region_query(region_id, project_id))
+            if result.deleted_count == 0:
+                raise Exception("Region not found")
 
-        result = self.mongo.update_one({
-            "_id": ObjectId(region_id),
-            "project_id": project_id,
-        }, {
-            "$set": fields
-        })
+            return {
+                "id": region_id
+            }
+
+        # new data centers check the marker, the cascade job removes the existing ones and then the region
+        result = self.mongo.update_one(self.region_query(region_id, project_id), deleting_update())
 
         if result.matched_count == 0:
             raise Exception("Region not found")
 
+        self.cascade_service.enqueue("region", [region_id], {"project_id": project_id})
+
         return {
             "id": region_id
         }
 
-    def delete(self, region_id: str, project_id: str, requester_id: str) -> dict:
+    def exists(self, region_id: str, project_id: str) -> bool:
+        return self.mongo.count_documents(self.region_query(region_id, project_id), limit=1) > 0
+
+    def existing(self, region_ids: list[str], project_id: str) -> set[str]:
+        regions = self.mongo.find(self.existing_query(region_ids, project_id), {"_id": 1})
+        return {str(region["_id"]) for region in regions}
+
+    def bulk_create(self, items: list, project_id: str, creator_id: str, organization_id: str) -> dict:
+        if not self.project_access_service.has_access(project_id, creator_id, "infra.region.admin"):
+            raise Exception("Not allowed")
+
+        results, parsed = parse_items(items, self.parse_create)
+        parsed = claim_names(results, parsed, self.mongo.find(names_query(project_id, parsed), {"name": 1}),
+                             "Region {} already exists")
+        write_bulk(self.mongo, self.insert_operations(results, parsed, project_id, creator_id, organization_id),
+                   results, lambda position: f"Region {parsed[position]['name']} already exists")
+
+        return {
+            "items": results
+        }
+
+    def bulk_update(self, items: list, project_id: str, requester_id: str) -> dict:
+        if not self.project_access_service.has_access(project_id, requester_id, "infra.region.admin"):
+            raise Exception("Not allowed")
+
+        results, parsed = parse_items(items, self.parse_update)
+        parsed = match_targets(results, parsed, self.mongo.find({**targets_query(project_id, parsed), **NOT_DELETING},
+                                                                {"name": 1}),
+                               "Region not found", "Region {} already exists")
+        write_bulk(self.mongo, self.update_operations(parsed, project_id), results,
+                   lambda position: f"Region {parsed[position]['name']} already exists")
+
+        return {
+            "items": results
+        }
+
+    def bulk_delete(self, region_ids: list, project_id: str, requester_id: str) -> dict:
         if not self.project_access_service.has_access(project_id, requester_id, "infra.region.admin"):
             raise Exception("Not allowed")
 
-        result = self.mongo.delete_one({
+        results, parsed = parse_items(region_ids, self.parse_delete)
+        parsed = match_targets(results, parsed, self.mongo.find({**ids_query(project_id, parsed), **NOT_DELETING},
+                                                                {"_id": 1}),
+                               "Region not found")
+        if parsed and self.cascade_service:
+            self.mongo.update_many({**ids_query(project_id, parsed), **NOT_DELETING}, deleting_update())
+            self.cascade_service.enqueue("region", [str(fields["_id"]) for fields in parsed.values()],
+                                         {"project_id": project_id})
+        elif parsed:
+            self.mongo.delete_many(ids_query(project_id, parsed))
+
+        return {
+            "items": results
+        }
+
+    @staticmethod
+    def region_document(name: str, description: str, project_id: str, creator_id: str, organization_id: str,
+                        region_id: ObjectId = None) -> dict:
+        document = {
+            "name": name,
+            "description": description,
+            "project_id": project_id,
+            "creator_id": creator_id,
+            "organization_id": organization_id,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+        }
+        if region_id:
+            document["_id"] = region_id
+
+        return document
+
+    @staticmethod
+    def region_query(region_id: str, project_id: str) -> dict:
+        return {
             "_id": ObjectId(region_id),
             "project_id": project_id,
-        })
+            **NOT_DELETING,
+        }
 
-        if result.deleted_count == 0:
-            raise Exception("Region not found")
+    @staticmethod
+    def project_query(project_id: str) -> dict:
+        return {
+            "project_id": project_id,
+            **NOT_DELETING,
+        }
+
+    @staticmethod
+    def update_fields(name: str, description: str) -> dict:
+        fields = {
+            "updated_at": datetime.now(),
+            "description": description,
+        }
+
+        if name:
+            fields["name"] = name
 
+        return fields
+
+    @staticmethod
+    def existing_query(region_ids: list[str], project_id: str) -> dict:
         return {
-            "id": region_id
+            "_id": {"$in": [ObjectId(region_id) for region_id in set(region_ids) if ObjectId.is_valid(region_id)]},
+            "project_id": project_id,
+            **NOT_DELETING,
         }
 
-    def exists(self, region_id: str, project_id: str) -> bool:
-        return self.mongo.count_documents({
-            "_id": ObjectId(region_id),
-            "project_id": project_id
-        }) > 0
+    @staticmethod
+    def parse_create(item) -> dict:
+        return {
+            "name": item_param(item, "name"),
+            "description": item_param(item, "description", required=False),
+        }
 
-    def name_exists(self, name: str, project_id: str) -> bool:
-        return self.mongo.count_documents({
-            'name': name,
-            'project_id': project_id
-        }) > 0
+    @staticmethod
+    def parse_update(item) -> dict:
+        return {
+            "_id": item_id(item_param(item, "id"), "Region not found"),
+            "name": item_param(item, "name", required=False),
+            "description": item_param(item, "description", required=False),
+        }
 
     @staticmethod
-    def to_dict(self) -> dict:
+    def parse_delete(region_id) -> dict:
         return {
-            "id": str(self["_id"]),
-            "name": self["name"],
-            "description": self["description"],
-            "project_id": self["project_id"],
-            "creator_id": self["creator_id"],
-            "organization_id": self["organization_id"],
-            "created_at": self["created_at"],
-            "updated_at": self["updated_at"],
+            "_id": item_id(region_id, "Region not found"),
         }
+
+    @classmethod
+    def insert_operations(cls, results: list, parsed: dict[int, dict], project_id: str, creator_id: str,
+                          organization_id: str) -> dict:
+        operations = {}
+        for position, fields in parsed.items():
+            region_id = ObjectId()
+            operations[position] = InsertOne(cls.region_document(
+                fields["name"], fields["description"], project_id, creator_id, organization_id, region_id))
+            results[position] = success(region_id)
+
+        return operations
+
+    @classmethod
+    def update_operations(cls, parsed: dict[int, dict], project_id: str) -> dict:
+        operations = {}
+        for position, region in parsed.items():
+            operations[position] = UpdateOne({
+                "_id": region["_id"],
+                "project_id": project_id,
+            }, {
+                "$set": cls.update_fields(region["name"], region["description"])
+            })
+
+        return operations
+
+    @staticmethod
+    def to_dict(self) -> dict:
+        return document_to_dict(self, RegionService.public_fields)
@@ -0,0 +1,130 @@
+import logging
+import queue
+import threading
+from datetime import datetime, timedelta
+from typing import Hashable
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+from pymongo.database import Database
+
+from lib.cache import LruCache
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidationBus:
+    def __init__(self, db: Database, poll_interval: float = 1, retention: int = 3600, overlap: float = 10,
+                 batch_size: int = 1000):
+        self.mongo = db.cache_invalidations
+        self.poll_interval = poll_interval
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.indexes = [
+            IndexModel([("created_at", ASCENDING)], name="created_at", expireAfterSeconds=retention),
+        ]
+        self.caches = {}
+        self.pending = queue.SimpleQueue()
+        self.origin = str(ObjectId())
+        self.since = datetime.now()
+        self.seen = {}
+        self.published = 0
+        self.received = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def attach(self, name: str, cache: LruCache):
+        self.caches[name] = cache
+        cache.listener = lambda operation, key: self.publish(name, operation, key)
+
+    def publish(self, name: str, operation: str, key: Hashable):
+        # request paths only queue, the bus thread writes them out with its next poll
+        self.pending.put({
+            "cache": name,
+            "operation": operation,
+            "key": list(key) if isinstance(key, tuple) else key,
+        })
+
+    def start(self):
+        if self.thread or not self.poll_interval:
+            return
+
+        # created after fork so every worker skips only its own invalidations
+        self.origin = str(ObjectId())
+        self.since = datetime.now()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="cache-invalidations", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Failed to publish cache invalidations")
+
+    def run(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                self.flush()
+                self.poll()
+            except Exception:
+                logger.exception("Failed to exchange cache invalidations")
+
+    def flush(self):
+        invalidations = []
+        while True:
+            try:
+                invalidations.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+
+        for start in range(0, len(invalidations), self.batch_size):
+            self.mongo.insert_one({
+                "origin": self.origin,
+                "invalidations": invalidations[start:start + self.batch_size],
+                "created_at": datetime.now(),
+            })
+        self.published += len(invalidations)
+
+    def poll(self):
+        # writers stamp created_at before their insert becomes visible, so each poll rereads an overlapping
+        # window and skips the documents it already applied
+        now = datetime.now()
+        since = self.since - timedelta(seconds=self.overlap)
+        for document in self.mongo.find({
+            "created_at": {"$gte": since},
+            "origin": {"$ne": self.origin},
+        }).sort("created_at", ASCENDING):
+            if document["_id"] in self.seen:
+                continue
+
+            self.seen[document["_id"]] = document["created_at"]
+            for invalidation in document["invalidations"]:
+                self.apply(invalidation)
+
+        self.since = now
+        self.seen = {document_id: created_at for document_id, created_at in self.seen.items() if created_at >= since}
+
+    def apply(self, invalidation: dict):
+        cache = self.caches.get(invalidation["cache"])
+        if cache is None:
+            return
+
+        key = tuple(invalidation["key"]) if isinstance(invalidation["key"], list) else invalidation["key"]
+        if invalidation["operation"] == "prefix":
+            cache.invalidate_prefix(key, broadcast=False)
+        else:
+            cache.invalidate(key, broadcast=False)
+        self.received += 1
+
+    def stats(self) -> dict:
+        return {
+            "published": self.published,
+            "received": self.received,
+        }
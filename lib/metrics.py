@@ -0,0 +1,248 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterable
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# a context variable follows both request threads and asyncio tasks
+mongo_seconds: ContextVar = ContextVar("mongo_seconds", default=None)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS, labels: dict = None, snapshot_path: str = None,
+                 snapshot_interval: float = 5):
+        self.buckets = buckets
+        # added to every sample, prefork workers each count their own requests under a worker label
+        self.labels = tuple(sorted((labels or {}).items()))
+        # prefork workers write their samples next to each other, whichever worker is scraped renders them all
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.descriptions = {}
+        self.collectors = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def describe(self, name: str, description: str):
+        self.descriptions[name] = description
+
+    def increment(self, name: str, labels: dict, amount: float = 1):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.counters.setdefault(name, {})
+            family[key] = family.get(key, 0) + amount
+
+    def observe(self, name: str, labels: dict, value: float):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.histograms.setdefault(name, {})
+            histogram = family.get(key)
+            if histogram is None:
+                histogram = family[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, name: str, labels: dict):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - started)
+
+    def add_collector(self, collector: Callable[[], Iterable[tuple]]):
+        # a collector yields (name, type, labels, value) samples computed at scrape time
+        self.collectors.append(collector)
+
+    def start_request(self):
+        mongo_seconds.set(0.0)
+
+    def add_mongo_time(self, seconds: float):
+        current = mongo_seconds.get()
+        if current is not None:
+            mongo_seconds.set(current + seconds)
+
+    def finish_request(self) -> float:
+        seconds = mongo_seconds.get() or 0.0
+        mongo_seconds.set(None)
+        return seconds
+
+    def start(self):
+        if self.thread or not self.snapshot_path:
+            return
+
+        os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="metrics-snapshots", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while True:
+            try:
+                self.write_snapshot()
+            except Exception:
+                logger.exception("Failed to write metrics snapshot")
+
+            if self.stopped.wait(self.snapshot_interval):
+                return
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = [[name, self.labels + key, value] for name, family in self.counters.items()
+                        for key, value in family.items()]
+            histograms = [[name, self.labels + key, list(value[0]), value[1], value[2]]
+                          for name, family in self.histograms.items() for key, value in family.items()]
+
+        collected = []
+        for collector in self.collectors:
+            for name, metric_type, labels, value in collector():
+                collected.append([name, metric_type, self.labels + tuple(sorted(labels.items())), value])
+
+        return {
+            "counters": counters,
+            "histograms": histograms,
+            "collected": collected,
+        }
+
+    def write_snapshot(self):
+        # replaced in one rename, a scrape never reads half a snapshot
+        partial = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(partial, "w") as file:
+            json.dump(self.snapshot(), file, default=str)
+        os.replace(partial, self.snapshot_path)
+
+    def read_snapshots(self) -> list[dict]:
+        snapshots = []
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(self.snapshot_path) or ".", "*.json"))):
+            if os.path.abspath(path) == os.path.abspath(self.snapshot_path):
+                continue
+
+            try:
+                with open(path) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                logger.warning("Skipping unreadable metrics snapshot %s", path)
+
+        return snapshots
+
+    @staticmethod
+    def clear_snapshots(directory: str):
+        # snapshots left by a previous run would report workers that no longer exist
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            os.remove(path)
+
+    def render(self) -> str:
+        snapshots = [self.snapshot()]
+        if self.snapshot_path:
+            snapshots += self.read_snapshots()
+
+        counters = {}
+        histograms = {}
+        collected = {}
+        for snapshot in snapshots:
+            for name, key, value in snapshot["counters"]:
+                counters.setdefault(name, []).append((key, value))
+            for name, key, buckets, total, count in snapshot["histograms"]:
+                histograms.setdefault(name, []).append((key, buckets, total, count))
+            for name, metric_type, key, value in snapshot["collected"]:
+                collected.setdefault((name, metric_type), []).append((key, value))
+
+        lines = []
+        for name, samples in sorted(counters.items()):
+            self.header(lines, name, "counter")
+            for key, value in samples:
+                lines.append(f"{name}{self.format_labels(key)} {value}")
+
+        for name, samples in sorted(histograms.items()):
+            self.header(lines, name, "histogram")
+            for key, buckets, total, count in samples:
+                key = tuple(key)
+                for bound, bucket_count in zip(self.buckets, buckets):
+                    lines.append(f"{name}_bucket{self.format_labels(key + (('le', str(bound)),))} {bucket_count}")
+                lines.append(f"{name}_bucket{self.format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self.format_labels(key)} {total}")
+                lines.append(f"{name}_count{self.format_labels(key)} {count}")
+
+        for (name, metric_type), samples in collected.items():
+            self.header(lines, name, metric_type)
+            for key, value in samples:
+                lines.append(f"{name}{self.format_labels(key)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def header(self, lines: list[str], name: str, metric_type: str):
+        if name in self.descriptions:
+            lines.append(f"# HELP {name} {self.descriptions[name]}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+    @staticmethod
+    def format_labels(key) -> str:
+        if not key:
+            return ""
+
+        labels = []
+        for label, value in key:
+            value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            labels.append(f"{label}=\"{value}\"")
+        return "{" + ",".join(labels) + "}"
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.collections = {}
+        metrics.describe("controller_mongo_commands_total", "Mongo commands by collection, command and outcome")
+        metrics.describe("controller_mongo_command_duration_seconds", "Mongo command round trip time")
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        with self.lock:
+            self.collections[(event.connection_id, event.request_id)] = self.collection_name(event)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self.record(event, "success")
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self.record(event, "failure")
+
+    def record(self, event, outcome: str):
+        with self.lock:
+            collection = self.collections.pop((event.connection_id, event.request_id), "")
+
+        seconds = event.duration_micros / 1000000
+        labels = {"collection": collection, "command": event.command_name}
+        self.metrics.increment("controller_mongo_commands_total", {**labels, "outcome": outcome})
+        self.metrics.observe("controller_mongo_command_duration_seconds", labels, seconds)
+        self.metrics.add_mongo_time(seconds)
+
+    @staticmethod
+    def collection_name(event: monitoring.CommandStartedEvent) -> str:
+        target = event.command.get(event.command_name)
+        if isinstance(target, str):
+            return target
+        return str(event.command.get("collection", ""))
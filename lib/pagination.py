@@ -0,0 +1,89 @@
+import base64
+from typing import Callable, Optional, Union
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.collection import Collection
+
+
+def encode_cursor(document_id: ObjectId) -> str:
+    return base64.urlsafe_b64encode(document_id.binary).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> ObjectId:
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError, InvalidId):
+        raise Exception("Invalid cursor")
+
+
+def paginate(mongo: Collection, query: dict, to_dict: Callable[[dict], dict], page: int = 0, size: int = 50,
+             cursor: Optional[str] = None, projection: Optional[dict] = None) -> Union[list[dict], dict]:
+    if cursor is None:
+        documents = mongo.find(query, projection).skip(page * size).limit(size)
+        return [to_dict(document) for document in documents]
+
+    if cursor:
+        query = {**query, "_id": {"$gt": decode_cursor(cursor)}}
+
+    documents = list(mongo.find(query, projection).sort("_id", 1).limit(size))
+    return cursor_page(documents, to_dict, size)
+
+
+async def paginate_async(mongo, query: dict, to_dict: Callable[[dict], dict], page: int = 0, size: int = 50,
+                         cursor: Optional[str] = None, projection: Optional[dict] = None) -> Union[list[dict], dict]:
+    if cursor is None:
+        documents = await mongo.find(query, projection).skip(page * size).limit(size).to_list(None)
+        return [to_dict(document) for document in documents]
+
+    if cursor:
+        query = {**query, "_id": {"$gt": decode_cursor(cursor)}}
+
+    documents = await mongo.find(query, projection).sort("_id", 1).limit(size).to_list(None)
+    return cursor_page(documents, to_dict, size)
+
+
+def paginate_aggregate(mongo: Collection, query: dict, stages: list[dict], to_dict: Callable[[dict], Optional[dict]],
+                       page: int = 0, size: int = 50, cursor: Optional[str] = None) -> Union[list[dict], dict]:
+    documents = list(mongo.aggregate(page_pipeline(query, page, size, cursor) + stages))
+    return aggregate_page(documents, to_dict, size, cursor)
+
+
+async def paginate_aggregate_async(mongo, query: dict, stages: list[dict], to_dict: Callable[[dict], Optional[dict]],
+                                   page: int = 0, size: int = 50,
+                                   cursor: Optional[str] = None) -> Union[list[dict], dict]:
+    documents = await (await mongo.aggregate(page_pipeline(query, page, size, cursor) + stages)).to_list(None)
+    return aggregate_page(documents, to_dict, size, cursor)
+
+
+def page_pipeline(query: dict, page: int, size: int, cursor: Optional[str]) -> list[dict]:
+    if cursor is None:
+        pipeline = [{"$match": query}, {"$skip": page * size}]
+    else:
+        if cursor:
+            query = {**query, "_id": {"$gt": decode_cursor(cursor)}}
+        pipeline = [{"$match": query}, {"$sort": {"_id": 1}}]
+
+    if size > 0:
+        pipeline.append({"$limit": size})
+
+    return pipeline
+
+
+def aggregate_page(documents: list[dict], to_dict: Callable[[dict], Optional[dict]], size: int,
+                   cursor: Optional[str]) -> Union[list[dict], dict]:
+    if cursor is None:
+        return [item for item in map(to_dict, documents) if item is not None]
+
+    return cursor_page(documents, to_dict, size)
+
+
+def cursor_page(documents: list[dict], to_dict: Callable[[dict], Optional[dict]], size: int) -> dict:
+    next_cursor = None
+    if size > 0 and len(documents) == size:
+        next_cursor = encode_cursor(documents[-1]["_id"])
+
+    return {
+        "items": [item for item in map(to_dict, documents) if item is not None],
+        "next_cursor": next_cursor,
+    }
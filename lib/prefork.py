@@ -0,0 +1,157 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerRequestHandler(WSGIRequestHandler):
+    # one request per connection, idle keep-alive clients would otherwise pin the bounded thread pool
+    protocol_version = "HTTP/1.0"
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, host: str, port: int, app: Callable, threads: int, fd: int):
+        super().__init__(host, port, app, WorkerRequestHandler, fd=fd)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="request")
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        # a busy worker stops accepting, leaving new connections in the backlog for the other workers
+        self.slots.acquire()
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def drain(self):
+        self.server_close()
+        self.executor.shutdown(wait=True)
+
+
+class PreforkServer:
+    def __init__(self, factory: Callable[[int], tuple[Callable, Callable]], host: str, port: int, workers: int = 0,
+                 threads: int = 8, graceful_timeout: float = 30, backlog: int = 2048):
+        self.factory = factory
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.socket = None
+        self.children = {}
+        self.stopping = False
+
+    def serve(self):
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        self.socket = socket.create_server((self.host, self.port), family=family, backlog=self.backlog)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        logger.info("Listening on %s:%d with %d workers of %d threads", self.host, self.port, self.workers,
+                    self.threads)
+
+        for worker in range(self.workers):
+            self.spawn(worker)
+
+        while not self.stopping:
+            self.reap()
+            time.sleep(0.5)
+
+        self.shutdown()
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def spawn(self, worker: int):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (worker, time.monotonic())
+            return
+
+        code = 0
+        try:
+            self.run_worker(worker)
+        except BaseException:
+            logger.exception("Worker %d failed", worker)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def run_worker(self, worker: int):
+        # the master turns Ctrl+C into a SIGTERM for every worker
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        app, shutdown = self.factory(worker)
+        server = PooledWSGIServer(self.host, self.port, app, self.threads, self.socket.fileno())
+        self.socket.close()
+
+        # shutdown() blocks until serve_forever returns, so it cannot run on the serving thread
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        logger.info("Worker %d serving as pid %d", worker, os.getpid())
+        try:
+            server.serve_forever()
+            server.drain()
+        finally:
+            shutdown()
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if not pid:
+                return
+
+            worker, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+
+            logger.warning("Worker %d (pid %d) exited with %d, restarting", worker, pid,
+                           os.waitstatus_to_exitcode(status))
+            # a worker that dies on startup would otherwise be respawned in a tight loop
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+            self.spawn(worker)
+
+    def shutdown(self):
+        for pid in self.children:
+            self.signal(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+
+        for pid in list(self.children):
+            logger.warning("Worker %d (pid %d) did not drain in time, killing it", self.children[pid][0], pid)
+            self.signal(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            del self.children[pid]
+
+        self.socket.close()
+
+    @staticmethod
+    def signal(pid: int, signum: int):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
@@ -1,2 +1,3 @@
 from .project_service import ProjectService
 from .project_access_service import ProjectAccessService
+from .async_services import AsyncProjectAccessService, AsyncProjectService
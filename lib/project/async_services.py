@@ -0,0 +1,292 @@
+import asyncio
+from typing import Callable, Optional
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from lib.bulk import parse_items, record_write_errors
+from lib.cascade import AsyncCascadeService, deleting_update
+from lib.pagination import paginate_aggregate_async, paginate_async
+from lib.projection import narrow_projection
+
+from .project_access_service import ProjectAccessService
+from .project_service import ProjectService
+
+
+class AsyncProjectAccessService(ProjectAccessService):
+    async def add(self, project_id: str, user_id: str, permissions: list[str], creator_id: str) -> dict:
+        await self.mongo.update_one(self.mapping_query(project_id, user_id), self.grant_update(project_id, user_id, permissions, creator_id), upsert=True)
+        self.permission_cache.invalidate((project_id, user_id))
+
+        return {
+            "project_id": project_id,
+            "user_id": user_id
+        }
+
+    async def delete(self, project_id: str, user_id: str, permissions: list[str]) -> dict:
+        result = await self.mongo.update_one(self.mapping_query(project_id, user_id), self.revoke_update(permissions))
+        self.permission_cache.invalidate((project_id, user_id))
+
+        if result.matched_count == 0:
+            raise Exception("Project access not found")
+
+        return {
+            "project_id": project_id,
+            "user_id": user_id
+        }
+
+    async def delete_all(self, project_id: str, user_id: str) -> dict:
+        result = await self.mongo.delete_one(self.mapping_query(project_id, user_id))
+        self.permission_cache.invalidate((project_id, user_id))
+
+        if result.deleted_count == 0:
+            raise Exception("Project access not found")
+
+        return {
+            "project_id": project_id,
+            "user_id": user_id
+        }
+
+    async def apply_changes(self, project_id: str, changes: dict[int, dict], results: list, creator_id: str):
+        positions, operations = self.change_operations(project_id, changes, creator_id)
+        if operations:
+            try:
+                await self.mongo.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                record_write_errors(e, positions, results, lambda position: "Project access changed concurrently")
+
+        self.invalidate_users(project_id, changes)
+
+    async def copy(self, source_project_id: str, project_id: str, creator_id: str):
+        await self.mongo.aggregate(self.copy_pipeline(source_project_id, project_id, creator_id, self.mongo.name))
+        self.permission_cache.invalidate_prefix((project_id,))
+
+    async def mapped_users(self, project_id: str, user_ids: list[str]) -> set[str]:
+        if not user_ids:
+            return set()
+
+        mappings = await self.mongo.find(self.mapped_query(project_id, user_ids), {"user_id": 1}).to_list(None)
+        return {mapping["user_id"] for mapping in mappings}
+
+    async def fetch_users(self, project_id: str, page: int = 0, size: int = 50,
+                          cursor: str = None) -> list[dict] | dict:
+        return await paginate_async(self.mongo, {
+            "project_id": project_id,
+        }, self.mapping_to_dict("user_id"), page, size, cursor, {"user_id": 1, "permissions": 1})
+
+    async def fetch_projects(self, user_id: str, page: int = 0, size: int = 50,
+                             cursor: str = None) -> list[dict] | dict:
+        return await paginate_async(self.mongo, {
+            "user_id": user_id,
+        }, self.mapping_to_dict("project_id"), page, size, cursor, {"project_id": 1, "permissions": 1})
+
+    async def fetch_joined(self, query: dict, collection, local_field: str, as_field: str,
+                           to_dict: Callable[[dict], dict], page: int = 0, size: int = 50, cursor: str = None,
+                           projection: dict = None) -> list[dict] | dict:
+        return await paginate_aggregate_async(self.mongo, query,
+                                              self.join_stages(collection.name, local_field, as_field, projection),
+                                              self.joined_to_dict(as_field, to_dict), page, size, cursor)
+
+    async def get_permissions(self, project_id: str, user_id: str) -> tuple:
+        key = (project_id, user_id)
+        permissions = self.permission_cache.get(key)
+        if permissions is not None:
+            return permissions
+
+        generation = self.permission_cache.generation
+        mapping = await self.mongo.find_one(self.permissions_query(project_id, user_id), {"permissions": 1})
+
+        return self.cache_permissions(key, mapping, generation)
+
+    async def revoke_project(self, project_id: str):
+        await self.mongo.update_many({"project_id": project_id}, deleting_update())
+        self.permission_cache.invalidate_prefix((project_id,))
+
+    async def has_access(self, project_id: str, user_id: str, permission: str) -> bool:
+        return self.granted(await self.get_permissions(project_id, user_id), permission)
+
+    async def has_any_access(self, project_id: str, user_id: str) -> bool:
+        return self.granted(await self.get_permissions(project_id, user_id), None)
+
+    async def load_with_access(self, project_id: str, user_id: str, permission: Optional[str], collection,
+                               query: dict, projection: dict = None) -> tuple[bool, Optional[dict]]:
+        key = (project_id, user_id)
+        permissions = self.permission_cache.get(key)
+        if permissions is not None:
+            if not self.granted(permissions, permission):
+                return False, None
+
+            return True, await collection.find_one(query, projection)
+
+        generation = self.permission_cache.generation
+        cursor = await self.mongo.aggregate(self.load_pipeline(project_id, user_id, collection.name, query,
+                                                               projection))
+        return self.loaded(key, await cursor.to_list(None), permission, generation)
+
+    async def authorized(self, allowed, result, message: str = "Project not found"):
+        # reads run alongside their access check and are dropped when it fails
+        allowed, result = await asyncio.gather(allowed, result, return_exceptions=True)
+        if isinstance(allowed, BaseException):
+            raise allowed
+        if not allowed:
+            raise Exception(message)
+        if isinstance(result, BaseException):
+            raise result
+
+        return result
+
+
+class AsyncProjectService(ProjectService):
+    cascade_service: AsyncCascadeService
+
+    async def create(self, name: str, creator_id: str, organization_id: str) -> dict:
+        try:
+            result = await self.mongo.insert_one(self.project_document(name, creator_id, organization_id))
+        except DuplicateKeyError:
+            raise Exception(f"Project {name} already exists")
+
+        project_id_str = str(result.inserted_id)
+
+        await self.project_access_service.add(project_id_str, creator_id, ["all"], "")
+
+        return {
+            "id": project_id_str
+        }
+
+    async def fetch(self, requester_id: str, page: int = 0, size: int = 50, cursor: str = None,
+                    fields: list[str] = None) -> list[dict] | dict:
+        return await self.project_access_service.fetch_joined({
+            "user_id": requester_id,
+        }, self.mongo, "project_id", "project", self.to_dict, page, size, cursor,
+            narrow_projection(self.projection, fields))
+
+    async def get(self, project_id: str, requester_id: str) -> dict:
+        allowed, project = await self.project_access_service.load_with_access(
+            project_id, requester_id, None, self.mongo, self.project_query(project_id), self.projection)
+
+        if not allowed:
+            raise Exception("Project not found")
+
+        if not project:
+            raise Exception("Project not found")
+
+        return self.to_dict(project)
+
+    async def update(self, project_id: str, name: str, requester_id: str, organization_id: str) -> dict:
+        if not await self.project_access_service.has_access(project_id, requester_id, "all"):
+            raise Exception("Not allowed")
+
+        try:
+            result = await self.mongo.update_one(self.project_query(project_id), {
+                "$set": self.update_fields(name)
+            })
+        except DuplicateKeyError:
+            raise Exception(f"Project {name} already exists")
+
+        if result.matched_count == 0:
+            raise Exception("Project not found")
+
+        return {
+            "id": project_id
+        }
+
+    async def delete(self, project_id: str, requester_id: str) -> dict:
+        if not await self.project_access_service.has_access(project_id, requester_id, "all"):
+            raise Exception("Not allowed")
+
+        if not self.cascade_service:
+            result = await self.mongo.delete_one(self.project_query(project_id))
+            if result.deleted_count == 0:
+                raise Exception("Project not found")
+
+            return {
+                "id": project_id
+            }
+
+        # the marker hides the project at once, the cascade job removes accesses, infra, machines and finally
+        # the project itself in batches
+        result = await self.mongo.update_one(self.project_query(project_id), deleting_update())
+        if result.matched_count == 0:
+            raise Exception("Project not found")
+
+        await self.project_access_service.revoke_project(project_id)
+        if self.machine_key_service:
+            await self.machine_key_service.revoke_project(project_id)
+
+        await self.cascade_service.enqueue("project", [project_id])
+
+        return {
+            "id": project_id
+        }
+
+    async def add_access(self, project_id: str, user_id: str, permissions: list[str], creator_id: str,
+                         organization_id: str) -> dict:
+        user = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, creator_id, "all"),
+            self.user_service.get_by_organization(user_id, organization_id),
+            "Not allowed",
+        )
+        await self.project_access_service.add(project_id, user["id"], permissions, creator_id)
+
+        return {
+            "project_id": project_id,
+            "user": user,
+            "permissions": permissions
+        }
+
+    async def bulk_access(self, project_id: str, items: list, requester_id: str, organization_id: str) -> dict:
+        results, changes = parse_items(items, self.parse_access_change)
+        users, mapped = await self.project_access_service.authorized(
+            self.project_access_service.has_access(project_id, requester_id, "all"),
+            asyncio.gather(
+                self.user_service.existing([change["user_id"] for change in changes.values() if change["grant"]],
+                                           organization_id),
+                self.project_access_service.mapped_users(project_id, [
+                    change["user_id"] for change in changes.values() if not change["grant"]
+                ]),
+            ),
+            "Not allowed",
+        )
+        changes = self.valid_access_changes(results, changes, users, mapped)
+        await self.project_access_service.apply_changes(project_id, changes, results, requester_id)
+
+        return {
+            "project_id": project_id,
+            "items": results
+        }
+
+    async def copy_access(self, project_id: str, source_project_id: str, requester_id: str) -> dict:
+        allowed = await asyncio.gather(
+            self.project_access_service.has_access(project_id, requester_id, "all"),
+            self.project_access_service.has_access(source_project_id, requester_id, "all"),
+        )
+        if not all(allowed):
+            raise Exception("Not allowed")
+
+        await self.project_access_service.copy(source_project_id, project_id, requester_id)
+
+        return {
+            "project_id": project_id,
+            "source_project_id": source_project_id
+        }
+
+    async def delete_access(self, project_id: str, user_id: str, permissions: list[str], requester_id: str) -> dict:
+        if not await self.project_access_service.has_access(project_id, requester_id, "all"):
+            raise Exception("Not allowed")
+
+        return await self.project_access_service.delete(project_id, user_id, permissions)
+
+    async def delete_all_access(self, project_id: str, user_id: str, requester_id: str) -> dict:
+        if not await self.project_access_service.has_access(project_id, requester_id, "all"):
+            raise Exception("Not allowed")
+
+        return await self.project_access_service.delete_all(project_id, user_id)
+
+    async def fetch_users(self, project_id: str, requester_id: str, page: int = 0, size: int = 50,
+                          cursor: str = None, fields: list[str] = None) -> list[dict] | dict:
+        return await self.project_access_service.authorized(
+            self.project_access_service.has_any_access(project_id, requester_id),
+            self.project_access_service.fetch_joined({
+                "project_id": project_id,
+            }, self.user_service.mongo, "user_id", "user", self.user_service.to_dict, page, size, cursor,
+                narrow_projection(self.user_service.projection, fields)),
+        )
@@ -1,31 +1,30 @@
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, UpdateOne
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 from datetime import datetime
+from typing import Callable, Optional
+
+from lib.bulk import record_write_errors
+from lib.cache import LruCache
+from lib.cascade import NOT_DELETING, deleting_update
+from lib.pagination import paginate, paginate_aggregate
 
 
 class ProjectAccessService:
-    def __init__(self, mongo: Collection):
+    indexes = [
+        IndexModel([("project_id", ASCENDING), ("user_id", ASCENDING)], name="project_id_user_id", unique=True),
+        IndexModel([("project_id", ASCENDING), ("_id", ASCENDING)], name="project_id__id"),
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="user_id__id"),
+    ]
+
+    def __init__(self, mongo: Collection, permission_cache: LruCache = None):
         self.mongo = mongo
+        self.permission_cache = permission_cache if permission_cache is not None else LruCache()
 
     def add(self, project_id: str, user_id: str, permissions: list[str], creator_id: str) -> dict:
-        self.mongo.update_one({
-            "project_id": project_id,
-            "user_id": user_id,
-        }, {
-            "$setOnInsert": {
-                "project_id": project_id,
-                "user_id": user_id,
-                "creator_id": creator_id,
-                "created_at": datetime.now()
-            },
-            "$addToSet": {
-                "permissions": {
-                    "$each": permissions
-                }
-            },
-            "$set": {
-                "updated_at": datetime.now(),
-            }
-        }, upsert=True)
+        self.mongo.update_one(self.mapping_query(project_id, user_id), self.grant_update(project_id, user_id, permissions, creator_id), upsert=True)
+        self.permission_cache.invalidate((project_id, user_id))
 
         return {
             "project_id": project_id,
@@ -33,17 +32,8 @@ class ProjectAccessService:
         }
 
     def delete(self, project_id: str, user_id: str, permissions: list[str]) -> dict:
-        result = self.mongo.update_one({
-            "project_id": project_id,
-            "user_id": user_id,
-        }, {
-            "$set": {
-                "updated_at": datetime.now(),
-            },
-            "$pullAll": {
-                "permissions": permissions
-            }
-        })
+        result = self.mongo.update_one(self.mapping_query(project_id, user_id), self.revoke_update(permissions))
+        self.permission_cache.invalidate((project_id, user_id))
 
         if result.matched_count == 0:
             raise Exception("Project access not found")
@@ -54,10 +44,8 @@ class ProjectAccessService:
         }
 
     def delete_all(self, project_id: str, user_id: str) -> dict:
-        result = self.mongo.delete_one({
-            "project_id": project_id,
-            "user_id": user_id
-        })
+        result = self.mongo.delete_one(self.mapping_query(project_id, user_id))
+        self.permission_cache.invalidate((project_id, user_id))
 
         if result.deleted_count == 0:
             raise Exception("Project access not found")
@@ -67,48 +55,272 @@ class ProjectAccessService:
             "user_id": user_id
         }
 
-    def fetch_users(self, project_id: str, page: int = 0, size: int = 50) -> list[dict]:
-        mappings = self.mongo.find({
-            "project_id": project_id,
-        }).skip(page * size).limit(size)
+    def apply_changes(self, project_id: str, changes: dict[int, dict], results: list, creator_id: str):
+        positions, operations = self.change_operations(project_id, changes, creator_id)
+        if operations:
+            try:
+                self.mongo.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                record_write_errors(e, positions, results, lambda position: "Project access changed concurrently")
+
+        self.invalidate_users(project_id, changes)
+
+    def copy(self, source_project_id: str, project_id: str, creator_id: str):
+        self.mongo.aggregate(self.copy_pipeline(source_project_id, project_id, creator_id, self.mongo.name))
+        self.permission_cache.invalidate_prefix((project_id,))
+
+    def mapped_users(self, project_id: str, user_ids: list[str]) -> set[str]:
+        if not user_ids:
+            return set()
 
-        result = []
+        mappings = self.mongo.find(self.mapped_query(project_id, user_ids), {"user_id": 1})
+        return {mapping["user_id"] for mapping in mappings}
+
+    def invalidate_mappings(self, mappings: list[dict]):
         for mapping in mappings:
-            result.append({
-                "user_id": mapping["user_id"],
-                "permissions": mapping["permissions"]
-            })
+            self.permission_cache.invalidate((mapping["project_id"], mapping["user_id"]))
+
+    def invalidate_users(self, project_id: str, changes: dict[int, dict]):
+        for user_id in {change["user_id"] for change in changes.values()}:
+            self.permission_cache.invalidate((project_id, user_id))
 
-        return result
+    def fetch_users(self, project_id: str, page: int = 0, size: int = 50, cursor: str = None) -> list[dict] | dict:
+        return paginate(self.mongo, {
+            "project_id": project_id,
+        }, self.mapping_to_dict("user_id"), page, size, cursor, {"user_id": 1, "permissions": 1})
 
-    def fetch_projects(self, user_id: str, page: int = 0, size: int = 50) -> list[dict]:
-        mappings = self.mongo.find({
+    def fetch_projects(self, user_id: str, page: int = 0, size: int = 50, cursor: str = None) -> list[dict] | dict:
+        return paginate(self.mongo, {
             "user_id": user_id,
-        }).skip(page * size).limit(size)
+        }, self.mapping_to_dict("project_id"), page, size, cursor, {"project_id": 1, "permissions": 1})
 
-        result = []
-        for mapping in mappings:
-            result.append({
-                "project_id": mapping["project_id"],
-                "permissions": mapping["permissions"]
-            })
+    def fetch_joined(self, query: dict, collection: Collection, local_field: str, as_field: str,
+                     to_dict: Callable[[dict], dict], page: int = 0, size: int = 50, cursor: str = None,
+                     projection: dict = None) -> list[dict] | dict:
+        return paginate_aggregate(self.mongo, query, self.join_stages(collection.name, local_field, as_field, projection),
+                                  self.joined_to_dict(as_field, to_dict), page, size, cursor)
+
+    def get_permissions(self, project_id: str, user_id: str) -> tuple:
+        key = (project_id, user_id)
+        permissions = self.permission_cache.get(key)
+        if permissions is not None:
+            return permissions
+
+        generation = self.permission_cache.generation
+        mapping = self.mongo.find_one(self.permissions_query(project_id, user_id), {"permissions": 1})
 
-        return result
+        return self.cache_permissions(key, mapping, generation)
 
-    def has_access(self, project_id: str, user_id: str, permission: str):
-        return self.mongo.count_documents({
+    @staticmethod
+    def mapping_query(project_id: str, user_id: str) -> dict:
+        return {
             "project_id": project_id,
             "user_id": user_id,
-            "permissions": {"$in": [permission, "all"]}
-        }) > 0
+        }
 
-    def has_any_access(self, project_id: str, user_id: str) -> bool:
-        return self.mongo.count_documents({
+    @staticmethod
+    def permissions_query(project_id: str, user_id: str) -> dict:
+        return {
             "project_id": project_id,
             "user_id": user_id,
-            "permissions": {
-                "$not": {
-                    "$size": 0
+            **NOT_DELETING,
+        }
+
+    @staticmethod
+    def mapped_query(project_id: str, user_ids: list[str]) -> dict:
+        return {
+            "project_id": project_id,
+            "user_id": {"$in": user_ids},
+        }
+
+    def revoke_project(self, project_id: str):
+        # the project's cascade job removes these rows, until then they grant nothing
+        self.mongo.update_many({"project_id": project_id}, deleting_update())
+        self.permission_cache.invalidate_prefix((project_id,))
+
+    def has_access(self, project_id: str, user_id: str, permission: str) -> bool:
+        return self.granted(self.get_permissions(project_id, user_id), permission)
+
+    def has_any_access(self, project_id: str, user_id: str) -> bool:
+        return self.granted(self.get_permissions(project_id, user_id), None)
+
+    def load_with_access(self, project_id: str, user_id: str, permission: Optional[str], collection: Collection,
+                         query: dict, projection: dict = None) -> tuple[bool, Optional[dict]]:
+        key = (project_id, user_id)
+        permissions = self.permission_cache.get(key)
+        if permissions is not None:
+            if not self.granted(permissions, permission):
+                return False, None
+
+            return True, collection.find_one(query, projection)
+
+        generation = self.permission_cache.generation
+        mappings = list(self.mongo.aggregate(self.load_pipeline(project_id, user_id, collection.name, query,
+                                                                projection)))
+        return self.loaded(key, mappings, permission, generation)
+
+    def cache_permissions(self, key: tuple, mapping: Optional[dict], generation: int) -> tuple:
+        permissions = tuple(mapping.get("permissions") or ()) if mapping else ()
+        self.permission_cache.set(key, permissions, generation=generation)
+        return permissions
+
+    def loaded(self, key: tuple, mappings: list[dict], permission: Optional[str],
+               generation: int) -> tuple[bool, Optional[dict]]:
+        mapping = mappings[0] if mappings else None
+        permissions = self.cache_permissions(key, mapping, generation)
+
+        if not self.granted(permissions, permission):
+            return False, None
+
+        documents = mapping["documents"]
+        return True, documents[0] if documents else None
+
+    @staticmethod
+    def load_pipeline(project_id: str, user_id: str, collection_name: str, query: dict,
+                      projection: dict = None) -> list[dict]:
+        # check the access row and load the document in one round trip, rows of a deleted project carry its marker
+        pipeline = [{"$match": query}, {"$limit": 1}]
+        if projection:
+            pipeline.append({"$project": projection})
+
+        return [
+            {"$match": {
+                "project_id": project_id,
+                "user_id": user_id,
+                **NOT_DELETING,
+            }},
+            {"$limit": 1},
+            {"$lookup": {
+                "from": collection_name,
+                "pipeline": pipeline,
+                "as": "documents",
+            }},
+            {"$project": {
+                "permissions": 1,
+                "documents": 1,
+            }},
+        ]
+
+    @staticmethod
+    def join_stages(collection_name: str, local_field: str, as_field: str, projection: dict = None) -> list[dict]:
+        # projects and users being deleted drop out of listings
+        pipeline = [{"$match": {"$expr": {"$eq": ["$_id", "$$id"]}, **NOT_DELETING}}]
+        if projection:
+            pipeline.append({"$project": projection})
+
+        return [
+            {"$lookup": {
+                "from": collection_name,
+                "let": {"id": {"$convert": {"input": f"${local_field}", "to": "objectId", "onError": None}}},
+                "pipeline": pipeline,
+                "as": as_field,
+            }},
+            {"$project": {
+                "permissions": 1,
+                as_field: {"$arrayElemAt": [f"${as_field}", 0]},
+            }},
+        ]
+
+    @staticmethod
+    def joined_to_dict(as_field: str, to_dict: Callable[[dict], dict]) -> Callable[[dict], Optional[dict]]:
+        # access rows whose project or user no longer exists are skipped rather than failing the page
+        return lambda mapping: {
+            "permissions": mapping["permissions"],
+            as_field: to_dict(mapping[as_field]),
+        } if as_field in mapping else None
+
+    @staticmethod
+    def mapping_to_dict(field: str) -> Callable[[dict], dict]:
+        return lambda mapping: {
+            field: mapping[field],
+            "permissions": mapping["permissions"]
+        }
+
+    @staticmethod
+    def grant_update(project_id: str, user_id: str, permissions: list[str], creator_id: str) -> dict:
+        return {
+            "$setOnInsert": {
+                "project_id": project_id,
+                "user_id": user_id,
+                "creator_id": creator_id,
+                "created_at": datetime.now()
+            },
+            "$addToSet": {
+                "permissions": {
+                    "$each": permissions
                 }
+            },
+            "$set": {
+                "updated_at": datetime.now(),
             }
-        }) > 0
+        }
+
+    @staticmethod
+    def revoke_update(permissions: list[str]) -> dict:
+        return {
+            "$set": {
+                "updated_at": datetime.now(),
+            },
+            "$pullAll": {
+                "permissions": permissions
+            }
+        }
+
+    @staticmethod
+    def change_operations(project_id: str, changes: dict[int, dict], creator_id: str) -> tuple[list[int], list]:
+        positions = []
+        operations = []
+        for position, change in changes.items():
+            query = {
+                "project_id": project_id,
+                "user_id": change["user_id"],
+            }
+
+            # grants and revokes of one user never overlap, so the unordered writes can land in any order
+            if change["grant"]:
+                positions.append(position)
+                operations.append(UpdateOne(query, ProjectAccessService.grant_update(
+                    project_id, change["user_id"], change["grant"], creator_id), upsert=True))
+            if change["revoke"]:
+                positions.append(position)
+                operations.append(UpdateOne(query, ProjectAccessService.revoke_update(change["revoke"])))
+
+        return positions, operations
+
+    @staticmethod
+    def copy_pipeline(source_project_id: str, project_id: str, creator_id: str, collection_name: str) -> list[dict]:
+        now = datetime.now()
+        return [
+            {"$match": {
+                "project_id": source_project_id,
+            }},
+            {"$project": {
+                "_id": 0,
+                "project_id": {"$literal": project_id},
+                "user_id": 1,
+                "permissions": 1,
+                "creator_id": {"$literal": creator_id},
+                "created_at": {"$literal": now},
+                "updated_at": {"$literal": now},
+            }},
+            # existing members keep their permissions and gain the source project's
+            {"$merge": {
+                "into": collection_name,
+                "on": ["project_id", "user_id"],
+                "whenMatched": [{"$set": {
+                    "permissions": {"$setUnion": [{"$ifNull": ["$permissions", []]}, "$$new.permissions"]},
+                    "updated_at": "$$new.updated_at",
+                }}],
+                "whenNotMatched": "insert",
+            }},
+        ]
+
+    @staticmethod
+    def granted(permissions: tuple, permission: Optional[str]) -> bool:
+        if permission is None:
+            return len(permissions) > 0
+
+        return permission in permissions or "all" in permissions
+
+    def cache_stats(self) -> dict:
+        return self.permission_cache.stats()
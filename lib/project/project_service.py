@@ -1,29 +1,43 @@
 from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
 from pymongo.collection import Collection
 from datetime import datetime
 from .project_access_service import ProjectAccessService
+from lib.bulk import failure, item_param, parse_items
+from lib.cascade import NOT_DELETING, CascadeService, deleting_update
 from lib.identity import UserService
+from lib.projection import document_to_dict, narrow_projection
 
 
 class ProjectService:
-
-    def __init__(self, mongo: Collection, project_access_service: ProjectAccessService, user_service: UserService):
+    public_fields = [
+        "name",
+        "creator_id",
+        "organization_id",
+        "created_at",
+        "updated_at",
+    ]
+    projection = dict.fromkeys(public_fields, 1)
+
+    indexes = [
+        IndexModel([("organization_id", ASCENDING), ("name", ASCENDING)], name="organization_id_name", unique=True),
+    ]
+
+    def __init__(self, mongo: Collection, project_access_service: ProjectAccessService, user_service: UserService,
+                 cascade_service: CascadeService = None, machine_key_service=None):
         self.mongo = mongo
         self.project_access_service = project_access_service
         self.user_service = user_service
+        self.cascade_service = cascade_service
+        self.machine_key_service = machine_key_service
 
     def create(self, name: str, creator_id: str, organization_id: str) -> dict:
-        if self.name_exists(name, organization_id):
+        try:
+            project_id = self.mongo.insert_one(self.project_document(name, creator_id, organization_id)).inserted_id
+        except DuplicateKeyError:
             raise Exception(f"Project {name} already exists")
 
-        project_id = self.mongo.insert_one({
-            "name": name,
-            "creator_id": creator_id,
-            "organization_id": organization_id,
-            "created_at": datetime.now(),
-            "updated_at": datetime.now(),
-        }).inserted_id
-
         project_id_str = str(project_id)
 
         self.project_access_service.add(project_id_str, creator_id, ["all"], "")
@@ -32,35 +46,20 @@ class ProjectService:
             "id": project_id_str
         }
 
-    def fetch(self, requester_id: str, page: int = 0, size: int = 50) -> list[dict]:
-        mappings = self.project_access_service.fetch_projects(requester_id, page, size)
-        project_ids = []
-        for mapping in mappings:
-            project_ids.append(ObjectId(mapping["project_id"]))
-
-        projects = self.mongo.find({
-            "_id": {"$in": project_ids}
-        })
-
-        project_map = {}
-        for project in projects:
-            p = self.to_dict(project)
-            project_map[p["id"]] = p
-
-        result = []
-        for mapping in mappings:
-            result.append({
-                "permissions": mapping["permissions"],
-                "project": project_map[mapping["project_id"]],
-            })
-
-        return result
+    def fetch(self, requester_id: str, page: int = 0, size: int = 50, cursor: str = None,
+              fields: list[str] = None) -> list[dict] | dict:
+        return self.project_access_service.fetch_joined({
+            "user_id": requester_id,
+        }, self.mongo, "project_id", "project", self.to_dict, page, size, cursor,
+            narrow_projection(self.projection, fields))
 
     def get(self, project_id: str, requester_id: str) -> dict:
-        if not self.project_access_service.has_any_access(project_id, requester_id):
-            raise Exception("Project not found")
+        allowed, project = self.project_access_service.load_with_access(project_id, requester_id, None, self.mongo,
+                                                                        self.project_query(project_id),
+                                                                        self.projection)
 
-        project = self.mongo.find_one({"_id": ObjectId(project_id)})
+        if not allowed:
+            raise Exception("Project not found")
 
         if not project:
             raise Exception("Project not found")
@@ -71,25 +70,12 @@ class ProjectService:
         if not self.project_access_service.has_access(project_id, requester_id, "all"):
             raise Exception("Not allowed")
 
-        fields = {
-            "updated_at": datetime.now(),
-        }
-
-        if name:
-            if self.mongo.count_documents({
-                "_id": {"$ne": ObjectId(project_id)},
-                "name": name,
-                "organization_id": organization_id
-            }) != 0:
-                raise Exception(f"Project {name} already exists")
-
-            fields["name"] = name
-
-        result = self.mongo.update_one({
-            "_id": ObjectId(project_id),
-        }, {
-            "$set": fields
-        })
+        try:
+            result = self.mongo.update_one(self.project_query(project_id), {
+                "$set": self.update_fields(name)
+            })
+        except DuplicateKeyError:
+            raise Exception(f"Project {name} already exists")
 
         if result.matched_count == 0:
             raise Exception("Project not found")
@@ -102,10 +88,28 @@ class ProjectService:
         if not self.project_access_service.has_access(project_id, requester_id, "all"):
             raise Exception("Not allowed")
 
-        result = self.mongo.delete_one({"_id": ObjectId(project_id)})
-        if result.deleted_count == 0:
+        if not self.cascade_service:
+            result = self.mongo.delete_one(self.project_query(project_id))
+            if result.deleted_count == 0:
+                raise Exception("Project not found")
+
+            return {
+                "id": project_id
+            }
+
+        # the marker hides the project at once, the cascade job removes accesses, infra, machines and finally
+        # the project itself in batches
+        result = self.mongo.update_one(self.project_query(project_id), deleting_update())
+        if result.matched_count == 0:
             raise Exception("Project not found")
 
+        # access rows and keys take the marker too, so permission and key lookups drop them in their own query
+        self.project_access_service.revoke_project(project_id)
+        if self.machine_key_service:
+            self.machine_key_service.revoke_project(project_id)
+
+        self.cascade_service.enqueue("project", [project_id])
+
         return {
             "id": project_id
         }
@@ -123,6 +127,38 @@ class ProjectService:
             "permissions": permissions
         }
 
+    def bulk_access(self, project_id: str, items: list, requester_id: str, organization_id: str) -> dict:
+        if not self.project_access_service.has_access(project_id, requester_id, "all"):
+            raise Exception("Not allowed")
+
+        results, changes = parse_items(items, self.parse_access_change)
+        users = self.user_service.existing([change["user_id"] for change in changes.values() if change["grant"]],
+                                           organization_id)
+        mapped = self.project_access_service.mapped_users(project_id, [
+            change["user_id"] for change in changes.values() if not change["grant"]
+        ])
+        changes = self.valid_access_changes(results, changes, users, mapped)
+        self.project_access_service.apply_changes(project_id, changes, results, requester_id)
+
+        return {
+            "project_id": project_id,
+            "items": results
+        }
+
+    def copy_access(self, project_id: str, source_project_id: str, requester_id: str) -> dict:
+        if not self.project_access_service.has_access(project_id, requester_id, "all"):
+            raise Exception("Not allowed")
+
+        if not self.project_access_service.has_access(source_project_id, requester_id, "all"):
+            raise Exception("Not allowed")
+
+        self.project_access_service.copy(source_project_id, project_id, requester_id)
+
+        return {
+            "project_id": project_id,
+            "source_project_id": source_project_id
+        }
+
     def delete_access(self, project_id: str, user_id: str, permissions: list[str], requester_id: str) -> dict:
         if not self.project_access_service.has_access(project_id, requester_id, "all"):
             raise Exception("Not allowed")
@@ -135,42 +171,81 @@ class ProjectService:
 
         return self.project_access_service.delete_all(project_id, user_id)
 
-    def fetch_users(self, project_id: str, requester_id: str, page: int = 0, size: int = 50) -> list[dict]:
+    def fetch_users(self, project_id: str, requester_id: str, page: int = 0, size: int = 50,
+                    cursor: str = None, fields: list[str] = None) -> list[dict] | dict:
         if not self.project_access_service.has_any_access(project_id, requester_id):
             raise Exception("Project not found")
 
-        mappings = self.project_access_service.fetch_users(project_id, page, size)
+        return self.project_access_service.fetch_joined({
+            "project_id": project_id,
+        }, self.user_service.mongo, "user_id", "user", self.user_service.to_dict, page, size, cursor,
+            narrow_projection(self.user_service.projection, fields))
+
+    @staticmethod
+    def project_document(name: str, creator_id: str, organization_id: str) -> dict:
+        return {
+            "name": name,
+            "creator_id": creator_id,
+            "organization_id": organization_id,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+        }
+
+    @staticmethod
+    def project_query(project_id: str) -> dict:
+        return {
+            "_id": ObjectId(project_id),
+            **NOT_DELETING,
+        }
+
+    @staticmethod
+    def update_fields(name: str) -> dict:
+        fields = {
+            "updated_at": datetime.now(),
+        }
 
-        user_ids = []
-        for mapping in mappings:
-            user_ids.append(mapping["user_id"])
+        if name:
+            fields["name"] = name
 
-        users = self.user_service.fetch_by_ids(user_ids)
-        user_map = {}
-        for user in users:
-            user_map[user["id"]] = user
+        return fields
 
-        result = []
-        for mapping in mappings:
-            result.append({
-                "permissions": mapping["permissions"],
-                "user": user_map[mapping["user_id"]],
-            })
-        return result
+    @staticmethod
+    def parse_access_change(item) -> dict:
+        change = {
+            "user_id": item_param(item, "user_id"),
+            "grant": item_param(item, "grant", list, required=False) or [],
+            "revoke": item_param(item, "revoke", list, required=False) or [],
+        }
 
-    def name_exists(self, name: str, organization_id: str) -> bool:
-        return self.mongo.count_documents({
-            "name": name,
-            "organization_id": organization_id
-        }) > 0
+        if not change["grant"] and not change["revoke"]:
+            raise Exception("grant or revoke is required")
+        if not all(isinstance(permission, str) for permission in change["grant"] + change["revoke"]):
+            raise Exception("Invalid data type for value of permissions")
+        if set(change["grant"]) & set(change["revoke"]):
+            raise Exception("A permission cannot be granted and revoked at once")
+
+        return change
+
+    @staticmethod
+    def valid_access_changes(results: list, changes: dict[int, dict], users: set[str],
+                             mapped: set[str]) -> dict[int, dict]:
+        valid = {}
+        seen = set()
+        for position, change in changes.items():
+            user_id = change["user_id"]
+            if user_id in seen:
+                results[position] = {"user_id": user_id, **failure("User is listed more than once")}
+            elif change["grant"] and user_id not in users:
+                results[position] = {"user_id": user_id, **failure("User not found")}
+            elif not change["grant"] and user_id not in mapped:
+                results[position] = {"user_id": user_id, **failure("Project access not found")}
+            else:
+                valid[position] = change
+                results[position] = {"user_id": user_id, "success": True}
+            seen.add(user_id)
+
+        return valid
 
     @staticmethod
     def to_dict(self):
-        return {
-            "id": str(self["_id"]),
-            "name": self["name"],
-            "creator_id": self["creator_id"],
-            "organization_id": self["organization_id"],
-            "created_at": self["created_at"],
-            "updated_at": self["updated_at"],
-        }
+        return document_to_dict(self, ProjectService.public_fields)
@@ -0,0 +1,26 @@
+from typing import Optional
+
+
+def document_to_dict(document: dict, fields: list[str]) -> dict:
+    result = {
+        "id": str(document["_id"]),
+    }
+
+    for field in fields:
+        if field in document:
+            result[field] = document[field]
+
+    return result
+
+
+def narrow_projection(projection: dict, fields: Optional[list[str]]) -> dict:
+    if not fields:
+        return projection
+
+    for field in fields:
+        if field != "id" and field not in projection:
+            raise Exception(f"Unknown field {field}")
+
+    narrowed = {field: 1 for field in fields if field in projection}
+    # an empty projection would return whole documents, so ask for _id alone instead
+    return narrowed or {"_id": 1}
@@ -0,0 +1,235 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Iterator
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.database import Database
+
+from lib.cascade import CascadeService
+from lib.identity.organization_service import OrganizationService
+
+logger = logging.getLogger(__name__)
+
+REFERENCES = [
+    # regions are checked before data centers so data centers of orphaned regions are caught in the same run
+    ("project_accesses", "project_id", "projects"),
+    ("project_accesses", "user_id", "users"),
+    ("machine_keys", "project_id", "projects"),
+    ("regions", "project_id", "projects"),
+    ("data_centers", "project_id", "projects"),
+    ("data_centers", "region_id", "regions"),
+    ("machines", "project_id", "projects"),
+]
+
+DELETING = [
+    # deletes mark the parent before enqueueing its job, a crash in between leaves it marked with no job
+    ("projects", "project", []),
+    ("regions", "region", ["project_id"]),
+    ("users", "user", []),
+]
+
+
+class Reconciler:
+    def __init__(self, db: Database, batch_size: int = 1000, pause: float = 0.05, interval: float = 0,
+                 delete: bool = False, hooks: dict[str, tuple[dict, Callable[[list[dict]], None]]] = None,
+                 grace: float = 3600):
+        self.db = db
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.grace = grace
+        self.delete = delete
+        self.hooks = hooks or {}
+        self.organization_service = OrganizationService(db.organizations)
+        self.runs = 0
+        self.orphaned = 0
+        self.deleted = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread or not self.interval:
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="orphan-reconciler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                report = self.reconcile(self.delete)
+            except Exception:
+                logger.exception("Failed to reconcile orphans")
+                continue
+
+            for reference, counts in report.items():
+                if counts["orphaned"]:
+                    logger.warning("Found %d orphans in %s, deleted %d", counts["orphaned"], reference,
+                                   counts["deleted"])
+
+    def reconcile(self, delete: bool = False) -> dict:
+        report = {}
+        for collection_name, field, parent_name in REFERENCES:
+            if self.stopped.is_set():
+                break
+
+            report[f"{collection_name}.{field}"] = self.check(collection_name, field, parent_name, delete)
+
+        if not self.stopped.is_set():
+            report["users.founded_organization"] = self.check_founders(delete)
+
+        for collection_name, kind, scope_fields in DELETING:
+            if self.stopped.is_set():
+                break
+
+            report[f"{collection_name}.deleting"] = self.check_deleting(collection_name, kind, scope_fields, delete)
+
+        self.runs += 1
+        return report
+
+    def check(self, collection_name: str, field: str, parent_name: str, delete: bool) -> dict:
+        collection = self.db[collection_name]
+        projection = {field: 1, **self.hooks.get(collection_name, ({}, None))[0]}
+        counts = self.counts()
+
+        for documents in self.scan(collection, {}, projection, counts):
+            missing = self.missing_parents(parent_name, {document.get(field) for document in documents})
+            orphans = [document for document in documents if document.get(field) in missing]
+            if len(counts["missing"]) < 20:
+                counts["missing"] = sorted(set(counts["missing"]) | {str(parent_id) for parent_id in missing})[:20]
+
+            self.settle(collection, orphans, counts, delete)
+
+        return counts
+
+    def check_founders(self, delete: bool) -> dict:
+        counts = self.counts()
+        # sign-up inserts the founding user before its organization, recent ones may still be writing it
+        query = {
+            "founded_organization": {"$type": "string"},
+            "created_at": {"$lt": datetime.now() - timedelta(seconds=self.grace)},
+        }
+
+        for documents in self.scan(self.db.users, query, {"organization_id": 1, "founded_organization": 1}, counts):
+            missing = self.missing_parents("organizations", {document["organization_id"] for document in documents})
+            founders = [document for document in documents if document["organization_id"] in missing]
+            if len(counts["missing"]) < 20:
+                counts["missing"] = sorted(set(counts["missing"]) | missing)[:20]
+
+            counts["orphaned"] += len(founders)
+            self.orphaned += len(founders)
+            if not delete or not founders:
+                continue
+
+            # "deleted" counts the organizations restored and the founders removed because their name was taken
+            # by an organization from before sign-up claims
+            stray = [founder for founder in founders if not self.organization_service.create(
+                founder["founded_organization"], str(founder["_id"]), ObjectId(founder["organization_id"]))]
+            if stray:
+                self.db.users.delete_many({"_id": {"$in": [founder["_id"] for founder in stray]}})
+
+            counts["deleted"] += len(founders)
+            self.deleted += len(founders)
+
+        return counts
+
+    def check_deleting(self, collection_name: str, kind: str, scope_fields: list[str], delete: bool) -> dict:
+        counts = self.counts()
+        query = {
+            "deleting": True,
+            "deleting_at": {"$lt": datetime.now() - timedelta(seconds=self.grace)},
+        }
+
+        projection = {"_id": 1, **dict.fromkeys(scope_fields, 1)}
+
+        for documents in self.scan(self.db[collection_name], query, projection, counts):
+            target_ids = [str(document["_id"]) for document in documents]
+            queued = set(self.db.cascade_jobs.distinct("target_id", {
+                "kind": kind,
+                "target_id": {"$in": target_ids},
+                "state": {"$ne": "done"},
+            }))
+            stalled = [document for document in documents if str(document["_id"]) not in queued]
+            counts["orphaned"] += len(stalled)
+            if len(counts["missing"]) < 20:
+                counts["missing"] = (counts["missing"] + [str(document["_id"]) for document in stalled])[:20]
+
+            # "deleted" counts the jobs enqueued again, the cascade job removes the parent itself
+            if delete and stalled:
+                self.db.cascade_jobs.insert_many([
+                    CascadeService.job_document(kind, str(document["_id"]),
+                                                {field: document[field] for field in scope_fields})
+                    for document in stalled
+                ])
+                counts["deleted"] += len(stalled)
+
+        return counts
+
+    def scan(self, collection, query: dict, projection: dict, counts: dict) -> Iterator[list[dict]]:
+        last_id = None
+        while not self.stopped.is_set():
+            # keyset batches over _id, so no cursor stays open across the pauses
+            batch_query = {**query, "_id": {"$gt": last_id}} if last_id else query
+            documents = list(collection.find(batch_query, projection).sort("_id", ASCENDING).limit(self.batch_size))
+            if not documents:
+                return
+
+            last_id = documents[-1]["_id"]
+            counts["scanned"] += len(documents)
+            yield documents
+
+            if len(documents) < self.batch_size:
+                return
+
+            if self.pause:
+                self.stopped.wait(self.pause)
+
+    def settle(self, collection, orphans: list[dict], counts: dict, delete: bool):
+        counts["orphaned"] += len(orphans)
+        self.orphaned += len(orphans)
+        if not delete or not orphans:
+            return
+
+        deleted = collection.delete_many({
+            "_id": {"$in": [document["_id"] for document in orphans]},
+        }).deleted_count
+        counts["deleted"] += deleted
+        self.deleted += deleted
+
+        hook = self.hooks.get(collection.name, ({}, None))[1]
+        if hook:
+            hook(orphans)
+
+    def missing_parents(self, parent_name: str, parent_ids: set) -> set:
+        valid = {parent_id for parent_id in parent_ids if isinstance(parent_id, str) and ObjectId.is_valid(parent_id)}
+        found = self.db[parent_name].find({
+            "_id": {"$in": [ObjectId(parent_id) for parent_id in valid]},
+        }, {"_id": 1})
+        return parent_ids - {str(parent["_id"]) for parent in found}
+
+    @staticmethod
+    def counts() -> dict:
+        return {
+            "scanned": 0,
+            "orphaned": 0,
+            "deleted": 0,
+            "missing": [],
+        }
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "orphaned": self.orphaned,
+            "deleted": self.deleted,
+        }
@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from typing import Optional
+
+from pymongo import MongoClient, monitoring
+
+FILTER_FIELDS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+    "aggregate": "pipeline",
+    "update": "updates",
+    "delete": "deletes",
+}
+SESSION_FIELDS = ["lsid", "$db", "$clusterTime", "$readPreference", "txnNumber", "autocommit", "startTransaction"]
+SKIPPED_MODULES = ["lib.slow_queries", "lib.metrics", "lib.pagination"]
+
+
+class SlowQueryLog(monitoring.CommandListener):
+    def __init__(self, threshold_ms: float = 100, path: str = "slow_queries.log", explain_per_minute: int = 6,
+                 max_bytes: int = 10 * 1024 * 1024, backups: int = 5, worker: int = None):
+        self.threshold = threshold_ms / 1000
+        self.explain_per_minute = explain_per_minute
+        self.client: Optional[MongoClient] = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.explained = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slow-query-explain")
+
+        self.logger = logging.getLogger("controller.slow_queries")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.handler = None
+        # a handler inherited from the master or an earlier app would share the file with other processes
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+
+        if path:
+            # rotation is only safe with one writer, so each prefork worker gets its own file
+            if worker is not None:
+                root, extension = os.path.splitext(path)
+                path = f"{root}.{worker}{extension}"
+            self.handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, delay=True)
+            self.handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(self.handler)
+
+    def attach(self, client: MongoClient):
+        self.client = client
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name not in FILTER_FIELDS:
+            return
+
+        with self.lock:
+            self.pending[(event.connection_id, event.request_id)] = (event.database_name, event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self.record(event, "success")
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self.record(event, "failure")
+
+    def record(self, event, outcome: str):
+        if event.command_name not in FILTER_FIELDS:
+            return
+
+        with self.lock:
+            started = self.pending.pop((event.connection_id, event.request_id), None)
+
+        seconds = event.duration_micros / 1000000
+        if started is None or seconds < self.threshold:
+            return
+
+        database_name, command = started
+        entry = {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "duration_ms": round(seconds * 1000, 3),
+            "outcome": outcome,
+            "database": database_name,
+            "collection": command.get(event.command_name),
+            "command": event.command_name,
+            "filter": self.redact(command.get(FILTER_FIELDS[event.command_name])),
+            "caller": self.caller(),
+        }
+
+        if self.sample_explain():
+            self.executor.submit(self.explain, entry, database_name, command)
+        else:
+            self.write(entry)
+
+    def sample_explain(self) -> bool:
+        if self.client is None or self.explain_per_minute <= 0:
+            return False
+
+        now = time.monotonic()
+        with self.lock:
+            while self.explained and self.explained[0] <= now - 60:
+                self.explained.popleft()
+            if len(self.explained) >= self.explain_per_minute:
+                return False
+            self.explained.append(now)
+            return True
+
+    def explain(self, entry: dict, database_name: str, command: dict):
+        # explain is not in FILTER_FIELDS, so these commands never re-enter the log
+        command = {key: value for key, value in command.items() if key not in SESSION_FIELDS}
+        try:
+            result = self.client[database_name].command("explain", command, verbosity="executionStats")
+            stats = result.get("executionStats", {})
+            entry["plan"] = {
+                "winning_plan": self.plan_stages(result.get("queryPlanner", {}).get("winningPlan", {})),
+                "returned": stats.get("nReturned"),
+                "keys_examined": stats.get("totalKeysExamined"),
+                "docs_examined": stats.get("totalDocsExamined"),
+                "execution_ms": stats.get("executionTimeMillis"),
+            }
+        except Exception as e:
+            entry["plan"] = {"error": str(e)}
+
+        self.write(entry)
+
+    def write(self, entry: dict):
+        self.logger.info(json.dumps(entry, default=str))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        if self.handler:
+            self.logger.removeHandler(self.handler)
+            self.handler.close()
+
+    @staticmethod
+    def caller() -> Optional[str]:
+        frame = sys._getframe(1)
+        while frame is not None:
+            module = frame.f_globals.get("__name__", "")
+            if module.startswith("lib.") and module not in SKIPPED_MODULES:
+                owner = frame.f_locals.get("self")
+                if owner is not None:
+                    return f"{type(owner).__name__}.{frame.f_code.co_name}"
+                return f"{module}.{frame.f_code.co_name}"
+            frame = frame.f_back
+
+        return None
+
+    @staticmethod
+    def plan_stages(plan: dict) -> list[str]:
+        stages = []
+        while plan:
+            stage = plan.get("stage", "")
+            if plan.get("indexName"):
+                stage += f"({plan['indexName']})"
+            stages.append(stage)
+            plan = plan.get("inputStage") or plan.get("queryPlan", {}).get("inputStage") or {}
+        return stages
+
+    @staticmethod
+    def redact(value):
+        if isinstance(value, dict):
+            return {key: SlowQueryLog.redact(item) for key, item in value.items()}
+
+        if isinstance(value, (list, tuple)):
+            shapes = []
+            for item in value:
+                shape = SlowQueryLog.redact(item)
+                if shape not in shapes:
+                    shapes.append(shape)
+            return shapes
+
+        if value is None:
+            return None
+        return "?"
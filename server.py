@@ -1,62 +1,131 @@
+import argparse
+import atexit
+import json
 import os
+from typing import Callable
+
 import pymongo
 from dotenv import *
 from flask import Flask, request, jsonify, g
 
 from api import *
-from api.region_api import RegionApi
-from lib.identity import *
-from lib.project import *
-from lib.infra import *
+from lib.metrics import CommandMetrics, Metrics
+from lib.prefork import PreforkServer
+from lib.slow_queries import SlowQueryLog
 from web import *
+from wiring import ERROR_RESPONSES, apply_migrations, build_controller, close_request, error_body, open_request, \
+    register, start_background, stop_background
 
-app = Flask(__name__)
 load_dotenv()
 
-jwt_signing_key = os.getenv("JWT_SIGNING_KEY")
-db = pymongo.MongoClient(os.getenv("DB_HOST"), int(os.getenv("DB_PORT"))).controller
 
-organization_service = OrganizationService(db.organizations)
-user_service = UserService(db.users, organization_service, jwt_signing_key)
-project_access_service = ProjectAccessService(db.project_accesses)
-project_service = ProjectService(db.projects, project_access_service, user_service)
-region_service = RegionService(db.regions, project_access_service)
-data_center_service = DataCenterService(db.data_centers, region_service, project_access_service)
-machine_key_service = MachineKeyService(db.machine_keys, project_access_service)
+def create_app(max_pool_size: int = 100, background: bool = True, leader: bool = True, worker: int = None,
+               threads: int = None) -> Flask:
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app, os.getenv("JSON_ISO_DATETIMES", "false") == "true")
+
+    if worker is None:
+        metrics = Metrics()
+    else:
+        metrics = Metrics(labels={"worker": worker},
+                          snapshot_path=os.path.join(os.getenv("METRICS_DIR", "metrics"), f"worker-{worker}.json"),
+                          snapshot_interval=float(os.getenv("METRICS_SNAPSHOT_INTERVAL", 5)))
+    slow_query_log = SlowQueryLog(
+        float(os.getenv("SLOW_QUERY_MS", 100)),
+        os.getenv("SLOW_QUERY_LOG", "slow_queries.log"),
+        int(os.getenv("SLOW_QUERY_EXPLAIN_PER_MINUTE", 6)),
+        worker=worker,
+    )
+    mongo_client = pymongo.MongoClient(
+        os.getenv("DB_HOST"),
+        int(os.getenv("DB_PORT")),
+        maxPoolSize=max_pool_size,
+        event_listeners=[CommandMetrics(metrics), slow_query_log],
+    )
+    slow_query_log.attach(mongo_client)
+    db = mongo_client[os.getenv("DB_NAME", "controller")]
+    controller = build_controller(db, db, metrics, threads=threads)
+
+    if background:
+        start_background(controller, leader)
+
+    def shutdown():
+        stop_background(controller)
+        slow_query_log.shutdown()
+        mongo_client.close()
 
-HealthApi(app).register()
-OrganizationApi(app, organization_service).register()
-UserApi(app, user_service).register()
-ProjectApi(app, project_service).register()
-DataCenterApi(app, data_center_service).register()
-RegionApi(app, region_service).register()
-MachineKeyApi(app, machine_key_service).register()
+    atexit.register(shutdown)
 
-Web(app).register()
+    register(app, controller)
+    Web(app).register()
 
+    @app.before_request
+    def before_request():
+        open_request(controller, g)
+        g.request_body = request.get_json(force=True, silent=True)
 
-@app.before_request
-def before_request():
-    g.request_body = request.get_json(force=True, silent=True)
-    g.db = db
-    g.jwt_signing_key = jwt_signing_key
+    @app.after_request
+    def after_request(response):
+        return close_request(controller, g, request, response)
 
+    for error, status, headers in ERROR_RESPONSES:
+        app.register_error_handler(error, lambda e, status=status, headers=headers: (
+            jsonify(error_body(e)), status, headers))
 
-@app.errorhandler(404)
-def handle_404_error(e):
-    return jsonify({
-        "success": False,
-        "message": str(e)
-    }), 404
+    controller.app = app
+    controller.shutdown = shutdown
+    app.extensions["controller"] = controller
+    return app
 
 
-@app.errorhandler(Exception)
-def handle_all_errors(e):
-    return jsonify({
-        "success": False,
-        "message": str(e)
-    }), 500
+def create_worker(worker: int) -> tuple[Flask, Callable]:
+    # the client is created after fork, sized for the request threads plus the background threads
+    threads = int(os.getenv("WORKER_THREADS", 8))
+    app = create_app(int(os.getenv("DB_MAX_POOL_SIZE", 0)) or threads + 4, leader=worker == 0, worker=worker,
+                     threads=threads)
+    return app, app.extensions["controller"].shutdown
+
+
+def migrate():
+    controller = create_app(background=False).extensions["controller"]
+    apply_migrations(controller)
+    controller.shutdown()
 
 
 if __name__ == '__main__':
-    app.run(host=os.getenv("HOST"), port=int(os.getenv("PORT")), debug=os.getenv("ENV") != "PROD")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "indexes", "reconcile"])
+    parser.add_argument("--dry-run", action="store_true", help="report missing, changed and extra indexes only")
+    parser.add_argument("--prune", action="store_true", help="drop indexes that are not declared by any service")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rebuild indexes whose declared spec differs from the existing one")
+    parser.add_argument("--delete", action="store_true", help="delete the orphans found by reconcile")
+    args = parser.parse_args()
+
+    if args.command == "indexes":
+        controller = create_app(background=False).extensions["controller"]
+        if not args.dry_run:
+            controller.heartbeat_recorder.ensure_collection()
+            controller.liveness_tracker.ensure_collection()
+
+        report = controller.index_manager.apply(dry_run=args.dry_run, prune=args.prune, rebuild=args.rebuild)
+        print(json.dumps(report, indent=2))
+        controller.shutdown()
+    elif args.command == "reconcile":
+        controller = create_app(background=False).extensions["controller"]
+        print(json.dumps(controller.reconciler.reconcile(delete=args.delete), indent=2))
+        controller.shutdown()
+    elif os.getenv("ENV") == "PROD":
+        migrate()
+        Metrics.clear_snapshots(os.getenv("METRICS_DIR", "metrics"))
+        PreforkServer(
+            create_worker,
+            os.getenv("HOST"),
+            int(os.getenv("PORT")),
+            int(os.getenv("WORKERS", 0)),
+            int(os.getenv("WORKER_THREADS", 8)),
+            float(os.getenv("GRACEFUL_TIMEOUT", 30)),
+        ).serve()
+    else:
+        migrate()
+        create_app().run(host=os.getenv("HOST"), port=int(os.getenv("PORT")), debug=True)
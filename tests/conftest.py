@@ -0,0 +1,23 @@
+import os
+import uuid
+
+import pymongo
+import pytest
+from pymongo.errors import PyMongoError
+
+
+@pytest.fixture
+def mongo_db():
+    # these tests need a real mongod; point MONGO_TEST_URL at one, they are skipped otherwise
+    client = pymongo.MongoClient(os.getenv("MONGO_TEST_URL", "mongodb://localhost:27017"),
+                                 serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        client.close()
+        pytest.skip("requires mongod")
+
+    name = f"controller_test_{uuid.uuid4().hex[:8]}"
+    yield client[name]
+    client.drop_database(name)
+    client.close()
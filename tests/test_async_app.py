@@ -0,0 +1,48 @@
+import asyncio
+import importlib
+import os
+
+from pymongo.uri_parser import parse_uri
+
+
+def call(client, method: str, url: str, body: dict = None, token: str = None, expect: int = 200):
+    async def send():
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        response = await client.open(url, method=method, json=body, headers=headers)
+        assert response.status_code == expect, (method, url, response.status_code, await response.get_data())
+        return await response.get_json()
+
+    return send()
+
+
+def test_async_app_serves_the_api(mongo_db, monkeypatch, tmp_path):
+    host, port = parse_uri(os.getenv("MONGO_TEST_URL", "mongodb://localhost:27017"))["nodelist"][0]
+    monkeypatch.setenv("DB_HOST", host)
+    monkeypatch.setenv("DB_PORT", str(port))
+    monkeypatch.setenv("DB_NAME", mongo_db.name)
+    monkeypatch.setenv("SLOW_QUERY_LOG", str(tmp_path / "slow_queries.log"))
+    asgi = importlib.import_module("asgi")
+
+    async def scenario():
+        async with asgi.app.test_app() as test_app:
+            client = test_app.test_client()
+            signup = {"username": "admin", "password": "password", "organization_name": "organization"}
+            await call(client, "POST", "/api/v1/users/signup", signup)
+            await call(client, "POST", "/api/v1/users/signup", signup, expect=500)
+            token = (await call(client, "POST", "/api/v1/users/token", signup))["token"]
+
+            project_id = (await call(client, "POST", "/api/v1/projects", {"name": "project"}, token))["id"]
+            regions = f"/api/v1/projects/{project_id}/infra/regions"
+            region_id = (await call(client, "POST", regions, {"name": "region", "description": ""}, token))["id"]
+            await call(client, "PUT", f"{regions}/{region_id}", {"name": "renamed", "description": ""}, token)
+            assert (await call(client, "GET", f"{regions}/{region_id}", token=token))["name"] == "renamed"
+
+            machine_keys = f"/api/v1/projects/{project_id}/infra/machine-keys"
+            machine_key_id = (await call(client, "POST", machine_keys, {"name": "key"}, token))["id"]
+            assert (await call(client, "GET", f"{machine_keys}/{machine_key_id}/key", token=token))["key"]
+
+            await call(client, "DELETE", f"/api/v1/projects/{project_id}", token=token)
+            await call(client, "GET", f"{regions}/{region_id}", token=token, expect=500)
+
+    asyncio.run(scenario())
+    assert mongo_db.users.count_documents({}) == 1
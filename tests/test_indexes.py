@@ -0,0 +1,56 @@
+import pytest
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from lib.indexes import IndexManager
+
+
+def rebuild(collection, model: IndexModel):
+    IndexManager.rebuild(collection, model, collection.index_information()[model.document["name"]])
+    return collection.index_information()
+
+
+def test_rebuild_changed_key(mongo_db):
+    collection = mongo_db.machines
+    collection.create_index([("project_id", ASCENDING)], name="project")
+    collection.insert_many([{"project_id": 1, "name": "a"}, {"project_id": 1, "name": "b"}])
+
+    model = IndexModel([("project_id", ASCENDING), ("name", DESCENDING)], name="project", unique=True)
+    indexes = rebuild(collection, model)
+
+    assert indexes["project"]["key"] == [("project_id", ASCENDING), ("name", DESCENDING)]
+    assert indexes["project"]["unique"]
+    assert "project_rebuild" not in indexes
+
+
+def test_rebuild_changed_options(mongo_db):
+    collection = mongo_db.machines
+    collection.create_index([("name", ASCENDING)], name="name")
+    collection.insert_many([{"name": "a"}, {"name": "b"}])
+
+    indexes = rebuild(collection, IndexModel([("name", ASCENDING)], name="name", unique=True))
+
+    assert indexes["name"]["unique"]
+    assert "name_rebuild" not in indexes
+
+
+def test_rebuild_keeps_old_index_when_new_spec_fails(mongo_db):
+    collection = mongo_db.machines
+    collection.create_index([("name", ASCENDING)], name="name")
+    collection.insert_many([{"name": "a"}, {"name": "a"}])
+
+    with pytest.raises(OperationFailure):
+        rebuild(collection, IndexModel([("name", ASCENDING)], name="name", unique=True))
+
+    indexes = collection.index_information()
+    assert not indexes["name"].get("unique")
+    assert "name_rebuild" not in indexes
+
+
+def test_rebuild_changed_ttl(mongo_db):
+    collection = mongo_db.cache_invalidations
+    collection.create_index([("created_at", ASCENDING)], name="created_at", expireAfterSeconds=60)
+
+    indexes = rebuild(collection, IndexModel([("created_at", ASCENDING)], name="created_at", expireAfterSeconds=120))
+
+    assert indexes["created_at"]["expireAfterSeconds"] == 120
@@ -0,0 +1,49 @@
+import time
+from datetime import datetime
+
+from lib.infra import LivenessTracker
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_leader_counts_heartbeats_forwarded_by_other_workers(mongo_db):
+    leader = LivenessTracker(mongo_db.machines, None, offline_after=2, tick=0.1, events_size=4096)
+    follower = LivenessTracker(mongo_db.machines, None, offline_after=2, tick=0.1, events_size=4096)
+    follower.ensure_collection()
+    leader.start()
+    try:
+        follower.forward([{"project_id": "project", "name": "machine", "received_at": datetime.now()}])
+        wait_for(lambda: follower.counts_for("project")["online"] == 1)
+        assert leader.counts_for("project") == {"project_id": "project", "online": 1, "offline": 0}
+
+        # without new heartbeats the machine expires and the published counts follow
+        wait_for(lambda: follower.counts_for("project")["offline"] == 1)
+        assert follower.counts_for("project")["online"] == 0
+    finally:
+        leader.stop()
+
+
+def test_restarted_leader_reads_back_flushed_machines(mongo_db):
+    leader = LivenessTracker(mongo_db.machines, None, offline_after=60, tick=0.1, events_size=4096)
+    follower = LivenessTracker(mongo_db.machines, None, offline_after=60, tick=0.1, events_size=4096)
+    follower.ensure_collection()
+
+    # more forwarded batches than the capped collection holds, the rebuild reads them from the machines
+    now = datetime.now()
+    mongo_db.machines.insert_many([
+        {"project_id": "project", "name": f"machine-{i}", "last_seen": now, "online": True} for i in range(50)
+    ])
+    for i in range(50):
+        follower.forward([{"project_id": "project", "name": f"machine-{i}", "received_at": now}])
+
+    leader.start()
+    try:
+        wait_for(lambda: follower.counts_for("project")["online"] == 50)
+        assert leader.counts_for("project") == {"project_id": "project", "online": 50, "offline": 0}
+    finally:
+        leader.stop()
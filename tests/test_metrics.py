@@ -0,0 +1,34 @@
+from lib.metrics import Metrics
+
+
+def worker_metrics(directory, worker: int) -> Metrics:
+    metrics = Metrics(labels={"worker": worker}, snapshot_path=str(directory / f"worker-{worker}.json"))
+    metrics.increment("controller_http_requests_total", {"endpoint": "/health", "status": 200}, worker + 1)
+    metrics.observe("controller_http_request_duration_seconds", {"endpoint": "/health"}, 0.002)
+    metrics.add_collector(lambda: [("controller_heartbeat_queue_depth", "gauge", {}, worker)])
+    return metrics
+
+
+def test_scrape_reports_every_worker(tmp_path):
+    Metrics.clear_snapshots(str(tmp_path))
+    serving, other = worker_metrics(tmp_path, 0), worker_metrics(tmp_path, 1)
+    other.write_snapshot()
+
+    rendered = serving.render()
+    assert 'controller_http_requests_total{worker="0",endpoint="/health",status="200"} 1' in rendered
+    assert 'controller_http_requests_total{worker="1",endpoint="/health",status="200"} 2' in rendered
+    assert 'controller_http_request_duration_seconds_count{worker="1",endpoint="/health"} 1' in rendered
+    assert 'controller_heartbeat_queue_depth{worker="1"} 1' in rendered
+    # each family is declared once, with the samples of all workers below it
+    assert rendered.count("# TYPE controller_http_requests_total counter") == 1
+
+    # a scrape answered by the other worker sees the same series
+    serving.write_snapshot()
+    assert other.render().count("controller_http_requests_total{") == 2
+
+
+def test_cleared_snapshots_are_not_reported(tmp_path):
+    worker_metrics(tmp_path, 1).write_snapshot()
+    Metrics.clear_snapshots(str(tmp_path))
+
+    assert 'worker="1"' not in worker_metrics(tmp_path, 0).render()
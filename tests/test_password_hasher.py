@@ -0,0 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.errors import ServiceBusyError
+from lib.identity import PasswordHasher
+
+THREADS = 4
+
+
+def test_admission_leaves_a_request_thread_free():
+    hasher = PasswordHasher(rounds=4, workers=2, max_queue=32, threads=THREADS)
+    assert hasher.limit == THREADS - 1
+    hasher.shutdown()
+
+
+def test_burst_is_rejected_while_other_requests_are_served():
+    hasher = PasswordHasher(rounds=12, workers=1, max_queue=32, threads=THREADS)
+    requests = ThreadPoolExecutor(max_workers=THREADS)
+    try:
+        logins = [requests.submit(hasher.hash, "password") for _ in range(THREADS * 4)]
+        crud = requests.submit(lambda: "served")
+
+        # the request is answered while admitted logins are still hashing, not after them
+        assert crud.result(timeout=5) == "served"
+        assert hasher.stats()["pending"] > 0
+
+        rejected = 0
+        for login in logins:
+            try:
+                login.result()
+            except ServiceBusyError:
+                rejected += 1
+
+        assert rejected >= len(logins) - hasher.limit
+        assert hasher.stats()["rejected"] == rejected
+    finally:
+        requests.shutdown()
+        hasher.shutdown()
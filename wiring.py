@@ -0,0 +1,300 @@
+import os
+import time
+from types import SimpleNamespace
+
+from api import *
+from api.region_api import RegionApi
+from lib.cache import LruCache
+from lib.cascade import AsyncCascadeService, CascadeService
+from lib.errors import ServiceBusyError
+from lib.identity import *
+from lib.indexes import IndexManager
+from lib.infra import *
+from lib.invalidations import InvalidationBus
+from lib.metrics import Metrics
+from lib.project import *
+from lib.reconciler import Reconciler
+
+SERVICES = SimpleNamespace(
+    organization=OrganizationService,
+    user=UserService,
+    project_access=ProjectAccessService,
+    project=ProjectService,
+    region=RegionService,
+    data_center=DataCenterService,
+    machine_key=MachineKeyService,
+    machine=MachineService,
+    heartbeat_history=HeartbeatHistoryService,
+    liveness=LivenessTracker,
+    infra_export=InfraExportService,
+    cascade=CascadeService,
+)
+
+ASYNC_SERVICES = SimpleNamespace(
+    organization=AsyncOrganizationService,
+    user=AsyncUserService,
+    project_access=AsyncProjectAccessService,
+    project=AsyncProjectService,
+    region=AsyncRegionService,
+    data_center=AsyncDataCenterService,
+    machine_key=AsyncMachineKeyService,
+    machine=AsyncMachineService,
+    heartbeat_history=AsyncHeartbeatHistoryService,
+    liveness=AsyncLivenessTracker,
+    infra_export=AsyncInfraExportService,
+    cascade=AsyncCascadeService,
+)
+
+ERROR_RESPONSES = [
+    (404, 404, {}),
+    (ServiceBusyError, 503, {"Retry-After": "1"}),
+    (Exception, 500, {}),
+]
+
+
+def build_controller(db, background_db, metrics: Metrics, services: SimpleNamespace = SERVICES,
+                     threads: int = None) -> SimpleNamespace:
+    # request services use db; the heartbeat writer, rollups, liveness, cascade deletes and reconciliation run on
+    # their own threads with background_db, which is the same database unless db is on the async driver
+    jwt_signing_key = os.getenv("JWT_SIGNING_KEY")
+    token_cache = LruCache(int(os.getenv("TOKEN_CACHE_SIZE", 10000)), float(os.getenv("TOKEN_CACHE_TTL", 300)))
+
+    organization_service = services.organization(db.organizations)
+    password_hasher = PasswordHasher(
+        int(os.getenv("BCRYPT_ROUNDS", 12)),
+        int(os.getenv("BCRYPT_WORKERS", 4)),
+        int(os.getenv("BCRYPT_QUEUE", 32)),
+        metrics,
+        threads,
+    )
+    permission_cache = LruCache(int(os.getenv("PERMISSION_CACHE_SIZE", 100000)),
+                                float(os.getenv("PERMISSION_CACHE_TTL", 30)))
+    project_access_service = services.project_access(db.project_accesses, permission_cache)
+    machine_key_cache = LruCache(int(os.getenv("MACHINE_KEY_CACHE_SIZE", 100000)),
+                                 float(os.getenv("MACHINE_KEY_CACHE_TTL", 60)))
+    machine_key_service = services.machine_key(db.machine_keys, project_access_service, machine_key_cache)
+    # every worker keeps its own caches, grants and revocations reach the other workers through Mongo
+    invalidation_bus = InvalidationBus(
+        background_db,
+        float(os.getenv("CACHE_INVALIDATION_POLL_INTERVAL", 1)),
+        int(os.getenv("CACHE_INVALIDATION_RETENTION", 3600)),
+    )
+    invalidation_bus.attach("permission", permission_cache)
+    invalidation_bus.attach("machine_key", machine_key_cache)
+    invalidation_hooks = {
+        "project_accesses": ({"project_id": 1, "user_id": 1}, project_access_service.invalidate_mappings),
+        "machine_keys": ({"key_hash": 1}, machine_key_service.invalidate_many),
+    }
+    cascade_options = [
+        int(os.getenv("CASCADE_BATCH_SIZE", 1000)),
+        float(os.getenv("CASCADE_POLL_INTERVAL", 5)),
+        float(os.getenv("CASCADE_LEASE", 60)),
+        float(os.getenv("CASCADE_BATCH_PAUSE", 0)),
+        int(os.getenv("CASCADE_JOB_RETENTION", 604800)),
+        invalidation_hooks,
+    ]
+    cascade_service = services.cascade(db, *cascade_options)
+    cascade_deleter = cascade_service if background_db is db else CascadeService(background_db, *cascade_options)
+    reconciler = Reconciler(
+        background_db,
+        int(os.getenv("RECONCILE_BATCH_SIZE", 1000)),
+        float(os.getenv("RECONCILE_BATCH_PAUSE", 0.05)),
+        float(os.getenv("RECONCILE_INTERVAL", 0)),
+        os.getenv("RECONCILE_DELETE", "false") == "true",
+        invalidation_hooks,
+        float(os.getenv("RECONCILE_GRACE", 3600)),
+    )
+    user_service = services.user(db.users, organization_service, jwt_signing_key, password_hasher, cascade_service)
+    project_service = services.project(db.projects, project_access_service, user_service, cascade_service,
+                                       machine_key_service)
+    region_service = services.region(db.regions, project_access_service, cascade_service)
+    data_center_service = services.data_center(db.data_centers, region_service, project_access_service)
+    heartbeat_history_options = [
+        int(os.getenv("HEARTBEAT_RAW_TTL", 172800)),
+        int(os.getenv("HEARTBEAT_MINUTE_TTL", 2592000)),
+        float(os.getenv("HEARTBEAT_ROLLUP_INTERVAL", 60)),
+        int(os.getenv("HEARTBEAT_HISTORY_MAX_POINTS", 500)),
+        int(os.getenv("HEARTBEAT_RAW_MAX_RANGE", 3600)),
+    ]
+    heartbeat_history_service = services.heartbeat_history(db, project_access_service, *heartbeat_history_options)
+    heartbeat_recorder = heartbeat_history_service if background_db is db else \
+        HeartbeatHistoryService(background_db, None, *heartbeat_history_options)
+    liveness_tracker = services.liveness(
+        background_db.machines,
+        project_access_service,
+        float(os.getenv("MACHINE_OFFLINE_AFTER", 90)),
+        float(os.getenv("LIVENESS_TICK", 1)),
+        rebuild_interval=float(os.getenv("LIVENESS_REBUILD_INTERVAL", 0)),
+        events_size=int(os.getenv("LIVENESS_EVENTS_SIZE", 16777216)),
+    )
+    machine_service = services.machine(
+        background_db.machines,
+        machine_key_service,
+        int(os.getenv("HEARTBEAT_FLUSH_SIZE", 1000)),
+        float(os.getenv("HEARTBEAT_FLUSH_INTERVAL", 1)),
+        int(os.getenv("HEARTBEAT_QUEUE_SIZE", 100000)),
+        heartbeat_recorder,
+        liveness_tracker,
+    )
+    infra_export_service = services.infra_export(
+        region_service,
+        data_center_service,
+        machine_key_service,
+        project_access_service,
+        int(os.getenv("EXPORT_BATCH_SIZE", 1000)),
+    )
+
+    return SimpleNamespace(
+        db=db,
+        background_db=background_db,
+        metrics=metrics,
+        jwt_signing_key=jwt_signing_key,
+        token_cache=token_cache,
+        permission_cache=permission_cache,
+        machine_key_cache=machine_key_cache,
+        organization_service=organization_service,
+        password_hasher=password_hasher,
+        user_service=user_service,
+        project_access_service=project_access_service,
+        project_service=project_service,
+        region_service=region_service,
+        data_center_service=data_center_service,
+        machine_key_service=machine_key_service,
+        heartbeat_history_service=heartbeat_history_service,
+        heartbeat_recorder=heartbeat_recorder,
+        liveness_tracker=liveness_tracker,
+        machine_service=machine_service,
+        infra_export_service=infra_export_service,
+        cascade_service=cascade_service,
+        cascade_deleter=cascade_deleter,
+        reconciler=reconciler,
+        invalidation_bus=invalidation_bus,
+        index_manager=IndexManager([
+            organization_service,
+            user_service,
+            project_access_service,
+            project_service,
+            region_service,
+            data_center_service,
+            machine_key_service,
+            machine_service,
+            heartbeat_recorder,
+            cascade_deleter,
+            invalidation_bus,
+        ]),
+    )
+
+
+def register(app, controller: SimpleNamespace):
+    HealthApi(app).register()
+    MetricsApi(app, controller.metrics).register()
+    OrganizationApi(app, controller.organization_service).register()
+    UserApi(app, controller.user_service).register()
+    ProjectApi(app, controller.project_service).register()
+    DataCenterApi(app, controller.data_center_service).register()
+    RegionApi(app, controller.region_service).register()
+    MachineKeyApi(app, controller.machine_key_service).register()
+    MachineApi(app, controller.machine_service, controller.heartbeat_history_service,
+               controller.liveness_tracker).register()
+    InfraApi(app, controller.infra_export_service).register()
+
+    metrics = controller.metrics
+    metrics.add_collector(lambda: service_metrics(controller))
+    metrics.describe("controller_http_requests_total", "HTTP requests by endpoint and status")
+    metrics.describe("controller_http_request_duration_seconds", "HTTP request latency by endpoint")
+    metrics.describe("controller_http_request_mongo_seconds", "Time each HTTP request spent waiting on Mongo")
+    metrics.describe("controller_operation_duration_seconds", "Latency of bcrypt, JWT and JSON encoding work")
+
+
+def service_metrics(controller: SimpleNamespace):
+    for name, cache in [("permission", controller.permission_cache), ("token", controller.token_cache),
+                        ("machine_key", controller.machine_key_cache)]:
+        stats = cache.stats()
+        yield "controller_cache_entries", "gauge", {"cache": name}, stats["size"]
+        yield "controller_cache_hits_total", "counter", {"cache": name}, stats["hits"]
+        yield "controller_cache_misses_total", "counter", {"cache": name}, stats["misses"]
+        yield "controller_cache_evictions_total", "counter", {"cache": name}, stats["evictions"]
+
+    hasher_stats = controller.password_hasher.stats()
+    yield "controller_password_hasher_pending", "gauge", {}, hasher_stats["pending"]
+    yield "controller_password_hasher_rejected_total", "counter", {}, hasher_stats["rejected"]
+    yield "controller_heartbeat_queue_depth", "gauge", {}, controller.machine_service.queue.qsize()
+
+    if controller.liveness_tracker.tracking:
+        liveness_stats = controller.liveness_tracker.stats()
+        yield "controller_machines", "gauge", {"state": "online"}, liveness_stats["online"]
+        yield "controller_machines", "gauge", {"state": "offline"}, liveness_stats["offline"]
+
+    cascade_stats = controller.cascade_deleter.stats()
+    for collection_name, deleted in cascade_stats["deleted"].items():
+        yield "controller_cascade_deleted_total", "counter", {"collection": collection_name}, deleted
+    yield "controller_cascade_jobs_finished_total", "counter", {}, cascade_stats["finished"]
+
+    reconciler_stats = controller.reconciler.stats()
+    yield "controller_reconcile_runs_total", "counter", {}, reconciler_stats["runs"]
+    yield "controller_orphans_found_total", "counter", {}, reconciler_stats["orphaned"]
+    yield "controller_orphans_deleted_total", "counter", {}, reconciler_stats["deleted"]
+
+    invalidation_stats = controller.invalidation_bus.stats()
+    yield "controller_cache_invalidations_published_total", "counter", {}, invalidation_stats["published"]
+    yield "controller_cache_invalidations_received_total", "counter", {}, invalidation_stats["received"]
+
+
+def start_background(controller: SimpleNamespace, leader: bool = True):
+    controller.machine_service.start()
+    controller.invalidation_bus.start()
+    controller.metrics.start()
+    # every worker flushes its own heartbeats and forwards them to the leader, which alone tracks liveness, rolls
+    # history up and deletes
+    if leader:
+        controller.liveness_tracker.start()
+        controller.heartbeat_recorder.start()
+        controller.cascade_deleter.start()
+        controller.reconciler.start()
+
+
+def stop_background(controller: SimpleNamespace):
+    controller.machine_service.stop()
+    controller.heartbeat_recorder.stop()
+    controller.liveness_tracker.stop()
+    controller.cascade_deleter.stop()
+    controller.reconciler.stop()
+    controller.invalidation_bus.stop()
+    controller.metrics.stop()
+    controller.password_hasher.shutdown()
+
+
+def apply_migrations(controller: SimpleNamespace):
+    # runs on the blocking driver, the ASGI app builds a second controller on its background database for it
+    controller.heartbeat_recorder.ensure_collection()
+    controller.liveness_tracker.ensure_collection()
+    controller.index_manager.migrate()
+    controller.machine_key_service.backfill_key_hashes()
+
+
+def open_request(controller: SimpleNamespace, g):
+    g.request_started = time.perf_counter()
+    g.metrics = controller.metrics
+    controller.metrics.start_request()
+    g.db = controller.db
+    g.jwt_signing_key = controller.jwt_signing_key
+    g.token_cache = controller.token_cache
+
+
+def close_request(controller: SimpleNamespace, g, request, response):
+    metrics = controller.metrics
+    labels = {
+        "method": request.method,
+        "endpoint": request.url_rule.rule if request.url_rule else "unmatched",
+    }
+    metrics.increment("controller_http_requests_total", {**labels, "status": response.status_code})
+    metrics.observe("controller_http_request_duration_seconds", labels, time.perf_counter() - g.request_started)
+    metrics.observe("controller_http_request_mongo_seconds", labels, metrics.finish_request())
+    return response
+
+
+def error_body(e: Exception) -> dict:
+    return {
+        "success": False,
+        "message": str(e)
+    }